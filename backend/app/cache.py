@@ -2,118 +2,629 @@
 Redis кэширование для высокопроизводительного распределенного кэша
 """
 
+import asyncio
+import gzip
 import json
 import logging
-from typing import Optional, Any
+import math
+import random
+import secrets
+import struct
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Any, Tuple
 import redis.asyncio as aioredis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
 from .config import settings
 
 logger = logging.getLogger(__name__)
 
 _redis_client: Optional[aioredis.Redis] = None
+_redis_connect_task: Optional[asyncio.Task] = None
 
+# Ошибки, после которых соединение с Redis считается потерянным
+_REDIS_CONNECTION_ERRORS = (RedisConnectionError, RedisTimeoutError, ConnectionError, OSError, asyncio.TimeoutError)
 
-async def get_redis() -> Optional[aioredis.Redis]:
-    """Получить Redis клиент, создавая при необходимости"""
+
+class _RedisCircuitBreaker:
+    """
+    Предохранитель для Redis: closed - работаем, open - Redis считается
+    недоступным до retry_at, half_open - идет пробное подключение.
+    Задержка между попытками растет экспоненциально (с jitter) до max_delay.
+    """
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.retry_at = 0.0  # time.monotonic()
+        self.opened_at: Optional[float] = None  # unix time
+        self.last_error: Optional[str] = None
+
+    def record_failure(self, error: BaseException) -> None:
+        self.consecutive_failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        delay = min(self.max_delay, self.base_delay * 2 ** (self.consecutive_failures - 1))
+        delay *= 1 + random.random() * 0.1  # jitter, чтобы воркеры не ломились одновременно
+        # Неудачная проба из half_open продолжает тот же обрыв, а не начинает новый
+        if self.state == "closed":
+            self.trips += 1
+            self.opened_at = time.time()
+        self.state = "open"
+        self.retry_at = time.monotonic() + delay
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def probe_due(self) -> bool:
+        return self.state == "open" and time.monotonic() >= self.retry_at
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "connected": _redis_client is not None,
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+            "opened_at": self.opened_at,
+            "retry_in_seconds": round(max(0.0, self.retry_at - time.monotonic()), 3) if self.state == "open" else None,
+            "last_error": self.last_error,
+        }
+
+
+_redis_breaker = _RedisCircuitBreaker()
+
+
+async def _connect_redis() -> None:
+    """Одна попытка подключения к Redis; результат фиксируется в предохранителе."""
     global _redis_client
-    
-    if _redis_client is None:
-        try:
-            redis_url = getattr(settings, 'redis_url', 'redis://localhost:6379/0')
-            _redis_client = await aioredis.from_url(
-                redis_url,
-                encoding="utf-8",
-                decode_responses=False,  # Работаем с bytes для производительности
-                socket_connect_timeout=2,
-                socket_timeout=2,
-                retry_on_timeout=True,
-                health_check_interval=30,
-                # Connection pooling для лучшей производительности
-                max_connections=50,
-                socket_keepalive=True,
-                socket_keepalive_options={},
-            )
-            # Проверяем подключение
-            await _redis_client.ping()
-            logger.info("✅ Redis подключен успешно")
-        except Exception as e:
+    if _redis_breaker.state == "open":
+        _redis_breaker.state = "half_open"
+    client = None
+    try:
+        redis_url = getattr(settings, 'redis_url', 'redis://localhost:6379/0')
+        client = await aioredis.from_url(
+            redis_url,
+            encoding="utf-8",
+            decode_responses=False,  # Работаем с bytes для производительности
+            socket_connect_timeout=2,
+            socket_timeout=2,
+            retry_on_timeout=True,
+            health_check_interval=30,
+            # Connection pooling для лучшей производительности
+            max_connections=50,
+            socket_keepalive=True,
+            socket_keepalive_options={},
+        )
+        # Проверяем подключение
+        await client.ping()
+        _redis_client = client
+        _redis_breaker.record_success()
+        logger.info("✅ Redis подключен успешно")
+    except Exception as e:
+        if _redis_breaker.consecutive_failures == 0:
             logger.warning(f"⚠️ Redis недоступен, работаем без кэша: {e}")
-            _redis_client = None
-    
+        _redis_breaker.record_failure(e)
+        if client is not None:
+            try:
+                await client.close()
+            except Exception:
+                pass
+
+
+def _schedule_redis_connect() -> asyncio.Task:
+    global _redis_connect_task
+    if _redis_connect_task is None or _redis_connect_task.done():
+        _redis_connect_task = asyncio.create_task(_connect_redis())
+    return _redis_connect_task
+
+
+async def connect_redis() -> Optional[aioredis.Redis]:
+    """Подключиться к Redis, дожидаясь результата (для старта приложения)"""
+    if _redis_client is None:
+        await _schedule_redis_connect()
     return _redis_client
 
 
+async def get_redis() -> Optional[aioredis.Redis]:
+    """
+    Получить Redis клиент без ожидания переподключения.
+    Если клиента нет, подключение запускается в фоне (не чаще, чем разрешает
+    предохранитель), а вызывающий сразу получает None и работает без кэша.
+    """
+    if _redis_client is not None:
+        return _redis_client
+    if _redis_breaker.state == "closed" or _redis_breaker.probe_due():
+        _schedule_redis_connect()
+    return None
+
+
+def _handle_redis_error(error: BaseException) -> None:
+    """При ошибке соединения сбрасывает клиента и размыкает предохранитель."""
+    global _redis_client
+    if not isinstance(error, _REDIS_CONNECTION_ERRORS) or _redis_client is None:
+        return
+    client = _redis_client
+    _redis_client = None
+    _redis_breaker.record_failure(error)
+    logger.warning(f"⚠️ Соединение с Redis потеряно, повтор через backoff: {error}")
+    asyncio.ensure_future(_close_quietly(client))
+
+
+def report_redis_error(error: BaseException) -> None:
+    """Сообщить об ошибке команды Redis, выполненной вне этого модуля (get_redis())"""
+    _handle_redis_error(error)
+
+
+async def _close_quietly(client: aioredis.Redis) -> None:
+    try:
+        await client.close()
+    except Exception:
+        pass
+
+
+def get_redis_breaker_state() -> dict:
+    return _redis_breaker.to_dict()
+
+
 async def close_redis():
     """Закрыть соединение с Redis"""
     global _redis_client
+    if _redis_connect_task is not None and not _redis_connect_task.done():
+        _redis_connect_task.cancel()
     if _redis_client:
         await _redis_client.close()
         _redis_client = None
         logger.info("Redis соединение закрыто")
 
 
+# Границы бакетов гистограммы задержек Redis (миллисекунды); последний бакет - все, что больше
+_LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class _PrefixStats:
+    """Счетчики кэша для одного префикса ключа (часть до первого ':')."""
+
+    __slots__ = (
+        "hits", "misses", "l1_hits", "l1_misses", "sets", "deletes", "errors",
+        "bytes_read", "bytes_written", "latency_buckets", "latency_total_ms", "latency_count",
+    )
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.l1_hits = 0
+        self.l1_misses = 0
+        self.sets = 0
+        self.deletes = 0
+        self.errors = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.latency_buckets = [0] * (len(_LATENCY_BUCKETS_MS) + 1)
+        self.latency_total_ms = 0.0
+        self.latency_count = 0
+
+    def observe_latency(self, started: float) -> None:
+        self.observe_elapsed((time.perf_counter() - started) * 1000)
+
+    def observe_elapsed(self, elapsed_ms: float) -> None:
+        self.latency_buckets[bisect_left(_LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        self.latency_total_ms += elapsed_ms
+        self.latency_count += 1
+
+    def to_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "l1_hits": self.l1_hits,
+            "l1_misses": self.l1_misses,
+            "sets": self.sets,
+            "deletes": self.deletes,
+            "errors": self.errors,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "avg_value_bytes": round(self.bytes_written / self.sets) if self.sets else None,
+            "latency_ms": {
+                "count": self.latency_count,
+                "avg": round(self.latency_total_ms / self.latency_count, 3) if self.latency_count else None,
+                "buckets": {
+                    **{f"le_{bound}": count for bound, count in zip(_LATENCY_BUCKETS_MS, self.latency_buckets)},
+                    "inf": self.latency_buckets[-1],
+                },
+            },
+        }
+
+
+_cache_stats: Dict[str, _PrefixStats] = {}
+
+
+def _stats_for(key: str) -> _PrefixStats:
+    prefix = key.split(":", 1)[0]
+    stats = _cache_stats.get(prefix)
+    if stats is None:
+        stats = _cache_stats[prefix] = _PrefixStats()
+    return stats
+
+
+def _observe_round_trip(started: float, keys: Iterable[str]) -> None:
+    """Одно наблюдение задержки на пакетный запрос для каждого префикса в нем"""
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    for stats in {id(stats): stats for stats in map(_stats_for, keys)}.values():
+        stats.observe_elapsed(elapsed_ms)
+
+
+def get_cache_stats() -> Dict[str, dict]:
+    """Счетчики кэша по префиксам ключей с момента старта процесса (или сброса)"""
+    return {prefix: stats.to_dict() for prefix, stats in sorted(_cache_stats.items())}
+
+
+def reset_cache_stats() -> None:
+    _cache_stats.clear()
+
+
 async def cache_get(key: str) -> Optional[bytes]:
     """Получить значение из кэша"""
+    stats = _stats_for(key)
     try:
         redis = await get_redis()
         if redis:
-            return await redis.get(key)
+            started = time.perf_counter()
+            value = await redis.get(key)
+            stats.observe_latency(started)
+            if value is None:
+                stats.misses += 1
+            else:
+                stats.hits += 1
+                stats.bytes_read += len(value)
+            return value
     except Exception as e:
+        _handle_redis_error(e)
+        stats.errors += 1
         # Убираем debug логи в production
         from .config import settings
         if settings.environment != "production":
-        logger.debug(f"Ошибка получения из кэша {key}: {e}")
+            logger.debug(f"Ошибка получения из кэша {key}: {e}")
     return None
 
 
 async def cache_set(key: str, value: bytes, ttl: int = 300) -> bool:
     """Сохранить значение в кэш с TTL"""
+    stats = _stats_for(key)
     try:
         redis = await get_redis()
         if redis:
+            started = time.perf_counter()
             await redis.setex(key, ttl, value)
+            stats.observe_latency(started)
+            stats.sets += 1
+            stats.bytes_written += len(value)
             return True
     except Exception as e:
+        _handle_redis_error(e)
+        stats.errors += 1
         # Убираем debug логи в production
         from .config import settings
         if settings.environment != "production":
-        logger.debug(f"Ошибка сохранения в кэш {key}: {e}")
+            logger.debug(f"Ошибка сохранения в кэш {key}: {e}")
     return False
 
 
 async def cache_delete(key: str) -> bool:
     """Удалить ключ из кэша"""
+    stats = _stats_for(key)
     try:
         redis = await get_redis()
         if redis:
+            started = time.perf_counter()
             await redis.delete(key)
+            stats.observe_latency(started)
+            stats.deletes += 1
             return True
     except Exception as e:
+        _handle_redis_error(e)
+        stats.errors += 1
         # Убираем debug логи в production
         from .config import settings
         if settings.environment != "production":
-        logger.debug(f"Ошибка удаления из кэша {key}: {e}")
+            logger.debug(f"Ошибка удаления из кэша {key}: {e}")
     return False
 
 
-async def cache_delete_pattern(pattern: str) -> int:
-    """Удалить все ключи по паттерну"""
+async def cache_set_many(items: Iterable[Tuple[str, bytes, int]]) -> bool:
+    """Сохранить несколько значений (ключ, значение, TTL) одним pipeline"""
+    items = list(items)
+    if not items:
+        return True
     try:
         redis = await get_redis()
         if redis:
-            keys = []
-            async for key in redis.scan_iter(match=pattern):
-                keys.append(key)
-            if keys:
-                return await redis.delete(*keys)
+            started = time.perf_counter()
+            pipe = redis.pipeline(transaction=False)
+            for key, value, ttl in items:
+                pipe.setex(key, ttl, value)
+            await pipe.execute()
+            _observe_round_trip(started, (key for key, _value, _ttl in items))
+            for key, value, _ttl in items:
+                stats = _stats_for(key)
+                stats.sets += 1
+                stats.bytes_written += len(value)
+            return True
     except Exception as e:
-        # Убираем debug логи в production
+        _handle_redis_error(e)
+        for key, _value, _ttl in items:
+            _stats_for(key).errors += 1
+        if settings.environment != "production":
+            logger.debug(f"Ошибка пакетного сохранения в кэш ({len(items)} ключей): {e}")
+    return False
+
+
+async def cache_publish(channel: str, message: bytes) -> int:
+    """Опубликовать сообщение в Redis канал, возвращает число получателей"""
+    try:
+        redis = await get_redis()
+        if redis:
+            return await redis.publish(channel, message)
+    except Exception as e:
+        _handle_redis_error(e)
         from .config import settings
         if settings.environment != "production":
-        logger.debug(f"Ошибка удаления паттерна {pattern}: {e}")
+            logger.debug(f"Ошибка публикации в канал {channel}: {e}")
     return 0
 
 
+async def cache_subscribe(
+    channel: str,
+    handler: Callable[[bytes], Awaitable[None]],
+    *,
+    on_subscribed: Optional[Callable[[], None]] = None,
+    on_disconnected: Optional[Callable[[], None]] = None,
+    retry_delay: float = 5.0,
+) -> None:
+    """
+    Бесконечно слушает Redis канал и вызывает handler для каждого сообщения.
+    При потере соединения вызывает on_disconnected и переподключается
+    через retry_delay секунд. Предназначено для запуска в фоновой задаче.
+    """
+    while True:
+        redis = await get_redis()
+        if redis is None:
+            if on_disconnected:
+                on_disconnected()
+            await asyncio.sleep(retry_delay)
+            continue
+
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(channel)
+            if on_subscribed:
+                on_subscribed()
+            while True:
+                # Явный timeout, чтобы ожидание не упиралось в socket_timeout клиента
+                message = await pubsub.get_message(timeout=1.0)
+                if message is None or message.get("type") != "message":
+                    continue
+                try:
+                    await handler(message["data"])
+                except Exception as e:
+                    logger.warning(f"Ошибка обработки сообщения из канала {channel}: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _handle_redis_error(e)
+            logger.warning(f"⚠️ Подписка на канал {channel} прервана: {e}")
+        finally:
+            if on_disconnected:
+                on_disconnected()
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+        await asyncio.sleep(retry_delay)
+
+
+# Значение со сжатием: метка формата, имя кодировки, перевод строки, затем данные.
+# Кодировка совпадает с HTTP Content-Encoding, поэтому сжатые байты можно
+# отдавать клиенту без распаковки
+_ENCODED_MAGIC = b"\x00enc:"
+ENCODING_IDENTITY = "identity"
+ENCODING_GZIP = "gzip"
+
+
+def pack_encoded(payload: bytes, encoding: str = ENCODING_IDENTITY) -> bytes:
+    """Упаковать уже закодированные байты вместе с именем кодировки"""
+    return _ENCODED_MAGIC + encoding.encode("ascii") + b"\n" + payload
+
+
+def unpack_encoded(raw: bytes) -> Tuple[str, bytes]:
+    """Возвращает (кодировка, данные); значения без метки считаются несжатыми"""
+    if not raw.startswith(_ENCODED_MAGIC):
+        return ENCODING_IDENTITY, raw
+    encoding_end = raw.find(b"\n", len(_ENCODED_MAGIC))
+    if encoding_end < 0:
+        return ENCODING_IDENTITY, raw
+    return raw[len(_ENCODED_MAGIC):encoding_end].decode("ascii"), raw[encoding_end + 1:]
+
+
+def decode_value(encoding: str, payload: bytes) -> bytes:
+    """Распаковать данные в исходные байты"""
+    if encoding == ENCODING_GZIP:
+        return gzip.decompress(payload)
+    if encoding != ENCODING_IDENTITY:
+        raise ValueError(f"Неизвестная кодировка значения кэша: {encoding}")
+    return payload
+
+
+# Удаляет блокировку, только если она все еще принадлежит нам (токен совпадает)
+_LOCK_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# Конверт значения для cache_get_or_recompute: метка формата, время пересчета
+# (секунды) и логический момент истечения (unix time), затем само значение
+_RECOMPUTE_ENVELOPE = struct.Struct(">4sdd")
+_RECOMPUTE_MAGIC = b"XF01"
+# Ссылки на фоновые ранние пересчеты: цикл событий хранит задачи слабыми
+# ссылками, и без них незавершенный пересчет может собрать сборщик мусора
+_early_recompute_tasks: set = set()
+
+
+async def _try_acquire_lock(key: str, ttl_ms: int) -> Tuple[Optional[bool], Optional[str]]:
+    """
+    Пытается взять блокировку SET NX PX.
+    Возвращает (True, токен), (False, None) если блокировка занята,
+    или (None, None) если Redis недоступен.
+    """
+    try:
+        redis = await get_redis()
+        if redis:
+            token = secrets.token_hex(8)
+            if await redis.set(key, token, nx=True, px=ttl_ms):
+                return True, token
+            return False, None
+    except Exception as e:
+        _handle_redis_error(e)
+        if settings.environment != "production":
+            logger.debug(f"Ошибка захвата блокировки {key}: {e}")
+    return None, None
+
+
+async def cache_release_lock(key: str, token: str) -> bool:
+    """Освободить блокировку, если она все еще принадлежит владельцу токена"""
+    try:
+        redis = await get_redis()
+        if redis:
+            return bool(await redis.eval(_LOCK_RELEASE_SCRIPT, 1, key, token))
+    except Exception as e:
+        _handle_redis_error(e)
+        if settings.environment != "production":
+            logger.debug(f"Ошибка освобождения блокировки {key}: {e}")
+    return False
+
+
+def _pack_recompute_entry(value: bytes, delta: float, expires_at: float) -> bytes:
+    return _RECOMPUTE_ENVELOPE.pack(_RECOMPUTE_MAGIC, delta, expires_at) + value
+
+
+def make_recompute_entry(value: bytes, ttl: int, delta: float = 0.0) -> bytes:
+    """
+    Значение для записи в обход cache_get_or_recompute (например, прогрев
+    через cache_set_many): свежее на ttl секунд, delta - время пересчета.
+    Хранить его в Redis нужно ttl + stale_ttl секунд.
+    """
+    return _pack_recompute_entry(value, delta, time.time() + ttl)
+
+
+def _unpack_recompute_entry(raw: bytes) -> Optional[Tuple[bytes, float, float]]:
+    if len(raw) < _RECOMPUTE_ENVELOPE.size or not raw.startswith(_RECOMPUTE_MAGIC):
+        return None
+    _magic, delta, expires_at = _RECOMPUTE_ENVELOPE.unpack_from(raw)
+    return raw[_RECOMPUTE_ENVELOPE.size:], delta, expires_at
+
+
+async def _recompute_and_store(
+    key: str,
+    lock_key: str,
+    token: str,
+    recompute: Callable[[], Awaitable[bytes]],
+    ttl: int,
+    stale_ttl: int,
+) -> bytes:
+    try:
+        started = time.monotonic()
+        value = await recompute()
+        delta = time.monotonic() - started
+        await cache_set(key, _pack_recompute_entry(value, delta, time.time() + ttl), ttl + stale_ttl)
+        return value
+    finally:
+        await cache_release_lock(lock_key, token)
+
+
+async def _recompute_early(
+    key: str,
+    lock_key: str,
+    recompute: Callable[[], Awaitable[bytes]],
+    ttl: int,
+    stale_ttl: int,
+    lock_ttl_ms: int,
+) -> None:
+    acquired, token = await _try_acquire_lock(lock_key, lock_ttl_ms)
+    if not acquired:
+        return
+    try:
+        await _recompute_and_store(key, lock_key, token, recompute, ttl, stale_ttl)
+    except Exception as e:
+        logger.warning(f"Ошибка раннего пересчета кэша {key}: {e}")
+
+
+async def cache_get_or_recompute(
+    key: str,
+    recompute: Callable[[], Awaitable[bytes]],
+    ttl: int,
+    *,
+    stale_ttl: int = 60,
+    beta: float = 1.0,
+    lock_ttl_ms: int = 10000,
+    wait_timeout: float = 2.0,
+) -> bytes:
+    """
+    Получить значение из Redis, пересчитывая его не более чем в одном процессе.
+
+    - Свежее значение отдается сразу; с ростом близости к истечению (с учетом
+      времени пересчета и beta) растет шанс запустить ранний пересчет в фоне
+      (XFetch), поэтому ключ обычно обновляется до истечения.
+    - Истекшее значение хранится в Redis еще stale_ttl секунд: пересчитывает
+      только владелец блокировки, остальные отдают устаревшее значение.
+    - При полном промахе запросы без блокировки ждут результат владельца до
+      wait_timeout секунд, затем считают сами.
+    - Без Redis (или при ttl <= 0) просто вызывает recompute.
+    """
+    if ttl <= 0 or await get_redis() is None:
+        return await recompute()
+
+    lock_key = f"{key}:lock"
+    raw = await cache_get(key)
+    entry = _unpack_recompute_entry(raw) if raw is not None else None
+    if entry is not None:
+        value, delta, expires_at = entry
+        now = time.time()
+        if now < expires_at:
+            # 1 - random() лежит в (0, 1], поэтому логарифм определен
+            if beta > 0 and now - delta * beta * math.log(1.0 - random.random()) >= expires_at:
+                task = asyncio.create_task(_recompute_early(key, lock_key, recompute, ttl, stale_ttl, lock_ttl_ms))
+                _early_recompute_tasks.add(task)
+                task.add_done_callback(_early_recompute_tasks.discard)
+            return value
+        acquired, token = await _try_acquire_lock(lock_key, lock_ttl_ms)
+        if acquired is False:
+            # Другой процесс уже пересчитывает - отдаем устаревшее значение
+            return value
+        if acquired is None:
+            return await recompute()
+        return await _recompute_and_store(key, lock_key, token, recompute, ttl, stale_ttl)
+
+    acquired, token = await _try_acquire_lock(lock_key, lock_ttl_ms)
+    if acquired:
+        return await _recompute_and_store(key, lock_key, token, recompute, ttl, stale_ttl)
+    if acquired is False:
+        deadline = time.monotonic() + wait_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            raw = await cache_get(key)
+            entry = _unpack_recompute_entry(raw) if raw is not None else None
+            if entry is not None:
+                return entry[0]
+    return await recompute()
+
+
 def make_cache_key(prefix: str, *args, **kwargs) -> str:
     """Создать ключ кэша из префикса и параметров"""
     parts = [prefix]
@@ -124,3 +635,158 @@ def make_cache_key(prefix: str, *args, **kwargs) -> str:
         parts.extend(f"{k}:{v}" for k, v in sorted_kwargs)
     return ":".join(parts)
 
+
+
+_MISSING = object()
+
+
+class TieredCache:
+    """
+    Двухуровневый кэш: ограниченный LRU в памяти процесса (L1) перед Redis (L2).
+
+    L1 хранит объекты как есть, с TTL на каждый ключ. L2 используется, только
+    если заданы encode/decode (значения в Redis - bytes). Одновременные промахи
+    по одному ключу объединяются: loader вызывается один раз, остальные
+    запросы ждут его результат (single-flight).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        maxsize: int = 1024,
+        ttl: float = 60.0,
+        l2_ttl: Optional[int] = None,
+        encode: Optional[Callable[[Any], bytes]] = None,
+        decode: Optional[Callable[[bytes], Any]] = None,
+    ):
+        self.name = name
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self.l2_ttl = l2_ttl if l2_ttl is not None else max(1, int(ttl))
+        self._encode = encode
+        self._decode = decode
+        # ключ -> (момент истечения по time.monotonic(), значение)
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @property
+    def uses_l2(self) -> bool:
+        return self._encode is not None and self._decode is not None
+
+    def _l2_key(self, key: str) -> str:
+        return make_cache_key(self.name, key)
+
+    def _is_current_load(self, key: str) -> bool:
+        # Инвалидация убирает загрузку ключа из _inflight: результат загрузки,
+        # начатой до инвалидации, в L1 не попадает, а другие ключи не затронуты
+        return self._inflight.get(key) is asyncio.current_task()
+
+    def get_local(self, key: str) -> Any:
+        """Значение из L1 или None, если его нет или оно истекло."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set_local(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str) -> Any:
+        """Значение из L1, затем из L2; None при промахе на обоих уровнях."""
+        value = self.get_local(key)
+        if value is not None:
+            _stats_for(self.name).l1_hits += 1
+            return value
+        _stats_for(self.name).l1_misses += 1
+        if not self.uses_l2:
+            return None
+        raw = await cache_get(self._l2_key(key))
+        if raw is None:
+            return None
+        value = self._decode(raw)
+        self.set_local(key, value)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None, l2_ttl: Optional[int] = None) -> None:
+        self.set_local(key, value, ttl)
+        if self.uses_l2:
+            await cache_set(self._l2_key(key), self._encode(value), l2_ttl or self.l2_ttl)
+
+    async def get_or_load(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        *,
+        ttl: Optional[float] = None,
+        l2_ttl: Optional[int] = None,
+    ) -> Any:
+        """
+        Возвращает значение по ключу, при промахе загружая его через loader.
+        Результат None не кэшируется. Исключение loader получают все ожидающие.
+        """
+        value = self.get_local(key)
+        if value is not None:
+            _stats_for(self.name).l1_hits += 1
+            return value
+        _stats_for(self.name).l1_misses += 1
+
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self._load(key, loader, ttl, l2_ttl))
+            self._inflight[key] = flight
+
+            def _forget(done: asyncio.Future, key: str = key) -> None:
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+
+            flight.add_done_callback(_forget)
+        # shield: отмена одного ожидающего запроса не отменяет общую загрузку
+        return await asyncio.shield(flight)
+
+    async def _load(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: Optional[float],
+        l2_ttl: Optional[int],
+    ) -> Any:
+        if self.uses_l2:
+            raw = await cache_get(self._l2_key(key))
+            if raw is not None:
+                value = self._decode(raw)
+                if self._is_current_load(key):
+                    self.set_local(key, value, ttl)
+                return value
+
+        value = await loader()
+        if value is None or not self._is_current_load(key):
+            # Ключ инвалидировали во время загрузки - результат не кэшируем
+            return value
+        self.set_local(key, value, ttl)
+        if self.uses_l2:
+            await cache_set(self._l2_key(key), self._encode(value), l2_ttl or self.l2_ttl)
+        return value
+
+    async def delete(self, key: str) -> None:
+        self.invalidate_local(key)
+        if self.uses_l2:
+            await cache_delete(self._l2_key(key))
+
+    def invalidate_local(self, key: Optional[str] = None) -> None:
+        """Сбрасывает ключ (или весь L1) и отбрасывает результаты его загрузок в полете."""
+        # Новые запросы не должны присоединяться к загрузке, начатой до инвалидации
+        if key is None:
+            self._entries.clear()
+            self._inflight.clear()
+        else:
+            self._entries.pop(key, None)
+            self._inflight.pop(key, None)
@@ -0,0 +1,608 @@
+"""
+Хранилище корзин.
+
+По умолчанию корзины живут в MongoDB (db.carts). В режиме CART_STORE=redis
+живые корзины хранятся в Redis-хешах: изменения позиций выполняются
+атомарно Lua-скриптами, а в db.carts корзины записываются пачками фоновой
+задачей (write-behind). MongoDB остается источником истины: корзина,
+которой нет в Redis (перезапуск Redis, истек TTL), загружается из db.carts.
+
+Если Redis недоступен, операции выполняются напрямую в MongoDB. Копии
+корзин, измененных так, устаревают: при первом обращении к Redis после сбоя
+процесс удаляет их, и корзины заново загружаются из MongoDB. Изменения,
+не сброшенные из Redis до сбоя (не дольше интервала сброса), при этом
+не видны в MongoDB.
+"""
+
+import asyncio
+import logging
+import weakref
+from datetime import datetime
+from typing import List
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# Используем orjson если доступен, иначе fallback на ujson
+try:
+  import orjson
+  HAS_ORJSON = True
+except ImportError:
+  import ujson as orjson
+  HAS_ORJSON = False
+
+from .cache import get_redis, report_redis_error
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Время жизни корзины в минутах
+CART_EXPIRY_MINUTES = 30
+
+_CART_KEY_PREFIX = "cart"
+_DIRTY_CARTS_KEY = "cart:dirty"
+_FLUSH_BATCH_SIZE = 500
+
+# Пересчет total_amount на стороне MongoDB - последняя стадия каждого update-пайплайна
+_TOTAL_STAGE = {
+  "$set": {
+    "total_amount": {
+      "$round": [
+        {
+          "$sum": {
+            "$map": {
+              "input": "$items",
+              "in": {"$multiply": [{"$ifNull": ["$$this.price", 0]}, {"$ifNull": ["$$this.quantity", 0]}]},
+            }
+          }
+        },
+        2,
+      ]
+    }
+  }
+}
+
+# Общая часть Lua-скриптов. Соглашение об аргументах:
+# KEYS[1] - хеш корзины, KEYS[2] - множество несохраненных корзин,
+# ARGV[1] - текущее время (мс), ARGV[2] - TTL хеша (с), ARGV[3] - user_id.
+# Скрипт возвращает 0, если корзины нет в Redis (её нужно загрузить из MongoDB),
+# 1 - если позиция не найдена, иначе HGETALL измененной корзины.
+_LUA_PRELUDE = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+  return 0
+end
+local items = cjson.decode(redis.call("HGET", KEYS[1], "items") or "[]")
+if type(items) ~= "table" then
+  items = {}
+end
+local function save()
+  local total = 0
+  for _, item in ipairs(items) do
+    total = total + (tonumber(item.price) or 0) * (tonumber(item.quantity) or 0)
+  end
+  total = math.floor(total * 100 + 0.5) / 100
+  local encoded = "[]"
+  if #items > 0 then
+    encoded = cjson.encode(items)
+  end
+  redis.call("HSET", KEYS[1], "items", encoded, "total_amount", tostring(total), "updated_at", ARGV[1])
+  redis.call("EXPIRE", KEYS[1], ARGV[2])
+  redis.call("SADD", KEYS[2], ARGV[3])
+  return redis.call("HGETALL", KEYS[1])
+end
+local function find_item(item_id)
+  for index, item in ipairs(items) do
+    if item.id == item_id then
+      return index
+    end
+  end
+  return nil
+end
+"""
+
+# ARGV[4] - позиция (JSON); совпадающая по товару и вариации позиция увеличивается
+_LUA_ADD_ITEM = _LUA_PRELUDE + """
+local new_item = cjson.decode(ARGV[4])
+for _, item in ipairs(items) do
+  if item.product_id == new_item.product_id and item.variant_id == new_item.variant_id then
+    item.quantity = item.quantity + new_item.quantity
+    return save()
+  end
+end
+table.insert(items, new_item)
+return save()
+"""
+
+# ARGV[4] - id позиции, ARGV[5] - новое количество
+_LUA_SET_QUANTITY = _LUA_PRELUDE + """
+local index = find_item(ARGV[4])
+if index == nil then
+  return 1
+end
+items[index].quantity = tonumber(ARGV[5])
+return save()
+"""
+
+# ARGV[4] - id позиции
+_LUA_REMOVE_ITEM = _LUA_PRELUDE + """
+local index = find_item(ARGV[4])
+if index == nil then
+  return 1
+end
+table.remove(items, index)
+return save()
+"""
+
+_LUA_CLEAR = _LUA_PRELUDE + """
+items = {}
+return save()
+"""
+
+# ARGV[4] - новые позиции (JSON), ARGV[5] - ожидаемый updated_at (мс).
+# 1 - корзина изменилась после чтения (оптимистическая блокировка)
+_LUA_REPLACE_ITEMS = _LUA_PRELUDE + """
+if redis.call("HGET", KEYS[1], "updated_at") ~= ARGV[5] then
+  return 1
+end
+items = cjson.decode(ARGV[4])
+if type(items) ~= "table" then
+  items = {}
+end
+return save()
+"""
+
+# ARGV[4] - граница истечения (мс). Просроченная корзина очищается, скрипт
+# возвращает её прежние позиции (JSON); 1 - корзина обновлялась позже границы
+_LUA_EXPIRE = _LUA_PRELUDE + """
+if tonumber(redis.call("HGET", KEYS[1], "updated_at")) > tonumber(ARGV[4]) then
+  return 1
+end
+local expired = redis.call("HGET", KEYS[1], "items") or "[]"
+items = {}
+save()
+return expired
+"""
+
+# Загрузка корзины из MongoDB: ARGV[4..8] - _id, items, total_amount, created_at, updated_at.
+# Если корзину уже загрузил параллельный запрос, она не перезаписывается
+_LUA_PRIME = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+  redis.call("HSET", KEYS[1], "_id", ARGV[4], "user_id", ARGV[3], "items", ARGV[5],
+    "total_amount", ARGV[6], "created_at", ARGV[7], "updated_at", ARGV[8])
+  redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return redis.call("HGETALL", KEYS[1])
+"""
+
+
+# Корзины, измененные этим процессом в MongoDB в обход Redis. Их копии
+# в Redis устарели и удаляются до следующей операции с Redis, чтобы скрипты
+# и сброс (write-behind) не перезаписали изменения, сделанные во время сбоя
+_detached_carts: set[int] = set()
+
+# Зарегистрированные Lua-скрипты по клиентам Redis: Script хранит SHA и
+# выполняется через EVALSHA, а после переподключения появляется новый клиент
+_registered_scripts: "weakref.WeakKeyDictionary[object, dict]" = weakref.WeakKeyDictionary()
+
+
+def _cart_script(redis, script: str):
+  scripts = _registered_scripts.get(redis)
+  if scripts is None:
+    scripts = _registered_scripts[redis] = {}
+  cart_script = scripts.get(script)
+  if cart_script is None:
+    cart_script = scripts[script] = redis.register_script(script)
+  return cart_script
+
+
+async def _evict_detached_carts(redis) -> None:
+  if not _detached_carts:
+    return
+  user_ids = list(_detached_carts)
+  pipe = redis.pipeline(transaction=False)
+  pipe.unlink(*(_cart_key(user_id) for user_id in user_ids))
+  pipe.srem(_DIRTY_CARTS_KEY, *user_ids)
+  await pipe.execute()
+  _detached_carts.difference_update(user_ids)
+
+
+def _redis_enabled() -> bool:
+  return settings.cart_store == "redis"
+
+
+def _cart_key(user_id: int) -> str:
+  return f"{_CART_KEY_PREFIX}:{user_id}"
+
+
+def _cart_ttl_seconds() -> int:
+  # Хеш живет дольше корзины, чтобы фоновые задачи успели её обработать
+  return CART_EXPIRY_MINUTES * 60 * 4
+
+
+def _to_millis(value: datetime) -> int:
+  return int((value - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def _from_millis(value: bytes | str) -> datetime:
+  return datetime.utcfromtimestamp(int(value) / 1000)
+
+
+def _dump_items(items: List[dict]) -> bytes:
+  if HAS_ORJSON:
+    return orjson.dumps(items)
+  return orjson.dumps(items).encode("utf-8")
+
+
+def _decode_redis_cart(raw) -> dict:
+  if isinstance(raw, dict):
+    fields = raw
+  else:
+    fields = dict(zip(raw[::2], raw[1::2]))
+  fields = {
+    (key.decode() if isinstance(key, bytes) else key): value
+    for key, value in fields.items()
+  }
+  items = orjson.loads(fields.get("items") or b"[]")
+  if not isinstance(items, list):
+    # cjson кодирует пустую таблицу как объект
+    items = []
+  cart_id = fields["_id"].decode() if isinstance(fields["_id"], bytes) else fields["_id"]
+  return {
+    "_id": ObjectId(cart_id),
+    "user_id": int(fields["user_id"]),
+    "items": items,
+    "total_amount": float(fields.get("total_amount") or 0),
+    "created_at": _from_millis(fields["created_at"]),
+    "updated_at": _from_millis(fields["updated_at"]),
+  }
+
+
+async def _mongo_load_cart(db: AsyncIOMotorDatabase, user_id: int) -> dict:
+  """Возвращает корзину пользователя, создавая пустую одним upsert."""
+  now = datetime.utcnow()
+  try:
+    return await db.carts.find_one_and_update(
+      {"user_id": user_id},
+      {"$setOnInsert": {"items": [], "total_amount": 0, "created_at": now, "updated_at": now}},
+      upsert=True,
+      return_document=ReturnDocument.AFTER,
+    )
+  except DuplicateKeyError:
+    # Корзина уже была создана параллельным запросом - получаем её
+    return await db.carts.find_one({"user_id": user_id})
+
+
+async def _mongo_update_cart(db: AsyncIOMotorDatabase, user_id: int, filter_extra: dict, items_expr, now: datetime, session=None) -> dict | None:
+  """Пайплайн-обновление позиций корзины с пересчетом total_amount одним запросом."""
+  cart = await db.carts.find_one_and_update(
+    {"user_id": user_id, **filter_extra},
+    [
+      {
+        "$set": {
+          "items": items_expr,
+          "updated_at": now,
+          "created_at": {"$ifNull": ["$created_at", now]},
+        }
+      },
+      _TOTAL_STAGE,
+    ],
+    upsert=not filter_extra,
+    return_document=ReturnDocument.AFTER,
+    session=session,
+  )
+  if _redis_enabled():
+    # В режиме Redis сюда попадают только при сбое - копия в Redis устарела
+    _detached_carts.add(user_id)
+  return cart
+
+
+async def _run_cart_script(db: AsyncIOMotorDatabase, user_id: int, script: str, *args, prime: bool = True) -> dict | int | bytes | None:
+  """
+  Выполняет Lua-скрипт над корзиной в Redis. Если корзины там нет, загружает
+  её из MongoDB и повторяет скрипт (prime=False - сразу возвращает 0).
+  Возвращает корзину, код скрипта или None, если операцию нужно выполнить
+  в MongoDB (Redis недоступен или корзина не удержалась в нем).
+  """
+  redis = await get_redis()
+  if redis is None:
+    return None
+  keys = [_cart_key(user_id), _DIRTY_CARTS_KEY]
+  argv = [_to_millis(datetime.utcnow()), _cart_ttl_seconds(), user_id, *args]
+  try:
+    await _evict_detached_carts(redis)
+    cart_script = _cart_script(redis, script)
+    result = await cart_script(keys=keys, args=argv)
+    if result == 0 and prime:
+      await _prime_cart(db, user_id)
+      result = await cart_script(keys=keys, args=argv)
+      if result == 0:
+        # Корзина снова пропала из Redis (истек TTL или её вытеснили) - работаем с MongoDB
+        logger.warning(f"Корзина {user_id} пропала из Redis после загрузки, используем MongoDB")
+        return None
+  except Exception as e:
+    report_redis_error(e)
+    logger.warning(f"Ошибка операции с корзиной {user_id} в Redis, используем MongoDB: {e}")
+    return None
+  if isinstance(result, (int, bytes)):
+    return result
+  return _decode_redis_cart(result)
+
+
+async def _prime_cart(db: AsyncIOMotorDatabase, user_id: int) -> dict:
+  doc = await _mongo_load_cart(db, user_id)
+  redis = await get_redis()
+  if redis is None:
+    return doc
+  raw = await _cart_script(redis, _LUA_PRIME)(
+    keys=[_cart_key(user_id), _DIRTY_CARTS_KEY],
+    args=[
+      _to_millis(datetime.utcnow()),
+      _cart_ttl_seconds(),
+      user_id,
+      str(doc["_id"]),
+      _dump_items(doc.get("items") or []),
+      str(doc.get("total_amount") or 0),
+      _to_millis(doc.get("created_at") or datetime.utcnow()),
+      _to_millis(doc.get("updated_at") or datetime.utcnow()),
+    ],
+  )
+  return _decode_redis_cart(raw)
+
+
+async def load_cart(db: AsyncIOMotorDatabase, user_id: int) -> dict:
+  """Возвращает документ корзины пользователя (пустую корзину создает)."""
+  if _redis_enabled():
+    redis = await get_redis()
+    if redis is not None:
+      try:
+        await _evict_detached_carts(redis)
+        raw = await redis.hgetall(_cart_key(user_id))
+        if raw:
+          return _decode_redis_cart(raw)
+        return await _prime_cart(db, user_id)
+      except Exception as e:
+        report_redis_error(e)
+        logger.warning(f"Ошибка чтения корзины {user_id} из Redis, используем MongoDB: {e}")
+  return await _mongo_load_cart(db, user_id)
+
+
+def uses_mongo_transactions() -> bool:
+  """Можно ли менять корзину в одной транзакции MongoDB со складом."""
+  return settings.mongo_transactions and not _redis_enabled()
+
+
+async def add_item(db: AsyncIOMotorDatabase, user_id: int, item: dict, session=None) -> dict:
+  """
+  Добавляет позицию в корзину; если такой товар с той же вариацией уже есть,
+  увеличивает его количество на item["quantity"]. session используется только
+  в режиме MongoDB.
+  """
+  if _redis_enabled():
+    cart = await _run_cart_script(db, user_id, _LUA_ADD_ITEM, _dump_items(item))
+    if cart is not None:
+      return cart
+
+  now = datetime.utcnow()
+  key = {"$literal": [item["product_id"], item.get("variant_id")]}
+  items_expr = {
+    "$let": {
+      "vars": {"items": {"$ifNull": ["$items", []]}},
+      "in": {
+        "$cond": [
+          {"$in": [key, {"$map": {"input": "$$items", "in": ["$$this.product_id", "$$this.variant_id"]}}]},
+          {
+            "$map": {
+              "input": "$$items",
+              "in": {
+                "$cond": [
+                  {"$eq": [["$$this.product_id", "$$this.variant_id"], key]},
+                  {"$mergeObjects": ["$$this", {"quantity": {"$add": ["$$this.quantity", item["quantity"]]}}]},
+                  "$$this",
+                ]
+              },
+            }
+          },
+          {"$concatArrays": ["$$items", [{"$literal": item}]]},
+        ]
+      },
+    }
+  }
+  try:
+    return await _mongo_update_cart(db, user_id, {}, items_expr, now, session=session)
+  except DuplicateKeyError:
+    if session is not None:
+      # Внутри транзакции повтор невозможен - транзакция будет прервана целиком
+      raise
+    # Параллельный upsert создал корзину - повторяем как обычное обновление
+    return await _mongo_update_cart(db, user_id, {}, items_expr, now)
+
+
+async def set_item_quantity(db: AsyncIOMotorDatabase, user_id: int, item_id: str, quantity: int) -> dict | None:
+  """Меняет количество позиции; None - позиции нет в корзине."""
+  if _redis_enabled():
+    cart = await _run_cart_script(db, user_id, _LUA_SET_QUANTITY, item_id, quantity)
+    if cart == 1:
+      return None
+    if cart is not None:
+      return cart
+
+  items_expr = {
+    "$map": {
+      "input": "$items",
+      "in": {
+        "$cond": [
+          {"$eq": ["$$this.id", {"$literal": item_id}]},
+          {"$mergeObjects": ["$$this", {"quantity": quantity}]},
+          "$$this",
+        ]
+      },
+    }
+  }
+  return await _mongo_update_cart(db, user_id, {"items.id": item_id}, items_expr, datetime.utcnow())
+
+
+async def remove_item(db: AsyncIOMotorDatabase, user_id: int, item_id: str) -> dict | None:
+  """Удаляет позицию; None - позиции нет в корзине."""
+  if _redis_enabled():
+    cart = await _run_cart_script(db, user_id, _LUA_REMOVE_ITEM, item_id)
+    if cart == 1:
+      return None
+    if cart is not None:
+      return cart
+
+  items_expr = {
+    "$filter": {
+      "input": "$items",
+      "cond": {"$ne": ["$$this.id", {"$literal": item_id}]},
+    }
+  }
+  return await _mongo_update_cart(db, user_id, {"items.id": item_id}, items_expr, datetime.utcnow())
+
+
+async def replace_items(db: AsyncIOMotorDatabase, user_id: int, items: List[dict], expected_updated_at: datetime) -> dict | None:
+  """
+  Записывает позиции корзины целиком, если корзина не менялась с момента
+  чтения (updated_at совпадает с expected_updated_at). None - корзина
+  изменилась или удалена, её нужно перечитать.
+  """
+  if _redis_enabled():
+    cart = await _run_cart_script(db, user_id, _LUA_REPLACE_ITEMS, _dump_items(items), _to_millis(expected_updated_at))
+    if cart == 1:
+      return None
+    if cart is not None:
+      return cart
+
+  return await _mongo_update_cart(
+    db,
+    user_id,
+    {"updated_at": expected_updated_at},
+    {"$literal": items},
+    datetime.utcnow(),
+  )
+
+
+async def clear_items(db: AsyncIOMotorDatabase, user_id: int) -> dict:
+  """Убирает из корзины все позиции."""
+  if _redis_enabled():
+    cart = await _run_cart_script(db, user_id, _LUA_CLEAR)
+    if cart is not None:
+      return cart
+  return await _mongo_update_cart(db, user_id, {}, {"$literal": []}, datetime.utcnow())
+
+
+async def delete_cart(db: AsyncIOMotorDatabase, user_id: int) -> None:
+  """
+  Удаляет корзину (например, после оформления заказа). В Redis корзина
+  очищается, а не удаляется: так сброс, начатый до удаления, не сможет
+  вернуть старые позиции - следующий сброс запишет пустую корзину.
+  """
+  cleared = None
+  if _redis_enabled():
+    cleared = await _run_cart_script(db, user_id, _LUA_CLEAR, prime=False)
+  await db.carts.delete_one({"user_id": user_id})
+  if _redis_enabled() and cleared is None:
+    _detached_carts.add(user_id)
+
+
+async def expire_cart(db: AsyncIOMotorDatabase, user_id: int, cutoff: datetime) -> List[dict] | None:
+  """
+  Очищает корзину, если она не менялась после cutoff, и возвращает её
+  прежние позиции (их нужно вернуть на склад). Проверка и очистка
+  атомарны, поэтому параллельное изменение корзины не теряется.
+  None - корзина обновлялась позже cutoff; пустой список - корзины нет.
+  """
+  if _redis_enabled():
+    result = await _run_cart_script(db, user_id, _LUA_EXPIRE, _to_millis(cutoff), prime=False)
+    if result == 1:
+      return None
+    if isinstance(result, bytes):
+      items = orjson.loads(result)
+      return items if isinstance(items, list) else []
+    # Корзины нет в Redis (или Redis недоступен) - актуальная копия в MongoDB
+
+  doc = await db.carts.find_one_and_delete({"user_id": user_id, "updated_at": {"$lte": cutoff}})
+  if doc is not None and _redis_enabled() and result is None:
+    _detached_carts.add(user_id)
+  if doc is not None:
+    return doc.get("items") or []
+  if await db.carts.count_documents({"user_id": user_id}, limit=1):
+    return None
+  return []
+
+
+async def flush_dirty_carts(db: AsyncIOMotorDatabase) -> int:
+  """Записывает измененные в Redis корзины в db.carts одним bulk_write на пачку."""
+  redis = await get_redis()
+  if redis is None:
+    return 0
+  await _evict_detached_carts(redis)
+  flushed = 0
+  while True:
+    user_ids = await redis.spop(_DIRTY_CARTS_KEY, _FLUSH_BATCH_SIZE)
+    if not user_ids:
+      return flushed
+    try:
+      pipe = redis.pipeline(transaction=False)
+      for user_id in user_ids:
+        pipe.hgetall(_cart_key(int(user_id)))
+      raw_carts = await pipe.execute()
+      operations = []
+      operation_users = []
+      for user_id, raw in zip(user_ids, raw_carts):
+        if not raw:
+          continue
+        cart = _decode_redis_cart(raw)
+        # Копия в MongoDB могла оказаться новее снимка (запись в обход Redis
+        # во время сбоя или параллельный сброс) - тогда upsert упирается
+        # в уникальный user_id и снимок не перезаписывает её
+        operations.append(
+          UpdateOne(
+            {"user_id": cart["user_id"], "updated_at": {"$lt": cart["updated_at"]}},
+            {
+              "$set": {
+                "items": cart["items"],
+                "total_amount": cart["total_amount"],
+                "updated_at": cart["updated_at"],
+              },
+              "$setOnInsert": {"_id": cart["_id"], "created_at": cart["created_at"]},
+            },
+            upsert=True,
+          )
+        )
+        operation_users.append(user_id)
+      skipped = 0
+      if operations:
+        try:
+          await db.carts.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+          write_errors = e.details.get("writeErrors", [])
+          failed = [error for error in write_errors if error.get("code") != 11000]
+          if failed:
+            # Остальные операции пачки применены - в очередь возвращаем только упавшие
+            await redis.sadd(_DIRTY_CARTS_KEY, *(operation_users[error["index"]] for error in failed))
+            logger.warning(f"Не удалось сбросить {len(failed)} корзин в MongoDB: {failed[0].get('errmsg')}")
+          skipped = len(write_errors)
+      flushed += len(operations) - skipped
+    except Exception:
+      # Возвращаем корзины в очередь, чтобы не потерять изменения
+      await redis.sadd(_DIRTY_CARTS_KEY, *user_ids)
+      raise
+    if len(user_ids) < _FLUSH_BATCH_SIZE:
+      return flushed
+
+
+async def run_cart_flusher() -> None:
+  """Фоновая задача write-behind: периодически сбрасывает корзины из Redis в MongoDB."""
+  from .database import get_db
+
+  while True:
+    await asyncio.sleep(settings.cart_flush_interval_seconds)
+    try:
+      await flush_dirty_carts(await get_db())
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      report_redis_error(e)
+      logger.warning(f"Ошибка сброса корзин в MongoDB: {e}")
@@ -0,0 +1,277 @@
+"""
+Индекс каталога в памяти процесса.
+
+Категории и товары хранятся по id, поэтому мутации из админки обновляют
+только затронутую запись, а не перечитывают обе коллекции из MongoDB.
+"""
+
+from collections import deque
+from hashlib import blake2b
+from bisect import bisect_right
+from typing import Deque, Dict, Iterable, List, Set, Tuple
+
+# Используем orjson если доступен, иначе fallback на ujson
+try:
+  import orjson
+  HAS_ORJSON = True
+except ImportError:
+  import ujson as orjson
+  HAS_ORJSON = False
+
+from .schemas import CatalogResponse, Category, Product
+from .search_index import ProductSearchIndex
+
+_ETAG_MODULUS = 1 << 128
+
+
+def _content_hash(kind: str, model) -> int:
+  """
+  128-битный хеш содержимого одной записи каталога.
+  Хешируются значения полей модели (__dict__) без вызова .dict().
+  """
+  if HAS_ORJSON:
+    serialized = orjson.dumps(model.__dict__, option=orjson.OPT_SORT_KEYS, default=str)
+  else:
+    serialized = orjson.dumps(model.__dict__, sort_keys=True, default=str).encode("utf-8")
+  digest = blake2b(serialized, digest_size=16, person=kind.encode("utf-8"))
+  return int.from_bytes(digest.digest(), "big")
+
+
+class CatalogIndex:
+  def __init__(
+    self,
+    categories: Iterable[Category],
+    products: Iterable[Product],
+    *,
+    only_available: bool = True,
+  ):
+    self.only_available = only_available
+    self.categories: Dict[str, Category] = {}
+    self.products: Dict[str, Product] = {}
+    # Хеши записей и их сумма по модулю 2^128: ETag не зависит от порядка
+    # записей и пересчитывается за O(1) при изменении одной из них
+    self._category_hashes: Dict[str, int] = {}
+    self._product_hashes: Dict[str, int] = {}
+    self._digest = 0
+    # Товары по category_id и сумма их хешей - для ETag отдельной категории
+    self._products_by_category: Dict[str, Dict[str, Product]] = {}
+    self._category_digests: Dict[str, int] = {}
+    # Отсортированные id товаров для курсорной пагинации (None - пересобрать)
+    self._sorted_product_ids: List[str] | None = None
+    self._sorted_category_product_ids: Dict[str, List[str]] = {}
+    for category in categories:
+      self._put_category(category)
+    for product in products:
+      self._put_product(product)
+    self._response: CatalogResponse | None = None
+    # id, затронутые мутациями с последнего take_changes()
+    self._changed_categories: Set[str] = set()
+    self._changed_products: Set[str] = set()
+    # Счетчик мутаций: по нему проверяется, что поисковый индекс,
+    # построенный по снимку товаров, все еще соответствует каталогу
+    self.generation = 0
+    # Поисковый индекс строится лениво (см. routers/catalog.py) и дальше
+    # поддерживается точечно вместе с товарами
+    self.search_index: ProductSearchIndex | None = None
+
+  @classmethod
+  def from_response(cls, payload: CatalogResponse, *, only_available: bool = True) -> "CatalogIndex":
+    return cls(payload.categories, payload.products, only_available=only_available)
+
+  @property
+  def etag(self) -> str:
+    return f"{self._digest:032x}"
+
+  def _put_category(self, category: Category) -> None:
+    content_hash = _content_hash("category", category)
+    self._digest = (self._digest - self._category_hashes.get(category.id, 0) + content_hash) % _ETAG_MODULUS
+    self._category_hashes[category.id] = content_hash
+    self.categories[category.id] = category
+
+  def _pop_category(self, category_id: str) -> None:
+    self.categories.pop(category_id, None)
+    self._digest = (self._digest - self._category_hashes.pop(category_id, 0)) % _ETAG_MODULUS
+
+  def _put_product(self, product: Product) -> None:
+    previous = self.products.get(product.id)
+    if previous is not None and previous.category_id != product.category_id:
+      # Товар переехал в другую категорию - убираем его из старой группы
+      self._pop_product(product.id)
+    content_hash = _content_hash("product", product)
+    previous_hash = self._product_hashes.get(product.id, 0)
+    self._digest = (self._digest - previous_hash + content_hash) % _ETAG_MODULUS
+    self._category_digests[product.category_id] = (
+      self._category_digests.get(product.category_id, 0) - previous_hash + content_hash
+    ) % _ETAG_MODULUS
+    self._product_hashes[product.id] = content_hash
+    if product.id not in self.products:
+      self._sorted_product_ids = None
+      self._sorted_category_product_ids.pop(product.category_id, None)
+    self.products[product.id] = product
+    self._products_by_category.setdefault(product.category_id, {})[product.id] = product
+
+  def _pop_product(self, product_id: str) -> bool:
+    product = self.products.pop(product_id, None)
+    content_hash = self._product_hashes.pop(product_id, 0)
+    self._digest = (self._digest - content_hash) % _ETAG_MODULUS
+    if product is None:
+      return False
+    category_id = product.category_id
+    self._category_digests[category_id] = (self._category_digests.get(category_id, 0) - content_hash) % _ETAG_MODULUS
+    group = self._products_by_category.get(category_id)
+    if group is not None:
+      group.pop(product_id, None)
+      if not group:
+        del self._products_by_category[category_id]
+        self._category_digests.pop(category_id, None)
+    self._sorted_product_ids = None
+    self._sorted_category_product_ids.pop(category_id, None)
+    return True
+
+  def category_products(self, category_id: str) -> List[Product]:
+    return list(self._products_by_category.get(category_id, {}).values())
+
+  def category_etag(self, category_id: str) -> str | None:
+    """ETag категории: меняется только при изменении самой категории или её товаров."""
+    category_hash = self._category_hashes.get(category_id)
+    if category_hash is None:
+      return None
+    digest = (category_hash + self._category_digests.get(category_id, 0)) % _ETAG_MODULUS
+    return f"{digest:032x}"
+
+  def page_products(
+    self,
+    cursor: str | None,
+    limit: int,
+    category_id: str | None = None,
+  ) -> Tuple[List[Product], str | None]:
+    """
+    Страница товаров по возрастанию id, начиная после cursor.
+    Возвращает товары и курсор следующей страницы (None - страниц больше нет).
+    """
+    if category_id is None:
+      if self._sorted_product_ids is None:
+        self._sorted_product_ids = sorted(self.products)
+      product_ids = self._sorted_product_ids
+    else:
+      product_ids = self._sorted_category_product_ids.get(category_id)
+      if product_ids is None:
+        product_ids = sorted(self._products_by_category.get(category_id, {}))
+        self._sorted_category_product_ids[category_id] = product_ids
+    start = bisect_right(product_ids, cursor) if cursor else 0
+    page_ids = product_ids[start:start + limit]
+    next_cursor = page_ids[-1] if start + limit < len(product_ids) else None
+    return [self.products[product_id] for product_id in page_ids], next_cursor
+
+  def products_etag(self, products: Iterable[Product], next_cursor: str | None = None) -> str:
+    """ETag для страницы пагинации: товары по порядку и курсор следующей страницы."""
+    digest = blake2b(digest_size=16, person=b"page")
+    for product in products:
+      digest.update(self._product_hashes.get(product.id, 0).to_bytes(16, "big"))
+    digest.update((next_cursor or "").encode("utf-8"))
+    return digest.hexdigest()
+
+  def to_response(self) -> CatalogResponse:
+    """Собирает CatalogResponse; результат переиспользуется до следующей мутации."""
+    if self._response is None:
+      self._response = CatalogResponse.construct(
+        categories=list(self.categories.values()),
+        products=list(self.products.values()),
+      )
+    return self._response
+
+  def take_changes(self) -> Tuple[Set[str], Set[str]]:
+    """Возвращает и сбрасывает id (категорий, товаров), затронутых мутациями."""
+    changes = (self._changed_categories, self._changed_products)
+    self._changed_categories = set()
+    self._changed_products = set()
+    return changes
+
+  def upsert_category(self, category: Category) -> None:
+    self._put_category(category)
+    self._changed_categories.add(category.id)
+    self._response = None
+
+  def remove_category(self, category_id: str) -> None:
+    """Удаляет категорию вместе с её товарами (как delete_category в БД)."""
+    self._pop_category(category_id)
+    self._changed_categories.add(category_id)
+    orphan_ids = list(self._products_by_category.get(category_id, {}))
+    for product_id in orphan_ids:
+      self._pop_product(product_id)
+      if self.search_index is not None:
+        self.search_index.remove(product_id)
+    self._changed_products.update(orphan_ids)
+    self.generation += 1
+    self._response = None
+
+  def upsert_product(self, product: Product) -> None:
+    if self.only_available and not product.available:
+      # Публичный индекс хранит только доступные товары
+      self.remove_product(product.id)
+      return
+    self._put_product(product)
+    if self.search_index is not None:
+      self.search_index.add(product)
+    self._changed_products.add(product.id)
+    self.generation += 1
+    self._response = None
+
+  def remove_product(self, product_id: str) -> None:
+    self._changed_products.add(product_id)
+    if self._pop_product(product_id):
+      if self.search_index is not None:
+        self.search_index.remove(product_id)
+      self.generation += 1
+      self._response = None
+
+
+class CatalogChangeLog:
+  """
+  Ограниченный журнал изменений каталога по версиям.
+
+  Каждая запись связывает новую версию с предыдущей и хранит id
+  затронутых категорий и товаров. Дельта строится проходом по цепочке
+  от запрошенной версии к предыдущим; запись без предыдущей версии
+  (полная перезагрузка) обрывает цепочку.
+  """
+
+  def __init__(self, maxlen: int = 1000):
+    self._maxlen = max(1, maxlen)
+    self._order: Deque[str] = deque()
+    self._entries: Dict[str, Tuple[str | None, Set[str], Set[str]]] = {}
+
+  def record(
+    self,
+    version: str,
+    previous_version: str | None,
+    categories: Iterable[str] = (),
+    products: Iterable[str] = (),
+  ) -> None:
+    if version in self._entries:
+      return
+    self._entries[version] = (previous_version, set(categories), set(products))
+    self._order.append(version)
+    while len(self._order) > self._maxlen:
+      self._entries.pop(self._order.popleft(), None)
+
+  def changes_between(self, since: str, until: str) -> Tuple[Set[str], Set[str]] | None:
+    """
+    Возвращает id (категорий, товаров), измененных после версии since
+    до версии until включительно, или None, если цепочка версий между
+    ними не сохранилась в журнале.
+    """
+    categories: Set[str] = set()
+    products: Set[str] = set()
+    version: str | None = until
+    # Цепочка не длиннее журнала, поэтому цикл ограничен maxlen шагами
+    for _ in range(len(self._order) + 1):
+      if version == since:
+        return categories, products
+      entry = self._entries.get(version) if version is not None else None
+      if entry is None:
+        return None
+      version, changed_categories, changed_products = entry
+      categories.update(changed_categories)
+      products.update(changed_products)
+    return None
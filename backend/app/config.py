@@ -13,6 +13,12 @@ ENV_PATH = ROOT_DIR / ".env"
 class Settings(BaseSettings):
   mongo_uri: str = Field("mongodb://localhost:27017", env="MONGO_URI")
   mongo_db: str = Field("miniapp", env="MONGO_DB")
+  mongo_connect_timeout_seconds: float = Field(10.0, env="MONGO_CONNECT_TIMEOUT_SECONDS")  # Сколько ждать ping при подключении
+  mongo_ping_timeout_seconds: float = Field(3.0, env="MONGO_PING_TIMEOUT_SECONDS")  # Таймаут проверочного ping уже открытого соединения
+  mongo_transactions: bool = Field(False, env="MONGO_TRANSACTIONS")  # Использовать транзакции (нужен replica set) для списания товара вместе с записью в корзину
+  mongo_heartbeat_seconds: float = Field(5.0, env="MONGO_HEARTBEAT_SECONDS")  # Интервал проверки соединения
+  mongo_heartbeat_failures: int = Field(3, env="MONGO_HEARTBEAT_FAILURES")  # Сколько неудачных ping подряд считается разрывом соединения
+  mongo_retry_max_seconds: float = Field(30.0, env="MONGO_RETRY_MAX_SECONDS")  # Максимальная пауза между попытками переподключения
   redis_url: str = Field("redis://localhost:6379/0", env="REDIS_URL")
   api_prefix: str = "/api"
   admin_ids: List[int] = Field(default_factory=list, env="ADMIN_IDS")
@@ -33,6 +39,14 @@ class Settings(BaseSettings):
   default_dev_user_id: int | None = Field(1, env="DEFAULT_DEV_USER_ID")
   enforce_telegram_signature: bool = Field(False, env="ENFORCE_TELEGRAM_SIGNATURE")
   catalog_cache_ttl_seconds: int = Field(600, env="CATALOG_CACHE_TTL_SECONDS")  # 10 минут для максимальной производительности
+  catalog_cache_hard_stale_seconds: int = Field(300, env="CATALOG_CACHE_HARD_STALE_SECONDS")  # Сколько после TTL можно отдавать устаревший каталог, обновляя его в фоне (0 - выключено)
+  catalog_version_poll_seconds: float = Field(30.0, env="CATALOG_VERSION_POLL_SECONDS")  # Проверка версии каталога в MongoDB на случай потерянной публикации в Redis
+  catalog_change_log_size: int = Field(1000, env="CATALOG_CHANGE_LOG_SIZE")  # Сколько версий хранит журнал для /catalog/changes
+  products_bulk_max_operations: int = Field(5000, env="PRODUCTS_BULK_MAX_OPERATIONS")  # Лимит операций в одном POST /admin/products/bulk
+  cart_store: str = Field("mongo", env="CART_STORE")  # Где хранятся живые корзины: mongo или redis (с записью в MongoDB в фоне)
+  cart_flush_interval_seconds: float = Field(1.0, env="CART_FLUSH_INTERVAL_SECONDS")  # Интервал сброса корзин из Redis в MongoDB
+  cart_sweep_interval_seconds: float = Field(60.0, env="CART_SWEEP_INTERVAL_SECONDS")  # Как часто освобождать товар из просроченных корзин
+  cart_batch_max_operations: int = Field(100, env="CART_BATCH_MAX_OPERATIONS")  # Лимит операций в одном POST /cart/batch
   broadcast_batch_size: int = Field(25, env="BROADCAST_BATCH_SIZE")
   broadcast_concurrency: int = Field(10, env="BROADCAST_CONCURRENCY")
   environment: str = Field("development", env="ENVIRONMENT")
@@ -1,4 +1,8 @@
+import asyncio
 import logging
+from datetime import datetime
+
+from fastapi import HTTPException, status
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 from pymongo import ASCENDING, DESCENDING
 
@@ -10,68 +14,177 @@ client: AsyncIOMotorClient | None = None
 db: AsyncIOMotorDatabase | None = None
 _indexes_initialized = False
 
+# Состояние подключения: disconnected -> connecting -> connected -> (разрыв) disconnected.
+# Переходами управляет только фоновая задача _supervise_mongo_connection,
+# запросы лишь читают состояние и не ждут переподключения.
+_STATE_DISCONNECTED = "disconnected"
+_STATE_CONNECTING = "connecting"
+_STATE_CONNECTED = "connected"
 
-async def connect_to_mongo():
-  """Подключается к MongoDB. Вызывается лениво при первом использовании."""
+_connection_state = _STATE_DISCONNECTED
+_connection_error: str | None = None
+_connected_since: datetime | None = None
+_supervisor_task: asyncio.Task | None = None
+_first_attempt_done: asyncio.Event | None = None
+
+_RETRY_BASE_DELAY_SECONDS = 1.0
+
+
+def _create_client() -> AsyncIOMotorClient:
+  # Оптимизация connection pool для быстрой работы с увеличенными таймаутами для Atlas
+  # Определяем, нужен ли SSL (если URI содержит mongodb.net или ssl=true)
+  use_ssl = "mongodb.net" in settings.mongo_uri or "ssl=true" in settings.mongo_uri.lower()
+
+  client_config = {
+    "serverSelectionTimeoutMS": 30000,  # Увеличено до 30 секунд для SSL handshake
+    "maxPoolSize": 50,  # Больше соединений для параллельных запросов
+    "minPoolSize": 10,  # Минимум соединений всегда готовы
+    "maxIdleTimeMS": 45000,  # Время жизни неактивных соединений
+    "connectTimeoutMS": 20000,  # Увеличено до 20 секунд для SSL handshake
+    "socketTimeoutMS": 60000,  # Увеличено до 60 секунд для операций чтения
+    "retryWrites": True,  # Автоматические повторы записи
+    "retryReads": True,  # Автоматические повторы чтения
+    "heartbeatFrequencyMS": 10000,  # Проверка соединения каждые 10 секунд
+    "waitQueueTimeoutMS": 30000,  # Таймаут ожидания в очереди соединений
+  }
+
+  # Для MongoDB Atlas явно включаем SSL
+  if use_ssl:
+    client_config["ssl"] = True
+
+  return AsyncIOMotorClient(settings.mongo_uri, **client_config)
+
+
+async def _ping(timeout: float) -> None:
+  # Ограничиваем ожидание сами: serverSelectionTimeoutMS рассчитан на медленный
+  # SSL handshake и слишком велик, чтобы по нему определять разрыв соединения
+  await asyncio.wait_for(client.admin.command("ping"), timeout=timeout)
+
+
+def _set_state(state: str, error: str | None = None) -> None:
+  global _connection_state, _connection_error, _connected_since
+  if state == _STATE_CONNECTED and _connection_state != _STATE_CONNECTED:
+    _connected_since = datetime.utcnow()
+  elif state != _STATE_CONNECTED:
+    _connected_since = None
+  _connection_state = state
+  _connection_error = error
+
+
+async def _connect_once() -> bool:
+  """Одна попытка подключения: клиент, ping, затем индексы."""
   global client, db
   if client is None:
+    client = _create_client()
+    db = client[settings.mongo_db]
+  _set_state(_STATE_CONNECTING, _connection_error)
+  await _ping(settings.mongo_connect_timeout_seconds)
+  await ensure_indexes(db)
+  _set_state(_STATE_CONNECTED)
+  logger.info(f"Connected to MongoDB at {settings.mongo_uri}")
+  return True
+
+
+async def _supervise_mongo_connection() -> None:
+  """
+  Фоновая задача: подключается с экспоненциальной задержкой между попытками,
+  а после подключения периодически проверяет соединение ping-ом.
+  """
+  failures = 0
+  heartbeat_failures = 0
+  while True:
     try:
-      # Оптимизация connection pool для быстрой работы с увеличенными таймаутами для Atlas
-      # Определяем, нужен ли SSL (если URI содержит mongodb.net или ssl=true)
-      use_ssl = "mongodb.net" in settings.mongo_uri or "ssl=true" in settings.mongo_uri.lower()
-      
-      client_config = {
-        "serverSelectionTimeoutMS": 30000,  # Увеличено до 30 секунд для SSL handshake
-        "maxPoolSize": 50,  # Больше соединений для параллельных запросов
-        "minPoolSize": 10,  # Минимум соединений всегда готовы
-        "maxIdleTimeMS": 45000,  # Время жизни неактивных соединений
-        "connectTimeoutMS": 20000,  # Увеличено до 20 секунд для SSL handshake
-        "socketTimeoutMS": 60000,  # Увеличено до 60 секунд для операций чтения
-        "retryWrites": True,  # Автоматические повторы записи
-        "retryReads": True,  # Автоматические повторы чтения
-        "heartbeatFrequencyMS": 10000,  # Проверка соединения каждые 10 секунд
-        "waitQueueTimeoutMS": 30000,  # Таймаут ожидания в очереди соединений
-      }
-      
-      # Для MongoDB Atlas явно включаем SSL
-      if use_ssl:
-        client_config["ssl"] = True
-      
-      client = AsyncIOMotorClient(settings.mongo_uri, **client_config)
-      db = client[settings.mongo_db]
-      await ensure_indexes(db)
-      # Проверяем подключение
-      await client.admin.command('ping')
-      logger.info(f"Connected to MongoDB at {settings.mongo_uri}")
+      if _connection_state == _STATE_CONNECTED:
+        await asyncio.sleep(settings.mongo_heartbeat_seconds)
+        try:
+          await _ping(settings.mongo_ping_timeout_seconds)
+        except asyncio.CancelledError:
+          raise
+        except Exception as e:
+          # Одиночный медленный ping не считается разрывом: иначе /ready
+          # снимает воркер с балансировки из-за кратковременной задержки
+          heartbeat_failures += 1
+          if heartbeat_failures < settings.mongo_heartbeat_failures:
+            logger.warning(f"MongoDB heartbeat failed ({heartbeat_failures}/{settings.mongo_heartbeat_failures}): {e}")
+            continue
+          raise
+        heartbeat_failures = 0
+        continue
+      await _connect_once()
+      failures = 0
+      _first_attempt_done.set()
+    except asyncio.CancelledError:
+      raise
     except Exception as e:
-      logger.error(f"Failed to connect to MongoDB: {e}")
-      logger.error("Server will start but database operations will fail. Please start MongoDB.")
-      # Не пытаемся продолжать инициализацию, оставляем db=None, чтобы приложение могло подняться
-      client = None
-      db = None
-      return
+      failures += 1
+      heartbeat_failures = 0
+      if _connection_state == _STATE_CONNECTED:
+        logger.error(f"Lost connection to MongoDB: {e}")
+      elif failures == 1:
+        logger.error(f"Failed to connect to MongoDB: {e}")
+        logger.error("Server will start but database operations will fail. Please start MongoDB.")
+      _set_state(_STATE_DISCONNECTED, f"{type(e).__name__}: {e}")
+      _first_attempt_done.set()
+      delay = min(settings.mongo_retry_max_seconds, _RETRY_BASE_DELAY_SECONDS * 2 ** (failures - 1))
+      await asyncio.sleep(delay)
 
 
-async def ensure_db_connection():
-  """Убеждается, что подключение к БД установлено."""
-  if client is None:
-    await connect_to_mongo()
+def _ensure_supervisor() -> None:
+  global _supervisor_task, _first_attempt_done
+  if _supervisor_task is None or _supervisor_task.done():
+    _first_attempt_done = asyncio.Event()
+    _supervisor_task = asyncio.create_task(_supervise_mongo_connection())
+
+
+async def connect_to_mongo():
+  """
+  Запускает фоновое подключение к MongoDB и ждет результата первой попытки
+  (не дольше mongo_connect_timeout_seconds). Дальнейшие переподключения
+  выполняются в фоне.
+  """
+  _ensure_supervisor()
+  try:
+    await asyncio.wait_for(_first_attempt_done.wait(), timeout=settings.mongo_connect_timeout_seconds + 1)
+  except asyncio.TimeoutError:
+    pass
 
 
 async def close_mongo_connection():
-  global client
+  global client, db, _supervisor_task
+  if _supervisor_task is not None:
+    _supervisor_task.cancel()
+    _supervisor_task = None
   if client:
     client.close()
     client = None
+    db = None
+  _set_state(_STATE_DISCONNECTED)
+
+
+def get_mongo_state() -> dict:
+  return {
+    "state": _connection_state,
+    "connected_since": _connected_since.isoformat() if _connected_since else None,
+    "last_error": _connection_error,
+  }
+
+
+def is_mongo_ready() -> bool:
+  return _connection_state == _STATE_CONNECTED and db is not None
 
 
 async def get_db() -> AsyncIOMotorDatabase:
-  """Получает подключение к БД, подключаясь при необходимости."""
-  if client is None or db is None:
-    await ensure_db_connection()
-  if db is None:
-    raise RuntimeError("Database is not initialized")
-  return db
+  """
+  Возвращает подключение к БД. Не ждет переподключения: пока соединения
+  нет, сразу отвечает 503, а переподключается фоновая задача.
+  """
+  if is_mongo_ready():
+    return db
+  _ensure_supervisor()
+  raise HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="База данных недоступна. Попробуйте позже.",
+  )
 
 
 async def ensure_indexes(database: AsyncIOMotorDatabase):
@@ -90,6 +203,15 @@ async def ensure_indexes(database: AsyncIOMotorDatabase):
   # Корзины - уникальный индекс для быстрого поиска
   await database.carts.create_index("user_id", unique=True)
   await database.carts.create_index("updated_at")  # Для очистки просроченных корзин
+
+  # Резервы склада под корзины: поиск истекших и upsert позиции
+  await database.reservations.create_index("expires_at")
+  await database.reservations.create_index(
+    [("user_id", ASCENDING), ("product_id", ASCENDING), ("variant_id", ASCENDING)],
+    unique=True,
+  )
+  # Незавершенные возвраты на склад из очищенных корзин
+  await database.stock_releases.create_index("retry_at")
   
   # Заказы - составные индексы для разных запросов
   await database.orders.create_index([("user_id", ASCENDING), ("created_at", DESCENDING)])
@@ -5,15 +5,16 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
 from .config import settings
-from .database import close_mongo_connection, connect_to_mongo
-from .cache import close_redis, get_redis
+from .database import close_mongo_connection, connect_to_mongo, get_mongo_state, is_mongo_ready
+from .cache import close_redis, connect_redis, get_redis_breaker_state
 from .utils import permanently_delete_order_entry
+from . import cart_store, reservations
 from .routers import admin, bot_webhook, cart, catalog, orders, store
 
 app = FastAPI(title="Mini Shop Telegram Backend", version="1.0.0")
 
 from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import StreamingResponse, Response
+from starlette.responses import JSONResponse, StreamingResponse, Response
 from starlette.concurrency import iterate_in_threadpool
 import gzip
 import io
@@ -181,9 +182,15 @@ async def apply_security_and_cache_headers(request, call_next):
   
   # Cache-Control headers для оптимизации
   path = request.url.path
-  if path.startswith("/api/catalog"):
-    # Каталог кэшируется на 10 минут для максимальной производительности
-    response.headers["Cache-Control"] = "public, max-age=600, stale-while-revalidate=120"
+  if path.startswith("/api/catalog/changes"):
+    # Дельта зависит от текущей версии каталога, кешировать её на клиенте нельзя
+    response.headers["Cache-Control"] = "no-cache"
+  elif path.startswith("/api/catalog"):
+    # Каталог кэшируется на 10 минут для максимальной производительности.
+    # Ответы с ETag роутер помечает must-revalidate - их заголовок не перезаписываем,
+    # иначе клиенты 10 минут не проверяют изменения и 304 не используются
+    if "Cache-Control" not in response.headers:
+      response.headers["Cache-Control"] = "public, max-age=600, stale-while-revalidate=120"
     response.headers["Vary"] = "Accept-Encoding"
   elif path.startswith("/api/store/status"):
     # Статус магазина кэшируется на 1 минуту
@@ -197,6 +204,29 @@ async def apply_security_and_cache_headers(request, call_next):
   return response
 
 
+async def _run_startup_migrations():
+  """
+  Выполняет миграции данных, как только супервизор подключится к MongoDB.
+  Сервер стартует и без базы, поэтому до успешного запуска повторяем
+  попытки с экспоненциальной задержкой.
+  """
+  import asyncio
+  from .database import get_db, is_mongo_ready
+  from .migrations import run_migrations
+
+  logger = logging.getLogger(__name__)
+  delay = 1.0
+  while True:
+    if is_mongo_ready():
+      try:
+        await run_migrations(await get_db())
+        return
+      except Exception as e:
+        logger.warning(f"Не удалось выполнить миграции данных, повтор через {delay:.0f} с: {e}")
+    await asyncio.sleep(delay)
+    delay = min(settings.mongo_retry_max_seconds, delay * 2)
+
+
 async def cleanup_deleted_orders():
   """
   Фоновая задача для окончательного удаления заказов,
@@ -265,7 +295,7 @@ async def startup():
   await connect_to_mongo()
   
   # Подключаемся к Redis при старте
-  await get_redis()
+  await connect_redis()
   
   # Запускаем фоновую задачу для очистки удаленных заказов (реже в production)
   import asyncio
@@ -274,6 +304,21 @@ async def startup():
     asyncio.create_task(cleanup_deleted_orders())
   else:
     asyncio.create_task(cleanup_deleted_orders())
+
+  # Подписываемся на изменения каталога от других воркеров
+  asyncio.create_task(catalog.listen_catalog_invalidations())
+  # Страховка подписки: периодически сверяем версию каталога с MongoDB
+  asyncio.create_task(catalog.poll_catalog_version())
+
+  # Приводим category_id товаров к одному типу (миграция идемпотентна и идет онлайн)
+  asyncio.create_task(_run_startup_migrations())
+
+  # Освобождаем товар из брошенных корзин по журналу резервов
+  asyncio.create_task(reservations.run_reservation_sweeper())
+
+  # Корзины в Redis записываются в MongoDB фоновой задачей (write-behind)
+  if settings.cart_store == "redis":
+    asyncio.create_task(cart_store.run_cart_flusher())
   
   # Настраиваем webhook для Telegram Bot API (если указан публичный URL)
   import os
@@ -348,6 +393,14 @@ async def shutdown():
   раньше, чем gzip-стримы успевают закрыться.
   """
   logger = logging.getLogger(__name__)
+  if settings.cart_store == "redis":
+    # Сбрасываем в MongoDB корзины, измененные после последнего прохода фоновой задачи
+    try:
+      from .database import get_db
+      await cart_store.flush_dirty_carts(await get_db())
+    except Exception as e:
+      logger.warning(f"Не удалось сохранить корзины из Redis в MongoDB: {e}")
+
   try:
     await close_mongo_connection()
     logger.info("MongoDB соединение закрыто")
@@ -378,6 +431,19 @@ async def health():
   """Health check endpoint that doesn't require database."""
   return {"status": "ok", "message": "Server is running"}
 
+@app.get("/ready")
+async def ready():
+  """
+  Readiness для балансировщика: 200, только когда есть соединение с MongoDB.
+  Redis не обязателен - без него приложение работает без кэша.
+  """
+  payload = {
+    "status": "ready" if is_mongo_ready() else "not_ready",
+    "mongo": get_mongo_state(),
+    "redis": get_redis_breaker_state(),
+  }
+  return JSONResponse(payload, status_code=200 if is_mongo_ready() else 503)
+
 # SPA fallback - отдаем Next.js для всех не-API маршрутов
 # В production на Railway Next.js работает через FastAPI прокси
 # Next.js standalone server обрабатывает маршруты через rewrites
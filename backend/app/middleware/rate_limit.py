@@ -57,7 +57,7 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         # Пропускаем health check и статические файлы
         path = request.url.path
-        if path in ["/health", "/"] or path.startswith("/assets/") or path.startswith("/uploads/"):
+        if path in ["/health", "/ready", "/"] or path.startswith("/assets/") or path.startswith("/uploads/"):
             return await call_next(request)
         
         # Определяем лимит для endpoint
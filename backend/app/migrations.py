@@ -0,0 +1,129 @@
+"""
+Разовые миграции данных.
+
+Запуск из каталога backend:
+  python -m app.migrations
+
+Миграции идемпотентны и работают онлайн: документы обновляются
+пачками, а каждое обновление применяется, только если поле
+все еще имеет старое значение (параллельные правки из админки не теряются).
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+_BATCH_SIZE = 500
+
+CATEGORY_IDS_MIGRATION = "normalize_product_category_ids"
+
+# Миграции, завершение которых этот процесс видел в коллекции migrations
+_completed_migrations: set[str] = set()
+
+
+def is_migration_completed(name: str) -> bool:
+  """Завершена ли миграция (по данным последнего запуска run_migrations в этом процессе)."""
+  return name in _completed_migrations
+
+
+async def _run_once(db: AsyncIOMotorDatabase, name: str, migration) -> None:
+  """Выполняет миграцию, если она еще не отмечена в коллекции migrations, и отмечает её."""
+  if name not in _completed_migrations:
+    if not await db.migrations.find_one({"_id": name}, {"_id": 1}):
+      await migration(db)
+      await db.migrations.update_one(
+        {"_id": name},
+        {"$setOnInsert": {"completed_at": datetime.utcnow()}},
+        upsert=True,
+      )
+  _completed_migrations.add(name)
+
+
+async def normalize_product_category_ids(
+  db: AsyncIOMotorDatabase,
+  batch_size: int = _BATCH_SIZE,
+) -> int:
+  """
+  Приводит products.category_id к строке (str(ObjectId) категории).
+
+  Старые товары хранили category_id как ObjectId, новые - как строку,
+  из-за чего чтения по категории шли через $in по обоим вариантам.
+  Возвращает число исправленных товаров.
+  """
+  legacy_filter = {"category_id": {"$exists": True, "$nin": [None, ""], "$not": {"$type": "string"}}}
+  migrated = 0
+  while True:
+    docs = await db.products.find(legacy_filter, {"category_id": 1}).limit(batch_size).to_list(length=batch_size)
+    if not docs:
+      break
+    operations = [
+      UpdateOne(
+        {"_id": doc["_id"], "category_id": doc["category_id"]},
+        {"$set": {"category_id": str(doc["category_id"])}},
+      )
+      for doc in docs
+    ]
+    result = await db.products.bulk_write(operations, ordered=False)
+    migrated += result.modified_count
+    if result.modified_count == 0:
+      # Ни одна запись пачки не изменилась - значит, их уже поправили параллельно
+      # или значения не приводятся к строке; не зацикливаемся на них
+      break
+  if migrated:
+    logger.info("Normalized category_id for %s products", migrated)
+  return migrated
+
+
+async def backfill_cart_reservations(
+  db: AsyncIOMotorDatabase,
+  batch_size: int = _BATCH_SIZE,
+) -> int:
+  """
+  Заполняет журнал резервов для непустых корзин, созданных до его появления,
+  чтобы фоновая задача освободила и их товар. Синхронизация не перезаписывает
+  записи более новой версии корзины, поэтому миграцию можно запускать повторно.
+  Возвращает число обработанных корзин.
+  """
+  from .reservations import sync_cart_reservations
+
+  synced = 0
+  last_id = None
+  while True:
+    query = {"items.0": {"$exists": True}}
+    if last_id is not None:
+      query["_id"] = {"$gt": last_id}
+    carts = await db.carts.find(query).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+    if not carts:
+      break
+    await asyncio.gather(*(sync_cart_reservations(db, cart) for cart in carts))
+    synced += len(carts)
+    last_id = carts[-1]["_id"]
+  if synced:
+    logger.info("Backfilled reservations for %s carts", synced)
+  return synced
+
+
+async def run_migrations(db: AsyncIOMotorDatabase) -> None:
+  await _run_once(db, CATEGORY_IDS_MIGRATION, normalize_product_category_ids)
+  await backfill_cart_reservations(db)
+
+
+async def _main() -> None:
+  from .database import close_mongo_connection, connect_to_mongo, get_db
+
+  await connect_to_mongo()
+  db = await get_db()
+  try:
+    await run_migrations(db)
+  finally:
+    await close_mongo_connection()
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  asyncio.run(_main())
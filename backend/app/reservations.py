@@ -0,0 +1,183 @@
+"""
+Журнал резервов склада под корзины.
+
+В коллекции reservations на каждую позицию корзины хранится документ
+(user_id, product_id, variant_id, quantity, expires_at, cart_updated_at).
+Журнал обновляется после каждого изменения корзины, а фоновая задача по
+индексу expires_at находит брошенные корзины, очищает их и возвращает товар
+на склад.
+
+Синхронизации выполняются в фоне и могут завершиться не по порядку, поэтому
+каждая запись помнит updated_at корзины, по которой она построена, и более
+старый снимок не перезаписывает более новый. Позиции, убранные из корзины,
+не удаляются, а обнуляются (quantity = 0), чтобы запоздавший старый снимок
+не вернул их обратно; такие записи удаляет фоновая задача вместе с корзиной.
+
+Позиции очищенной корзины перед возвратом на склад записываются в
+stock_releases, поэтому возврат, прерванный ошибкой, повторяется.
+
+Сама корзина остается источником истины: на склад возвращаются позиции,
+снятые с корзины при очистке, а журнал только подсказывает, какие корзины
+проверить. Поэтому отставание журнала (например, из-за гонки двух
+обновлений) не приводит к потере или двойному возврату товара.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from . import cart_store
+from .cart_store import CART_EXPIRY_MINUTES
+from .config import settings
+from .utils import restore_variant_quantities
+
+logger = logging.getLogger(__name__)
+
+_SWEEP_BATCH_SIZE = 500
+# Через сколько повторять возврат на склад, который не завершился
+_RELEASE_RETRY_SECONDS = 300
+
+
+async def sync_cart_reservations(db: AsyncIOMotorDatabase, cart: dict) -> None:
+  """Приводит резервы пользователя к позициям корзины одним bulk_write."""
+  user_id = cart["user_id"]
+  cart_updated_at = cart.get("updated_at") or datetime.utcnow()
+  expires_at = cart_updated_at + timedelta(minutes=CART_EXPIRY_MINUTES)
+  # Записи, построенные по более новой версии корзины, не трогаем
+  not_newer = {"cart_updated_at": {"$not": {"$gt": cart_updated_at}}}
+  snapshot = {"expires_at": expires_at, "cart_updated_at": cart_updated_at}
+  lines: dict = {}
+  for item in cart.get("items") or []:
+    if not item.get("variant_id"):
+      continue
+    key = (item.get("product_id"), item.get("variant_id"))
+    lines[key] = lines.get(key, 0) + (item.get("quantity") or 0)
+
+  operations = [
+    UpdateOne(
+      {"user_id": user_id, "product_id": product_id, "variant_id": variant_id, **not_newer},
+      {"$set": {"quantity": quantity, **snapshot}},
+      upsert=True,
+    )
+    for (product_id, variant_id), quantity in lines.items()
+  ]
+  # Позиции, которых больше нет в корзине
+  removed_filter = {"user_id": user_id, **not_newer}
+  if lines:
+    removed_filter["$nor"] = [{"product_id": product_id, "variant_id": variant_id} for product_id, variant_id in lines]
+  operations.append(UpdateMany(removed_filter, {"$set": {"quantity": 0, **snapshot}}))
+  try:
+    await db.reservations.bulk_write(operations, ordered=False)
+  except BulkWriteError as e:
+    # Запись с более новой версией корзины уже есть: upsert по старому снимку
+    # упирается в уникальный индекс (user_id, product_id, variant_id)
+    if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+      raise
+
+
+def schedule_reservation_sync(db: AsyncIOMotorDatabase, cart: dict) -> None:
+  """Обновляет журнал в фоне, не задерживая ответ на изменение корзины."""
+  async def _sync():
+    try:
+      await sync_cart_reservations(db, cart)
+    except Exception as e:
+      logger.warning(f"Не удалось обновить резервы корзины {cart.get('user_id')}: {e}")
+
+  asyncio.create_task(_sync())
+
+
+async def drop_reservations(db: AsyncIOMotorDatabase, user_id: int) -> None:
+  """Удаляет резервы без возврата на склад (товар ушел в заказ)."""
+  await db.reservations.delete_many({"user_id": user_id})
+
+
+async def _release_cart_items(db: AsyncIOMotorDatabase, user_id: int, items: list) -> None:
+  """
+  Возвращает на склад позиции очищенной корзины. Позиции сначала
+  записываются в stock_releases: корзины уже нет, и если возврат упадет,
+  следующий проход повторит его по этой записи.
+  """
+  release = {
+    "user_id": user_id,
+    "items": items,
+    "retry_at": datetime.utcnow() + timedelta(seconds=_RELEASE_RETRY_SECONDS),
+  }
+  result = await db.stock_releases.insert_one(release)
+  await restore_variant_quantities(db, items)
+  await db.stock_releases.delete_one({"_id": result.inserted_id})
+
+
+async def _retry_stock_releases(db: AsyncIOMotorDatabase, now: datetime) -> int:
+  """Повторяет возвраты на склад, которые не завершились в прошлых проходах."""
+  retried = 0
+  for _ in range(_SWEEP_BATCH_SIZE):
+    # Переносом retry_at запись захватывается, чтобы другой воркер не вернул товар второй раз
+    release = await db.stock_releases.find_one_and_update(
+      {"retry_at": {"$lte": now}},
+      {"$set": {"retry_at": now + timedelta(seconds=_RELEASE_RETRY_SECONDS)}},
+    )
+    if release is None:
+      break
+    await restore_variant_quantities(db, release.get("items") or [])
+    await db.stock_releases.delete_one({"_id": release["_id"]})
+    retried += 1
+  return retried
+
+
+async def release_expired_reservations(db: AsyncIOMotorDatabase) -> int:
+  """
+  Очищает корзины с истекшими резервами и возвращает их товар на склад.
+  Кроме журнала проверяются корзины, давно не менявшиеся по carts.updated_at:
+  так освобождаются и корзины без записей в журнале (фоновая синхронизация
+  не удалась). Возвращает число очищенных корзин.
+  """
+  now = datetime.utcnow()
+  cutoff = now - timedelta(minutes=CART_EXPIRY_MINUTES)
+  await _retry_stock_releases(db, now)
+  expired, stale_carts = await asyncio.gather(
+    db.reservations.find(
+      {"expires_at": {"$lte": now}},
+      {"user_id": 1},
+    ).limit(_SWEEP_BATCH_SIZE).to_list(length=_SWEEP_BATCH_SIZE),
+    db.carts.find(
+      {"updated_at": {"$lte": cutoff}, "items.0": {"$exists": True}},
+      {"user_id": 1},
+    ).limit(_SWEEP_BATCH_SIZE).to_list(length=_SWEEP_BATCH_SIZE),
+  )
+
+  released = 0
+  for user_id in {doc["user_id"] for doc in expired} | {doc["user_id"] for doc in stale_carts}:
+    items = await cart_store.expire_cart(db, user_id, cutoff)
+    if items is None:
+      # Корзина менялась недавно, а журнал отстал - переносим срок
+      await db.reservations.update_many(
+        {"user_id": user_id},
+        {"$set": {"expires_at": now + timedelta(minutes=CART_EXPIRY_MINUTES)}},
+      )
+      continue
+    if items:
+      await _release_cart_items(db, user_id, items)
+      released += 1
+    # Записи новой корзины, созданной уже после очистки, не трогаем
+    await db.reservations.delete_many({"user_id": user_id, "cart_updated_at": {"$not": {"$gt": cutoff}}})
+  return released
+
+
+async def run_reservation_sweeper() -> None:
+  """Фоновая задача: периодически освобождает товар брошенных корзин."""
+  from .database import get_db
+
+  while True:
+    await asyncio.sleep(settings.cart_sweep_interval_seconds)
+    try:
+      released = await release_expired_reservations(await get_db())
+      if released:
+        logger.info(f"Освобождены резервы {released} просроченных корзин")
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      logger.warning(f"Ошибка освобождения просроченных резервов: {e}")
@@ -8,6 +8,7 @@ from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo.errors import ServerSelectionTimeoutError, ConnectionFailure
 
+from ..cache import get_cache_stats, get_redis_breaker_state, reset_cache_stats
 from ..database import get_db
 from ..schemas import (
   BroadcastRequest,
@@ -20,7 +21,7 @@ from ..schemas import (
 from ..utils import (
   as_object_id,
   serialize_doc,
-  restore_variant_quantity,
+  restore_variant_quantities,
   mark_order_as_deleted,
   restore_order_entry,
   get_gridfs,
@@ -42,39 +43,39 @@ async def list_orders(
   _admin_id: int = Depends(verify_admin),
 ):
   # Оптимизированное построение запроса
-    query = {}
-    if status_filter:
+  query = {}
+  if status_filter:
     query["status"] = {"$in": [OrderStatus.PROCESSING.value, OrderStatus.NEW.value]} if status_filter == OrderStatus.PROCESSING else status_filter.value
-    if not include_deleted:
-      query["deleted_at"] = {"$exists": False}
-    if cursor:
-      try:
-        query["_id"] = {"$lt": as_object_id(cursor)}
-      except ValueError:
-        raise HTTPException(status_code=400, detail="Некорректный cursor")
-
-    # Используем индекс для быстрой сортировки
-    docs = await (
-      db.orders.find(query)
-      .sort("_id", -1)
+  if not include_deleted:
+    query["deleted_at"] = {"$exists": False}
+  if cursor:
+    try:
+      query["_id"] = {"$lt": as_object_id(cursor)}
+    except ValueError:
+      raise HTTPException(status_code=400, detail="Некорректный cursor")
+
+  # Используем индекс для быстрой сортировки
+  docs = await (
+    db.orders.find(query)
+    .sort("_id", -1)
     .hint([("status", 1), ("created_at", -1)])
-      .limit(limit + 1)
-      .to_list(length=limit + 1)
-    )
-  
+    .limit(limit + 1)
+    .to_list(length=limit + 1)
+  )
+
   # Оптимизированная валидация заказов
-    orders = []
-    for doc in docs:
-      try:
+  orders = []
+  for doc in docs:
+    try:
       orders.append(Order(**serialize_doc(doc) | {"id": str(doc["_id"])}))
     except:
-        continue
+      continue
 
-    next_cursor = None
-    if len(orders) > limit:
+  next_cursor = None
+  if len(orders) > limit:
     next_cursor = orders[limit].id
     orders = orders[:limit]
-    return PaginatedOrdersResponse(orders=orders, next_cursor=next_cursor)
+  return PaginatedOrdersResponse(orders=orders, next_cursor=next_cursor)
 
 
 @router.get("/admin/order/{order_id}", response_model=Order)
@@ -144,15 +145,7 @@ async def update_order_status(
   
   # Если заказ отменяется, возвращаем товары на склад
   if new_status == OrderStatus.CANCELED.value and old_status != OrderStatus.CANCELED.value:
-    items = old_doc.get("items", [])
-    for item in items:
-      if item.get("variant_id"):
-        await restore_variant_quantity(
-          db,
-          item.get("product_id"),
-          item.get("variant_id"),
-          item.get("quantity", 0)
-        )
+    await restore_variant_quantities(db, old_doc.get("items", []))
   
   editable_statuses = {
     OrderStatus.PROCESSING.value,
@@ -410,3 +403,17 @@ async def send_broadcast(
     failed_count=failed_count
   )
 
+
+@router.get("/admin/cache/stats")
+async def get_cache_statistics(
+  reset: bool = Query(False, description="Сбросить счетчики после чтения"),
+  _admin_id: int = Depends(verify_admin),
+):
+  """
+  Счетчики кэша по префиксам ключей (попадания, промахи, ошибки, объемы,
+  задержки Redis) и состояние предохранителя подключения к Redis.
+  """
+  stats = get_cache_stats()
+  if reset:
+    reset_cache_stats()
+  return {"redis": get_redis_breaker_state(), "prefixes": stats}
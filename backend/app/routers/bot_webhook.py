@@ -268,18 +268,10 @@ async def handle_bot_webhook(
             
             # Если заказ отменяется, возвращаем товары на склад
             from datetime import datetime
-            from ..utils import restore_variant_quantity
+            from ..utils import restore_variant_quantities
             
             if new_status_value == OrderStatus.CANCELED.value and current_status != OrderStatus.CANCELED.value:
-                items = doc.get("items", [])
-                for item in items:
-                    if item.get("variant_id"):
-                        await restore_variant_quantity(
-                            db,
-                            item.get("product_id"),
-                            item.get("variant_id"),
-                            item.get("quantity", 0)
-                        )
+                await restore_variant_quantities(db, doc.get("items", []))
             
             # Определяем, можно ли редактировать адрес
             editable_statuses = {
@@ -459,17 +451,9 @@ async def handle_bot_webhook(
             
             # Обновляем статус на "отменён" и возвращаем товары на склад
             from datetime import datetime
-            from ..utils import restore_variant_quantity
+            from ..utils import restore_variant_quantities
             
-            items = doc.get("items", [])
-            for item in items:
-                if item.get("variant_id"):
-                    await restore_variant_quantity(
-                        db,
-                        item.get("product_id"),
-                        item.get("variant_id"),
-                        item.get("quantity", 0)
-                    )
+            await restore_variant_quantities(db, doc.get("items", []))
             
             updated = await db.orders.find_one_and_update(
                 {"_id": as_object_id(order_id)},
@@ -1,24 +1,35 @@
 from uuid import uuid4
-from datetime import datetime, timedelta
+from datetime import datetime
 import asyncio
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo.errors import DuplicateKeyError
 
+from .. import cart_store
+from ..config import settings
 from ..database import get_db
-from ..schemas import AddToCartRequest, Cart, RemoveFromCartRequest, UpdateCartItemRequest
+from ..reservations import schedule_reservation_sync
+from ..schemas import (
+  AddToCartRequest,
+  Cart,
+  CartBatchOp,
+  CartBatchOperation,
+  CartBatchRequest,
+  RemoveFromCartRequest,
+  UpdateCartItemRequest,
+)
 from ..utils import (
   as_object_id,
   decrement_variant_quantity,
+  decrement_variant_quantities,
+  reserve_variant_quantity,
   serialize_doc,
   restore_variant_quantity,
+  restore_variant_quantities,
 )
 from ..security import TelegramUser, get_current_user
 
-# Время жизни корзины в минутах
-CART_EXPIRY_MINUTES = 30
-
 router = APIRouter(tags=["cart"])
 
 def normalize_cart(cart: dict) -> dict:
@@ -48,111 +59,9 @@ def normalize_cart(cart: dict) -> dict:
   return cart
 
 
-async def cleanup_expired_cart(db: AsyncIOMotorDatabase, cart: dict):
-  """Очищает просроченную корзину и возвращает товары на склад"""
-  if not cart or not cart.get("items"):
-    return False
-  
-  updated_at = cart.get("updated_at")
-  if not updated_at:
-    updated_at = cart.get("created_at", datetime.utcnow())
-  
-  # Оптимизированная проверка истечения
-  if not isinstance(updated_at, datetime):
-    if isinstance(updated_at, str):
-      try:
-        updated_at = datetime.fromisoformat(updated_at.replace('Z', '+00:00'))
-      except:
-        updated_at = datetime.utcnow()
-    else:
-        updated_at = datetime.utcnow()
-    expiry_time = updated_at + timedelta(minutes=CART_EXPIRY_MINUTES)
-  
-  if datetime.utcnow() > expiry_time:
-    # Возвращаем все товары на склад
-    for item in cart.get("items", []):
-      if item.get("variant_id"):
-        await restore_variant_quantity(
-          db,
-          item.get("product_id"),
-          item.get("variant_id"),
-          item.get("quantity", 0)
-        )
-    
-    # Удаляем корзину
-    await db.carts.delete_one({"_id": cart["_id"]})
-    return True
-  return False
-
-
-async def get_cart_document(db: AsyncIOMotorDatabase, user_id: int, check_expiry: bool = True):
-  cart = await db.carts.find_one({"user_id": user_id})
-  if not cart:
-    cart = {
-      "user_id": user_id,
-      "items": [],
-      "total_amount": 0,
-      "created_at": datetime.utcnow(),
-      "updated_at": datetime.utcnow(),
-    }
-    try:
-      result = await db.carts.insert_one(cart)
-      cart["_id"] = result.inserted_id
-    except DuplicateKeyError:
-      # Корзина уже была создана параллельным запросом - получаем её
-      cart = await db.carts.find_one({"user_id": user_id})
-      if not cart:
-        # Если всё ещё не найдена (крайне редкий случай), создаём заново
-        cart = {
-          "user_id": user_id,
-          "items": [],
-          "total_amount": 0,
-          "created_at": datetime.utcnow(),
-          "updated_at": datetime.utcnow(),
-        }
-        result = await db.carts.insert_one(cart)
-        cart["_id"] = result.inserted_id
-  elif check_expiry:
-    # Оптимизированная проверка истечения
-    updated_at = cart.get("updated_at") or cart.get("created_at", datetime.utcnow())
-    if not isinstance(updated_at, datetime):
-    if isinstance(updated_at, str):
-      try:
-        updated_at = datetime.fromisoformat(updated_at.replace('Z', '+00:00'))
-      except:
-          updated_at = datetime.utcnow()
-      else:
-        updated_at = datetime.utcnow()
-    
-    if datetime.utcnow() > updated_at + timedelta(minutes=CART_EXPIRY_MINUTES):
-      # Очищаем корзину в фоне, не блокируя ответ
-      asyncio.create_task(cleanup_expired_cart(db, cart))
-      # Создаем новую корзину сразу
-      cart = {
-        "user_id": user_id,
-        "items": [],
-        "total_amount": 0,
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(),
-      }
-      try:
-        result = await db.carts.insert_one(cart)
-        cart["_id"] = result.inserted_id
-      except DuplicateKeyError:
-        # Корзина уже была создана параллельным запросом - получаем её
-        cart = await db.carts.find_one({"user_id": user_id})
-        if not cart:
-          # Если всё ещё не найдена, создаём заново
-          cart = {
-            "user_id": user_id,
-            "items": [],
-            "total_amount": 0,
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow(),
-          }
-          result = await db.carts.insert_one(cart)
-          cart["_id"] = result.inserted_id
-  return cart
+async def get_cart_document(db: AsyncIOMotorDatabase, user_id: int):
+  # Истекшие корзины очищает фоновая задача (см. reservations.py)
+  return await cart_store.load_cart(db, user_id)
 
 
 def recalculate_total(cart):
@@ -168,13 +77,73 @@ async def get_cart(
   current_user: TelegramUser = Depends(get_current_user),
   db: AsyncIOMotorDatabase = Depends(get_db),
 ):
-  # Быстрое получение корзины без блокирующей проверки истечения
   user_id = current_user.id
-  cart = await get_cart_document(db, user_id, check_expiry=True)
+  cart = await get_cart_document(db, user_id)
   safe_cart = normalize_cart(cart)
   return Cart(**serialize_doc(safe_cart) | {"id": str(cart["_id"])})
 
 
+_CART_PRODUCT_PROJECTION = {
+  "name": 1,
+  "price": 1,
+  "image": 1,
+  "variants": 1,
+  "_id": 1,
+}
+
+
+async def _reserve_for_cart(db: AsyncIOMotorDatabase, product_oid, payload: AddToCartRequest, session=None) -> dict:
+  """
+  Списывает товар со склада одним условным обновлением. Товар перечитывается
+  только при неудаче - чтобы объяснить, почему списать не удалось.
+  """
+  product = await reserve_variant_quantity(
+    db,
+    product_oid,
+    payload.variant_id,
+    payload.quantity,
+    projection=_CART_PRODUCT_PROJECTION,
+    session=session,
+  )
+  if product:
+    return product
+
+  product = await db.products.find_one({"_id": product_oid}, _CART_PRODUCT_PROJECTION, session=session)
+  if not product:
+    raise HTTPException(status_code=404, detail="Товар не найден")
+
+  # Вариации обязательны для всех товаров
+  variants = product.get("variants", [])
+  if not variants:
+    raise HTTPException(
+      status_code=400,
+      detail="Товар не может быть продан без вариаций (вкусов). Обратитесь к администратору."
+    )
+
+  variant = next((v for v in variants if v.get("id") == payload.variant_id), None)
+  if not variant:
+    raise HTTPException(status_code=404, detail="Вариация не найдена")
+
+  raise HTTPException(
+    status_code=400,
+    detail=f"Недостаточно товара. В наличии: {variant.get('quantity', 0)}"
+  )
+
+
+def _new_cart_item(product: dict, payload: AddToCartRequest | CartBatchOperation) -> dict:
+  variant = next((v for v in product.get("variants", []) if v.get("id") == payload.variant_id), {})
+  return {
+    "id": uuid4().hex,
+    "product_id": payload.product_id,
+    "variant_id": payload.variant_id,
+    "product_name": product["name"],
+    "variant_name": variant.get("name"),
+    "quantity": payload.quantity,
+    "price": product.get("price", 0),
+    "image": variant.get("image") if variant else product.get("image"),
+  }
+
+
 @router.post("/cart", response_model=Cart)
 async def add_to_cart(
   payload: AddToCartRequest,
@@ -187,165 +156,39 @@ async def add_to_cart(
   except ValueError:
     raise HTTPException(status_code=400, detail="Некорректный идентификатор товара")
 
-  # Получаем товар и корзину параллельно для оптимизации
-  # Для добавления в корзину не нужно проверять истечение (это делается при GET)
-  # Используем проекцию для товара - не загружаем лишние поля
-  product_task = db.products.find_one(
-    {"_id": product_oid},
-    {
-      "name": 1,
-      "price": 1,
-      "image": 1,
-      "variants": 1,
-      "_id": 1,
-    }
-  )
-  cart_task = get_cart_document(db, user_id, check_expiry=False)
-  
-  product, cart = await asyncio.gather(product_task, cart_task)
-  
-  if not product:
-    raise HTTPException(status_code=404, detail="Товар не найден")
-
-  # Вариации обязательны для всех товаров
-  variants = product.get("variants", [])
-  if not variants or len(variants) == 0:
-    raise HTTPException(
-      status_code=400,
-      detail="Товар не может быть продан без вариаций (вкусов). Обратитесь к администратору."
-    )
-  
   # Проверяем, что вариация указана
   if not payload.variant_id:
     raise HTTPException(
       status_code=400,
       detail="Необходимо выбрать вариацию (вкус)"
     )
-  
-  # Проверяем вариацию
-  variant = next((v for v in variants if v.get("id") == payload.variant_id), None)
-  if not variant:
-    raise HTTPException(status_code=404, detail="Вариация не найдена")
-  
-  variant_name = variant.get("name")
-  variant_price = product.get("price", 0)
-  variant_quantity = variant.get("quantity", 0)
-  
-  # Используем атомарные операции MongoDB для обновления корзины и списания товара
+
   now = datetime.utcnow()
-  
-  # Вычисляем изменение total_amount заранее
-  price_delta = variant_price * payload.quantity
-  
-  # Перечитываем корзину для актуальных данных (защита от race conditions)
-  fresh_cart = await db.carts.find_one({"_id": cart["_id"]}, {"items": 1})
-  if not fresh_cart:
-    raise HTTPException(status_code=404, detail="Корзина не найдена")
-  
-  # Оптимизированный поиск существующего товара
-  items = fresh_cart.get("items", [])
-  existing = next(
-    (item for item in items if item.get("product_id") == payload.product_id and item.get("variant_id") == payload.variant_id),
-    None
-  )
-  already_in_cart = existing.get("quantity", 0) if existing else 0
-  total_needed = already_in_cart + payload.quantity
-  
-  # Проверка количества с учетом уже добавленного
-  if variant_quantity < total_needed:
-    can_add = max(0, variant_quantity - already_in_cart)
-    if can_add == 0:
-      raise HTTPException(
-        status_code=400,
-        detail=f"Недостаточно товара. В наличии: {variant_quantity}, уже в корзине: {already_in_cart}"
-      )
-    else:
-      raise HTTPException(
-        status_code=400,
-        detail=f"Недостаточно товара. Доступно для добавления: {can_add}, уже в корзине: {already_in_cart}"
-      )
-  
-  if existing:
-    # Обновляем существующий товар атомарно и списываем товар со склада одновременно
-    # Сначала списываем товар
-    success = await decrement_variant_quantity(
-      db,
-      payload.product_id,
-      payload.variant_id,
-      payload.quantity
-    )
-    if not success:
-      raise HTTPException(
-        status_code=400,
-        detail=f"Недостаточно товара. В наличии: {variant_quantity}"
-      )
-    
-    # Обновляем корзину с пересчетом total_amount в одном запросе
-    # Используем актуальный _id из fresh_cart
-    final_cart = await db.carts.find_one_and_update(
-      {
-        "_id": fresh_cart["_id"],
-        "items": {
-          "$elemMatch": {
-            "product_id": payload.product_id,
-            "variant_id": payload.variant_id
-          }
-        }
-      },
-      {
-        "$inc": {
-          "items.$.quantity": payload.quantity,
-          "total_amount": price_delta
-        },
-        "$set": {"updated_at": now}
-      },
-      return_document=True
-    )
+  if cart_store.uses_mongo_transactions():
+    # Списание и запись в корзину в одной транзакции: при ошибке откатываются оба.
+    # with_transaction сам повторяет транзакцию и коммит при временных ошибках
+    async def add_in_transaction(session):
+      product = await _reserve_for_cart(db, product_oid, payload, session=session)
+      return await cart_store.add_item(db, user_id, _new_cart_item(product, payload), session=session)
+
+    async with await db.client.start_session() as session:
+      try:
+        final_cart = await session.with_transaction(add_in_transaction)
+      except DuplicateKeyError:
+        # Параллельный upsert создал корзину, транзакция откатилась целиком -
+        # повторяем её, теперь upsert найдет корзину и обновит её
+        final_cart = await session.with_transaction(add_in_transaction)
   else:
-    # Добавляем новый товар атомарно
-    new_item = {
-      "id": uuid4().hex,
-      "product_id": payload.product_id,
-      "variant_id": payload.variant_id,
-      "product_name": product["name"],
-      "variant_name": variant_name,
-      "quantity": payload.quantity,
-      "price": variant_price,
-      "image": variant.get("image") if variant else product.get("image"),
-    }
-    
-    # Сначала списываем товар
-    success = await decrement_variant_quantity(
-      db,
-      payload.product_id,
-      payload.variant_id,
-      payload.quantity
-    )
-    if not success:
-      raise HTTPException(
-        status_code=400,
-        detail=f"Недостаточно товара. В наличии: {variant_quantity}"
-      )
-    
-    # Обновляем корзину с пересчетом total_amount в одном запросе
-    # Используем актуальный _id из fresh_cart
-    final_cart = await db.carts.find_one_and_update(
-      {"_id": fresh_cart["_id"]},
-      {
-        "$push": {"items": new_item},
-        "$inc": {"total_amount": price_delta},
-        "$set": {"updated_at": now}
-      },
-      return_document=True
-    )
-  
-  if not final_cart:
-    # Если обновление не удалось, возвращаем товар на склад
-    await restore_variant_quantity(db, payload.product_id, payload.variant_id, payload.quantity)
-    raise HTTPException(status_code=500, detail="Ошибка при обновлении корзины")
-  
-  # Обновление клиента в фоне (fire-and-forget для скорости)
+    product = await _reserve_for_cart(db, product_oid, payload)
     try:
+      final_cart = await cart_store.add_item(db, user_id, _new_cart_item(product, payload))
+    except Exception:
+      # Без транзакций запись в корзину может упасть уже после списания
+      await restore_variant_quantity(db, payload.product_id, payload.variant_id, payload.quantity)
+      raise HTTPException(status_code=500, detail="Ошибка при обновлении корзины")
+
+  # Обновление клиента в фоне (fire-and-forget для скорости)
+  try:
     asyncio.create_task(
       db.customers.update_one(
         {"telegram_id": user_id},
@@ -355,7 +198,8 @@ async def add_to_cart(
     )
   except:
     pass  # Игнорируем ошибки
-  
+
+  schedule_reservation_sync(db, final_cart)
   safe_cart = normalize_cart(final_cart)
   return Cart(**serialize_doc(safe_cart) | {"id": str(final_cart["_id"])})
 
@@ -366,7 +210,7 @@ async def update_cart_item(
   db: AsyncIOMotorDatabase = Depends(get_db),
   current_user: TelegramUser = Depends(get_current_user),
 ):
-  cart = await get_cart_document(db, current_user.id, check_expiry=False)
+  cart = await get_cart_document(db, current_user.id)
   item = next((item for item in cart["items"] if item.get("id") == payload.item_id), None)
   if not item:
     raise HTTPException(status_code=404, detail="Товар не найден в корзине")
@@ -396,10 +240,13 @@ async def update_cart_item(
     except:
       pass  # Игнорируем остальные ошибки
   
-  item["quantity"] = payload.quantity
-  cart["updated_at"] = datetime.utcnow()
-  cart = recalculate_total(cart)
-  await db.carts.update_one({"_id": cart["_id"]}, {"$set": cart})
+  cart = await cart_store.set_item_quantity(db, current_user.id, payload.item_id, payload.quantity)
+  if cart is None:
+    # Позицию успели удалить параллельным запросом - возвращаем списанное обратно
+    if item.get("variant_id") and quantity_diff > 0:
+      await restore_variant_quantity(db, item["product_id"], item.get("variant_id"), quantity_diff)
+    raise HTTPException(status_code=404, detail="Товар не найден в корзине")
+  schedule_reservation_sync(db, cart)
   safe_cart = normalize_cart(cart)
   return Cart(**serialize_doc(safe_cart) | {"id": str(cart["_id"])})
 
@@ -410,12 +257,16 @@ async def remove_from_cart(
   db: AsyncIOMotorDatabase = Depends(get_db),
   current_user: TelegramUser = Depends(get_current_user),
 ):
-  cart = await get_cart_document(db, current_user.id, check_expiry=False)
-  item_to_remove = next((item for item in cart["items"] if item["id"] == payload.item_id), None)
+  cart = await get_cart_document(db, current_user.id)
+  item_to_remove = next((item for item in cart["items"] if item.get("id") == payload.item_id), None)
   if not item_to_remove:
     raise HTTPException(status_code=404, detail="Товар не найден в корзине")
   
-  # Возвращаем товар на склад при удалении из корзины
+  cart = await cart_store.remove_item(db, current_user.id, payload.item_id)
+  if cart is None:
+    raise HTTPException(status_code=404, detail="Товар не найден в корзине")
+
+  # Возвращаем товар на склад после удаления из корзины
   if item_to_remove.get("variant_id"):
     await restore_variant_quantity(
       db,
@@ -423,11 +274,8 @@ async def remove_from_cart(
       item_to_remove.get("variant_id"),
       item_to_remove.get("quantity", 0)
     )
-  
-  cart["items"] = [item for item in cart["items"] if item["id"] != payload.item_id]
-  cart["updated_at"] = datetime.utcnow()
-  cart = recalculate_total(cart)
-  await db.carts.update_one({"_id": cart["_id"]}, {"$set": cart})
+
+  schedule_reservation_sync(db, cart)
   safe_cart = normalize_cart(cart)
   return Cart(**serialize_doc(safe_cart) | {"id": str(cart["_id"])})
 
@@ -438,22 +286,163 @@ async def clear_cart(
   current_user: TelegramUser = Depends(get_current_user),
 ):
   """Очищает корзину и возвращает все товары на склад"""
-  cart = await get_cart_document(db, current_user.id, check_expiry=False)
-  
-  # Возвращаем все товары на склад
-  for item in cart.get("items", []):
-    if item.get("variant_id"):
-      await restore_variant_quantity(
-        db,
-        item.get("product_id"),
-        item.get("variant_id"),
-        item.get("quantity", 0)
-      )
+  cart = await get_cart_document(db, current_user.id)
   
+  # Возвращаем все товары на склад одним bulk_write
+  await restore_variant_quantities(db, cart.get("items", []))
+
   # Очищаем корзину
-  cart["items"] = []
-  cart["total_amount"] = 0
-  cart["updated_at"] = datetime.utcnow()
-  await db.carts.update_one({"_id": cart["_id"]}, {"$set": cart})
+  cart = await cart_store.clear_items(db, current_user.id)
+  schedule_reservation_sync(db, cart)
   safe_cart = normalize_cart(cart)
   return Cart(**serialize_doc(safe_cart) | {"id": str(cart["_id"])})
+
+
+# Сколько раз пересчитывать пакет, если корзину изменили параллельно
+_CART_BATCH_ATTEMPTS = 3
+
+
+def _apply_cart_batch(items: list, operations: list, products: dict) -> list:
+  """
+  Применяет операции пакета по порядку к копии позиций корзины и возвращает
+  итоговые позиции. Любая ошибка отменяет пакет целиком (HTTPException).
+  """
+  items = [dict(item) for item in items]
+  for position, operation in enumerate(operations):
+    if operation.op == CartBatchOp.ADD:
+      if not operation.product_id or not operation.quantity:
+        raise HTTPException(status_code=400, detail=f"Операция {position}: нужны product_id и quantity")
+      if not operation.variant_id:
+        raise HTTPException(status_code=400, detail="Необходимо выбрать вариацию (вкус)")
+      product = products.get(operation.product_id)
+      if not product:
+        raise HTTPException(status_code=404, detail="Товар не найден")
+      if not product.get("variants"):
+        raise HTTPException(
+          status_code=400,
+          detail="Товар не может быть продан без вариаций (вкусов). Обратитесь к администратору."
+        )
+      if not any(v.get("id") == operation.variant_id for v in product["variants"]):
+        raise HTTPException(status_code=404, detail="Вариация не найдена")
+      existing = next(
+        (item for item in items if item.get("product_id") == operation.product_id and item.get("variant_id") == operation.variant_id),
+        None
+      )
+      if existing:
+        existing["quantity"] = existing.get("quantity", 0) + operation.quantity
+      else:
+        items.append(_new_cart_item(product, operation))
+      continue
+
+    item = next((item for item in items if item.get("id") == operation.item_id), None)
+    if not item:
+      raise HTTPException(status_code=404, detail="Товар не найден в корзине")
+    if operation.op == CartBatchOp.SET_QUANTITY:
+      if not operation.quantity:
+        raise HTTPException(status_code=400, detail=f"Операция {position}: нужно quantity")
+      item["quantity"] = operation.quantity
+    else:
+      items.remove(item)
+  return items
+
+
+def _stock_deltas(old_items: list, new_items: list) -> dict:
+  """Изменение количества по (product_id, variant_id): > 0 - списать, < 0 - вернуть."""
+  deltas: dict = {}
+  for items, sign in ((new_items, 1), (old_items, -1)):
+    for item in items:
+      if item.get("variant_id"):
+        key = (item.get("product_id"), item.get("variant_id"))
+        deltas[key] = deltas.get(key, 0) + sign * (item.get("quantity") or 0)
+  return {key: delta for key, delta in deltas.items() if delta}
+
+
+def _stock_lines(deltas: dict, sign: int) -> list:
+  return [
+    {"product_id": product_id, "variant_id": variant_id, "quantity": sign * delta}
+    for (product_id, variant_id), delta in deltas.items()
+    if delta * sign > 0
+  ]
+
+
+@router.post("/cart/batch", response_model=Cart)
+async def batch_update_cart(
+  payload: CartBatchRequest,
+  db: AsyncIOMotorDatabase = Depends(get_db),
+  current_user: TelegramUser = Depends(get_current_user),
+):
+  """
+  Применяет пакет операций с корзиной (add, set_quantity, remove) по порядку.
+  Склад меняется на итоговую разницу пакетными запросами, корзина
+  записывается одним запросом; если её изменили параллельно, пакет
+  пересчитывается заново. Ошибка любой операции отменяет весь пакет.
+  """
+  user_id = current_user.id
+  operations = payload.operations
+  if not operations:
+    raise HTTPException(status_code=400, detail="Пустой пакет операций")
+  if len(operations) > settings.cart_batch_max_operations:
+    raise HTTPException(
+      status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+      detail=f"Не более {settings.cart_batch_max_operations} операций за запрос",
+    )
+
+  # Товары для всех add загружаются одним запросом
+  product_oids = set()
+  for operation in operations:
+    if operation.op == CartBatchOp.ADD and operation.product_id:
+      try:
+        product_oids.add(as_object_id(operation.product_id))
+      except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный идентификатор товара")
+  products = {}
+  if product_oids:
+    async for product in db.products.find({"_id": {"$in": list(product_oids)}}, _CART_PRODUCT_PROJECTION):
+      products[str(product["_id"])] = product
+
+  for _attempt in range(_CART_BATCH_ATTEMPTS):
+    cart = await get_cart_document(db, user_id)
+    old_items = cart.get("items") or []
+    new_items = _apply_cart_batch(old_items, operations, products)
+    deltas = _stock_deltas(old_items, new_items)
+
+    to_decrement = _stock_lines(deltas, 1)
+    decremented = await decrement_variant_quantities(db, to_decrement)
+    failed = [key for key, ok in decremented.items() if not ok]
+    if failed:
+      # Пакет отменяется целиком: возвращаем то, что успели списать
+      await restore_variant_quantities(db, [line for line in to_decrement if decremented.get((line["product_id"], line["variant_id"]))])
+      product_id, variant_id = failed[0]
+      product_name = (products.get(product_id) or {}).get("name") or "Товар"
+      raise HTTPException(status_code=400, detail=f"Недостаточно товара: {product_name}")
+
+    try:
+      final_cart = await cart_store.replace_items(db, user_id, new_items, cart["updated_at"])
+    except Exception:
+      # Корзина не записана - списанное под неё возвращаем на склад
+      await restore_variant_quantities(db, to_decrement)
+      raise
+    if final_cart is None:
+      # Корзину изменили между чтением и записью - откатываем списание и повторяем
+      await restore_variant_quantities(db, to_decrement)
+      continue
+
+    # Товар из уменьшенных и удаленных позиций возвращается после записи корзины
+    await restore_variant_quantities(db, _stock_lines(deltas, -1))
+    break
+  else:
+    raise HTTPException(status_code=409, detail="Корзина изменилась, повторите запрос")
+
+  if any(operation.op == CartBatchOp.ADD for operation in operations):
+    # Обновление клиента в фоне (fire-and-forget для скорости)
+    asyncio.create_task(
+      db.customers.update_one(
+        {"telegram_id": user_id},
+        {"$set": {"last_cart_activity": datetime.utcnow()}},
+        upsert=True
+      )
+    )
+
+  schedule_reservation_sync(db, final_cart)
+  safe_cart = normalize_cart(final_cart)
+  return Cart(**serialize_doc(safe_cart) | {"id": str(final_cart["_id"])})
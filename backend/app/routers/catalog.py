@@ -1,10 +1,10 @@
 from datetime import datetime, timedelta
-from typing import List, Sequence, Tuple
+from typing import Callable, Iterable, List, Tuple
 
 import asyncio
-import json
+import gzip
 import logging
-from hashlib import sha256
+import weakref
 from bson import ObjectId
 from fastapi import (
   APIRouter,
@@ -12,17 +12,33 @@ from fastapi import (
   Header,
   HTTPException,
   Query,
+  Request,
   Response,
   status,
 )
 from fastapi.responses import JSONResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from pymongo import ReturnDocument
+from pydantic import ValidationError
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from ..auth import verify_admin
 from ..config import settings
 from ..database import get_db
-from ..cache import cache_get, cache_set, cache_delete_pattern, make_cache_key
+from ..cache import (
+  ENCODING_GZIP,
+  cache_get_or_recompute,
+  cache_publish,
+  cache_set_many,
+  cache_subscribe,
+  decode_value,
+  make_cache_key,
+  make_recompute_entry,
+  pack_encoded,
+  unpack_encoded,
+)
+from ..catalog_index import CatalogChangeLog, CatalogIndex
+from ..search_index import MIN_QUERY_TOKEN_LENGTH, ProductSearchIndex
 # Используем orjson если доступен, иначе fallback на ujson
 try:
     import orjson
@@ -31,7 +47,15 @@ except ImportError:
     import ujson as orjson
     HAS_ORJSON = False
 from ..schemas import (
+  BulkProductOp,
+  BulkProductOperation,
+  BulkProductRowResult,
+  BulkProductsResponse,
+  CatalogChangesResponse,
+  CatalogLiteResponse,
   CatalogResponse,
+  CatalogSearchResponse,
+  PaginatedProductsResponse,
   Category,
   CategoryCreate,
   CategoryDetail,
@@ -40,21 +64,44 @@ from ..schemas import (
   ProductCreate,
   ProductUpdate,
 )
+from ..migrations import CATEGORY_IDS_MIGRATION, is_migration_completed
 from ..utils import as_object_id, serialize_doc
 
 router = APIRouter(tags=["catalog"])
 logger = logging.getLogger(__name__)
 
-_catalog_cache: CatalogResponse | None = None
+_catalog_cache: CatalogIndex | None = None
 _catalog_cache_etag: str | None = None
 _catalog_cache_expiration: datetime | None = None
 _catalog_cache_version: str | None = None
 _catalog_cache_lock = asyncio.Lock()
 _CATALOG_CACHE_STATE_ID = "catalog_cache_state"
+# Отдельный кеш каталога админки (все товары, включая недоступные)
+_admin_catalog_cache: CatalogIndex | None = None
+_admin_catalog_cache_version: str | None = None
+_admin_catalog_cache_lock = asyncio.Lock()
+_admin_catalog_encoded: Tuple[str, bytes] | None = None
+# Фоновое обновление устаревшего каталога (stale-while-revalidate)
+_catalog_revalidation_task: asyncio.Task | None = None
 # Кеш версии в памяти для избежания лишних запросов к БД
 _cache_version_in_memory: str | None = None
 _cache_version_expiration: datetime | None = None
 _CACHE_VERSION_TTL_SECONDS = 10  # Версия кешируется на 10 секунд
+# Канал Redis, через который воркеры узнают о новой версии каталога.
+# Пока подписка активна, версия в памяти считается актуальной без опроса MongoDB;
+# при недоступности Redis работает опрос cache_state с TTL выше.
+_CATALOG_INVALIDATION_CHANNEL = "catalog-invalidations"
+_catalog_invalidation_subscribed = False
+# Журнал изменений по версиям для /catalog/changes
+_catalog_change_log = CatalogChangeLog(maxlen=settings.catalog_change_log_size)
+# Готовые тела ответов /catalog/category/{id}: category_id -> (etag, body)
+_category_encoded: dict[str, Tuple[str, bytes]] = {}
+# Текущие построения поискового индекса (по одному на индекс каталога)
+_search_index_builds: "weakref.WeakKeyDictionary[CatalogIndex, asyncio.Task]" = weakref.WeakKeyDictionary()
+# Готовые байты ответа (etag, body, gzip body) для последней версии каталога
+# по каждому представлению (full/lite), чтобы не сериализовать и не сжимать
+# каталог на каждый промах Redis
+_catalog_encoded: dict[str, Tuple[str, bytes, bytes]] = {}
 
 
 async def _load_catalog_from_db(db: AsyncIOMotorDatabase, only_available: bool = True) -> CatalogResponse:
@@ -107,65 +154,74 @@ async def _load_catalog_from_db(db: AsyncIOMotorDatabase, only_available: bool =
   # Оптимизированная валидация товаров (минимальные проверки для скорости)
   products = []
   for doc in products_docs:
-      # Быстрая предварительная проверка обязательных полей
-      name = doc.get("name")
-      if not name or not isinstance(name, str):
-        continue
-      
-      category_id = doc.get("category_id")
-      if not category_id:
-        continue
-      
-      # Быстрая обработка цены
-    price = doc.get("price", 0.0)
-    if not isinstance(price, (int, float)):
-      price = float(price) if price else 0.0
-      
-    # Собираем данные товара (минимальная валидация)
-    product_data: dict = {
-        "id": str(doc["_id"]),
-        "name": name,
-        "price": price,
-        "category_id": str(category_id) if not isinstance(category_id, str) else category_id,
-      "available": bool(doc.get("available", True)),
-      }
-      
-      # Опциональные поля добавляем только если они есть
-      if "description" in doc and doc["description"]:
-      desc = doc["description"]
-      product_data["description"] = desc[:300] if isinstance(desc, str) and len(desc) > 300 else desc
-      if "image" in doc:
-        product_data["image"] = doc["image"]
-      if "images" in doc:
-        product_data["images"] = doc["images"]
-      if "variants" in doc:
-        product_data["variants"] = doc["variants"]
-      
-    # Прямое создание без try-catch для скорости
-    try:
-      products.append(Product(**product_data))
-    except:
-      # Пропускаем некорректные товары без логирования в production
-      continue
-  
+    product = _build_catalog_product(doc)
+    if product is not None:
+      products.append(product)
+
   return CatalogResponse(categories=categories, products=products)
 
 
+def _build_catalog_product(doc: dict) -> Product | None:
+  """Собирает товар каталога из документа MongoDB (None для некорректных документов)."""
+  # Быстрая предварительная проверка обязательных полей
+  name = doc.get("name")
+  if not name or not isinstance(name, str):
+    return None
+
+  category_id = doc.get("category_id")
+  if not category_id:
+    return None
+
+  # Быстрая обработка цены
+  price = doc.get("price", 0.0)
+  if not isinstance(price, (int, float)):
+    price = float(price) if price else 0.0
+
+  # Собираем данные товара (минимальная валидация)
+  product_data: dict = {
+    "id": str(doc["_id"]),
+    "name": name,
+    "price": price,
+    "category_id": str(category_id) if not isinstance(category_id, str) else category_id,
+    "available": bool(doc.get("available", True)),
+  }
+
+  # Опциональные поля добавляем только если они есть
+  if "description" in doc and doc["description"]:
+    desc = doc["description"]
+    product_data["description"] = desc[:300] if isinstance(desc, str) and len(desc) > 300 else desc
+  if "image" in doc:
+    product_data["image"] = doc["image"]
+  if "images" in doc:
+    product_data["images"] = doc["images"]
+  if "variants" in doc:
+    product_data["variants"] = doc["variants"]
+
+  # Прямое создание без try-catch для скорости
+  try:
+    return Product(**product_data)
+  except:
+    # Пропускаем некорректные товары без логирования в production
+    return None
+
+
 def _catalog_to_dict(payload: CatalogResponse) -> dict:
   # Используем exclude_unset для исключения None значений и уменьшения размера ответа
   return payload.dict(by_alias=True, exclude_none=False)
 
 
-def _compute_catalog_etag(payload: CatalogResponse) -> str:
-  payload_dict = _catalog_to_dict(payload)
-  serialized = json.dumps(payload_dict, sort_keys=True, ensure_ascii=False)
-  return sha256(serialized.encode("utf-8")).hexdigest()
-
-
 def _generate_cache_version() -> str:
   return str(ObjectId())
 
 
+def _is_cache_version_fresh(now: datetime) -> bool:
+  if _cache_version_in_memory is None:
+    return False
+  if _catalog_invalidation_subscribed:
+    return True
+  return _cache_version_expiration is not None and now < _cache_version_expiration
+
+
 async def _get_catalog_cache_version(db: AsyncIOMotorDatabase, use_memory_cache: bool = True) -> str:
   """
   Получает версию кеша каталога с опциональным кешированием в памяти.
@@ -177,9 +233,8 @@ async def _get_catalog_cache_version(db: AsyncIOMotorDatabase, use_memory_cache:
   global _cache_version_in_memory, _cache_version_expiration
   
   # Проверяем кеш в памяти, если он включен
-  if use_memory_cache and _cache_version_in_memory is not None and _cache_version_expiration is not None:
-    if datetime.utcnow() < _cache_version_expiration:
-      return _cache_version_in_memory
+  if use_memory_cache and _is_cache_version_fresh(datetime.utcnow()):
+    return _cache_version_in_memory
   
   # Загружаем из БД
   doc = await db.cache_state.find_one({"_id": _CATALOG_CACHE_STATE_ID})
@@ -191,18 +246,20 @@ async def _get_catalog_cache_version(db: AsyncIOMotorDatabase, use_memory_cache:
       _cache_version_expiration = datetime.utcnow() + timedelta(seconds=_CACHE_VERSION_TTL_SECONDS)
     return version
 
-  # Создаем новую версию
-  version = _generate_cache_version()
-  await db.cache_state.update_one(
+  # Создаем начальную версию; если её одновременно создал другой воркер,
+  # $setOnInsert ничего не перезапишет и вернется уже записанная версия
+  doc = await db.cache_state.find_one_and_update(
     {"_id": _CATALOG_CACHE_STATE_ID},
     {
-      "$set": {
-        "version": version,
+      "$setOnInsert": {
+        "version": _generate_cache_version(),
         "updated_at": datetime.utcnow(),
       }
     },
     upsert=True,
+    return_document=ReturnDocument.AFTER,
   )
+  version = doc["version"]
   # Обновляем кеш в памяти
   if use_memory_cache:
     _cache_version_in_memory = version
@@ -210,25 +267,220 @@ async def _get_catalog_cache_version(db: AsyncIOMotorDatabase, use_memory_cache:
   return version
 
 
-async def _bump_catalog_cache_version(db: AsyncIOMotorDatabase) -> str:
+async def _swap_catalog_cache_version(db: AsyncIOMotorDatabase, previous_version: str | None = None) -> str | None:
+  """
+  Записывает новую версию каталога в cache_state. С previous_version это
+  compare-and-swap: версия меняется, только если в БД все еще previous_version;
+  если её успел сменить другой воркер, возвращается None.
+  """
   global _cache_version_in_memory, _cache_version_expiration
   version = _generate_cache_version()
-  await db.cache_state.update_one(
-    {"_id": _CATALOG_CACHE_STATE_ID},
-    {
-      "$set": {
-        "version": version,
-        "updated_at": datetime.utcnow(),
-      }
-    },
-    upsert=True,
-  )
+  update = {
+    "$set": {
+      "version": version,
+      "updated_at": datetime.utcnow(),
+    }
+  }
+  if previous_version is None:
+    await db.cache_state.update_one({"_id": _CATALOG_CACHE_STATE_ID}, update, upsert=True)
+  else:
+    result = await db.cache_state.update_one(
+      {"_id": _CATALOG_CACHE_STATE_ID, "version": previous_version},
+      update,
+    )
+    if result.matched_count == 0:
+      return None
   # Обновляем кеш в памяти
   _cache_version_in_memory = version
   _cache_version_expiration = datetime.utcnow() + timedelta(seconds=_CACHE_VERSION_TTL_SECONDS)
   return version
 
 
+async def _publish_catalog_version(
+  version: str,
+  previous_version: str | None = None,
+  categories: Iterable[str] = (),
+  products: Iterable[str] = (),
+) -> None:
+  """
+  Записывает версию в журнал изменений и рассылает её воркерам.
+  Без previous_version изменение считается полной перезагрузкой.
+  """
+  categories = list(categories)
+  products = list(products)
+  _catalog_change_log.record(version, previous_version, categories, products)
+  # Сообщаем остальным воркерам о новой версии
+  message = {
+    "version": version,
+    "previous_version": previous_version,
+    "categories": categories,
+    "products": products,
+  }
+  await cache_publish(_CATALOG_INVALIDATION_CHANNEL, _dump_json(message))
+
+
+async def _bump_catalog_cache_version(db: AsyncIOMotorDatabase) -> str:
+  """Создает новую версию каталога для полной перезагрузки и рассылает её воркерам."""
+  version = await _swap_catalog_cache_version(db)
+  await _publish_catalog_version(version)
+  return version
+
+
+async def _handle_catalog_invalidation(message: bytes) -> None:
+  global _cache_version_in_memory, _cache_version_expiration
+  try:
+    payload = orjson.loads(message)
+    version = payload["version"]
+  except Exception:
+    logger.warning("Некорректное сообщение об изменении каталога: %r", message)
+    return
+  _catalog_change_log.record(
+    version,
+    payload.get("previous_version"),
+    payload.get("categories") or (),
+    payload.get("products") or (),
+  )
+  if not version or version == _cache_version_in_memory:
+    # Собственная публикация или повтор - версия уже применена
+    return
+  db = await get_db()
+  previous_version = payload.get("previous_version")
+  if previous_version and _catalog_cache is not None and _catalog_cache_version == previous_version:
+    # Индекс отстал ровно на одну версию - дочитываем только измененные записи
+    try:
+      if await _apply_remote_catalog_changes(
+        db,
+        previous_version,
+        version,
+        payload.get("categories") or (),
+        payload.get("products") or (),
+      ):
+        return
+    except Exception as e:
+      logger.warning("Failed to patch catalog cache from remote changes: %s", e)
+  _cache_version_in_memory = version
+  _cache_version_expiration = datetime.utcnow() + timedelta(seconds=_CACHE_VERSION_TTL_SECONDS)
+  if _catalog_cache is not None and _catalog_cache_version != version:
+    # Перестраиваем кеш сразу, не дожидаясь первого запроса после изменения
+    asyncio.create_task(_refresh_catalog_cache(db))
+
+
+async def _apply_remote_catalog_changes(
+  db: AsyncIOMotorDatabase,
+  previous_version: str,
+  version: str,
+  category_ids: Iterable[str],
+  product_ids: Iterable[str],
+) -> bool:
+  """
+  Применяет к индексам в памяти изменения, сделанные другим воркером:
+  перечитывает из MongoDB только перечисленные категории и товары.
+  Возвращает False, если индекс успел смениться и нужна полная перезагрузка.
+  """
+  global _cache_version_in_memory, _cache_version_expiration
+  global _catalog_cache_etag, _catalog_cache_expiration, _catalog_cache_version
+  global _admin_catalog_cache, _admin_catalog_cache_version
+  category_ids = list(category_ids)
+  product_ids = list(product_ids)
+  category_oids = [_category_filter(category_id)["_id"] for category_id in category_ids]
+  product_oids = [ObjectId(product_id) for product_id in product_ids if ObjectId.is_valid(product_id)]
+  categories_docs, products_docs = await asyncio.gather(
+    db.categories.find({"_id": {"$in": category_oids}}, {"name": 1}).to_list(length=None) if category_oids else _empty_list(),
+    db.products.find({"_id": {"$in": product_oids}}).to_list(length=None) if product_oids else _empty_list(),
+  )
+
+  index = _catalog_cache
+  if index is None or _catalog_cache_version != previous_version:
+    return False
+
+  found_categories = {}
+  for doc in categories_docs:
+    name = doc.get("name")
+    if name and isinstance(name, str):
+      found_categories[str(doc["_id"])] = Category(name=name, id=str(doc["_id"]))
+  found_products = {str(doc["_id"]): doc for doc in products_docs}
+
+  def apply(target: CatalogIndex) -> None:
+    for category_id in category_ids:
+      category = found_categories.get(category_id)
+      if category is None:
+        target.remove_category(category_id)
+      else:
+        target.upsert_category(category)
+    for product_id in product_ids:
+      doc = found_products.get(product_id)
+      if doc is None:
+        target.remove_product(product_id)
+      else:
+        _patch_catalog_product(target, doc)
+    target.take_changes()
+
+  # Патч выполняется без await, как и в _patch_catalog_cache
+  apply(index)
+  _catalog_cache_etag = index.etag
+  _catalog_cache_expiration = datetime.utcnow() + timedelta(seconds=settings.catalog_cache_ttl_seconds)
+  _catalog_cache_version = version
+  if _admin_catalog_cache is not None and _admin_catalog_cache_version == previous_version:
+    apply(_admin_catalog_cache)
+    _admin_catalog_cache_version = version
+  else:
+    _admin_catalog_cache = None
+    _admin_catalog_cache_version = None
+  _cache_version_in_memory = version
+  _cache_version_expiration = datetime.utcnow() + timedelta(seconds=_CACHE_VERSION_TTL_SECONDS)
+  return True
+
+
+async def _empty_list() -> list:
+  return []
+
+
+async def poll_catalog_version() -> None:
+  """
+  Фоновая проверка версии каталога в MongoDB. Страхует подписку на Redis:
+  если публикация потерялась (например, у публикующего воркера был открыт
+  circuit breaker Redis), воркер все равно заметит новую версию.
+  """
+  global _cache_version_in_memory, _cache_version_expiration
+  while True:
+    await asyncio.sleep(settings.catalog_version_poll_seconds)
+    try:
+      db = await get_db()
+      version = await _get_catalog_cache_version(db, use_memory_cache=False)
+    except Exception as e:
+      logger.debug("Catalog version poll failed: %s", e)
+      continue
+    if version == _cache_version_in_memory:
+      continue
+    _cache_version_in_memory = version
+    _cache_version_expiration = datetime.utcnow() + timedelta(seconds=_CACHE_VERSION_TTL_SECONDS)
+    if _catalog_cache is not None and _catalog_cache_version != version:
+      asyncio.create_task(_refresh_catalog_cache(db))
+
+
+def _on_catalog_invalidation_subscribed() -> None:
+  global _catalog_invalidation_subscribed, _cache_version_in_memory
+  # Пока подписки не было, сообщения могли потеряться: следующая проверка
+  # версии один раз перечитает cache_state из MongoDB
+  _cache_version_in_memory = None
+  _catalog_invalidation_subscribed = True
+
+
+def _on_catalog_invalidation_disconnected() -> None:
+  global _catalog_invalidation_subscribed
+  _catalog_invalidation_subscribed = False
+
+
+async def listen_catalog_invalidations() -> None:
+  """Фоновая задача: подписка воркера на изменения версии каталога."""
+  await cache_subscribe(
+    _CATALOG_INVALIDATION_CHANNEL,
+    _handle_catalog_invalidation,
+    on_subscribed=_on_catalog_invalidation_subscribed,
+    on_disconnected=_on_catalog_invalidation_disconnected,
+  )
+
+
 async def fetch_catalog(
   db: AsyncIOMotorDatabase,
   *,
@@ -249,13 +501,11 @@ async def fetch_catalog(
     and _catalog_cache_expiration
     and _catalog_cache_expiration > now
     and _catalog_cache_version is not None
-    and _cache_version_in_memory is not None
-    and _cache_version_expiration is not None
-    and now < _cache_version_expiration
+    and _is_cache_version_fresh(now)
     and _catalog_cache_version == _cache_version_in_memory
   ):
     # Кеш валиден и версия совпадает - возвращаем без запроса к БД
-    return _catalog_cache, _catalog_cache_etag
+    return _catalog_cache.to_response(), _catalog_cache_etag
 
   # Если кеш истек или версия не совпадает, получаем актуальную версию (с кешированием)
   current_version = await _get_catalog_cache_version(db, use_memory_cache=True)
@@ -270,7 +520,23 @@ async def fetch_catalog(
     and _catalog_cache_expiration > now
     and _catalog_cache_version == current_version
   ):
-    return _catalog_cache, _catalog_cache_etag
+    return _catalog_cache.to_response(), _catalog_cache_etag
+
+  # Stale-while-revalidate: версия актуальна, истек только TTL - отдаем
+  # имеющиеся данные сразу и обновляем их одной фоновой задачей на воркер
+  hard_stale = settings.catalog_cache_hard_stale_seconds
+  if (
+    not force_refresh
+    and ttl > 0
+    and hard_stale > 0
+    and _catalog_cache
+    and _catalog_cache_etag
+    and _catalog_cache_expiration
+    and now < _catalog_cache_expiration + timedelta(seconds=hard_stale)
+    and _catalog_cache_version == current_version
+  ):
+    _schedule_catalog_revalidation(db, only_available=_catalog_cache.only_available)
+    return _catalog_cache.to_response(), _catalog_cache_etag
 
   # Кеш истек или версия изменилась - загружаем заново
   async with _catalog_cache_lock:
@@ -286,14 +552,20 @@ async def fetch_catalog(
       and _catalog_cache_expiration > now
       and _catalog_cache_version == current_version
     ):
-      return _catalog_cache, _catalog_cache_etag
+      return _catalog_cache.to_response(), _catalog_cache_etag
 
     # Загружаем данные из БД
     data = await _load_catalog_from_db(db, only_available=only_available)
-    etag = _compute_catalog_etag(data)
+    # ETag собирается из хешей отдельных записей при построении индекса
+    index = CatalogIndex.from_response(data, only_available=only_available)
+    etag = index.etag
 
     if ttl > 0:
-      _catalog_cache = data
+      previous_index = _catalog_cache
+      _catalog_cache = index
+      if previous_index is not None and previous_index.search_index is not None:
+        # Поиском уже пользуются - строим индекс новой версии сразу в фоне
+        _ensure_search_index_build(_catalog_cache)
       _catalog_cache_etag = etag
       _catalog_cache_expiration = now + timedelta(seconds=ttl)
       _catalog_cache_version = current_version
@@ -306,25 +578,162 @@ async def fetch_catalog(
     return data, etag
 
 
+def _schedule_catalog_revalidation(db: AsyncIOMotorDatabase, *, only_available: bool) -> None:
+  """Запускает фоновое обновление каталога, если оно еще не идет (single-flight)."""
+  global _catalog_revalidation_task
+  if _catalog_revalidation_task is not None and not _catalog_revalidation_task.done():
+    return
+  _catalog_revalidation_task = asyncio.create_task(
+    _revalidate_catalog_cache(db, only_available=only_available)
+  )
+
+
+async def _revalidate_catalog_cache(db: AsyncIOMotorDatabase, *, only_available: bool) -> None:
+  try:
+    await fetch_catalog(db, force_refresh=True, only_available=only_available)
+  except Exception as exc:
+    # Данные остаются устаревшими; следующий запрос запустит новую попытку
+    logger.warning("Failed to revalidate stale catalog cache: %s", exc)
+
+
 async def invalidate_catalog_cache(db: AsyncIOMotorDatabase | None = None):
   global _catalog_cache, _catalog_cache_expiration, _catalog_cache_etag, _catalog_cache_version
+  global _admin_catalog_cache, _admin_catalog_cache_version
   _catalog_cache = None
   _catalog_cache_expiration = None
   _catalog_cache_etag = None
   _catalog_cache_version = None
+  _admin_catalog_cache = None
+  _admin_catalog_cache_version = None
 
-  # Очищаем Redis кэш
-  try:
-    await cache_delete_pattern("catalog:*")
-  except Exception as e:
-    # Убираем debug логи в production
-    if settings.environment != "production":
-    logger.debug(f"Ошибка очистки Redis кэша: {e}")
-
+  # Ключи Redis содержат версию каталога, поэтому после смены версии старые
+  # записи просто перестают читаться и истекают по TTL - удалять их не нужно
   if db is not None:
     _catalog_cache_version = await _bump_catalog_cache_version(db)
 
 
+async def _patch_catalog_cache(
+  db: AsyncIOMotorDatabase,
+  patch: Callable[[CatalogIndex], None],
+):
+  """
+  Применяет мутацию админки к индексам каталога в памяти (публичному и
+  админскому) вместо полной перезагрузки. Если публичного индекса нет или
+  он отстал от версии в БД (изменения другого воркера), выполняется обычная
+  инвалидация с перезагрузкой.
+  """
+  global _catalog_cache_etag, _catalog_cache_expiration, _catalog_cache_version
+  global _admin_catalog_cache, _admin_catalog_cache_version
+  ttl = settings.catalog_cache_ttl_seconds
+  if _catalog_cache is None or ttl <= 0:
+    await invalidate_catalog_cache(db)
+    await _refresh_catalog_cache(db)
+    return
+
+  # Версия из памяти может отставать на несколько секунд - читаем её из БД
+  current_version = await _get_catalog_cache_version(db, use_memory_cache=False)
+  if _catalog_cache is None or _catalog_cache_version != current_version:
+    await invalidate_catalog_cache(db)
+    await _refresh_catalog_cache(db)
+    return
+
+  # Сначала занимаем следующую версию (compare-and-swap), и только потом
+  # патчим индекс: если два воркера сохраняют одновременно, один из них
+  # проиграет и перезагрузит каталог, а не выдаст свой индекс без чужой правки
+  version = await _swap_catalog_cache_version(db, previous_version=current_version)
+  if version is None:
+    logger.info("Catalog version changed concurrently, reloading catalog cache")
+    await invalidate_catalog_cache(db)
+    await _refresh_catalog_cache(db)
+    return
+
+  index = _catalog_cache
+  if index is None or _catalog_cache_version != current_version:
+    # Пока шел compare-and-swap, индекс перезагрузили - обновим его заново
+    await invalidate_catalog_cache(db)
+    await _refresh_catalog_cache(db)
+    return
+
+  # Патч и пересчет etag выполняются без await, поэтому читатели видят
+  # либо старый, либо уже обновленный индекс, но не промежуточное состояние
+  patch(index)
+  changed_categories, changed_products = index.take_changes()
+  _catalog_cache_etag = index.etag
+  _catalog_cache_expiration = datetime.utcnow() + timedelta(seconds=ttl)
+  _catalog_cache_version = version
+
+  admin_index = _admin_catalog_cache
+  if admin_index is not None and _admin_catalog_cache_version == current_version:
+    patch(admin_index)
+    admin_index.take_changes()
+    _admin_catalog_cache_version = version
+  else:
+    # Админский кеш отстал - перезагрузится при следующем запросе
+    _admin_catalog_cache = None
+    _admin_catalog_cache_version = None
+
+  await _publish_catalog_version(version, current_version, changed_categories, changed_products)
+  # Redis общий для всех воркеров, поэтому прогреваем его только индексом,
+  # версия которого занята compare-and-swap выше
+  _schedule_catalog_redis_warmup(index, version)
+
+
+def _catalog_redis_key(version: str | None, view: str) -> str:
+  # Версия каталога в ключе заменяет удаление ключей при инвалидации
+  if view == "lite":
+    return make_cache_key("catalog", version, only_available=True, view=view)
+  return make_cache_key("catalog", version, only_available=True)
+
+
+def _schedule_catalog_redis_warmup(index: CatalogIndex, version: str) -> None:
+  if settings.catalog_cache_ttl_seconds > 0:
+    asyncio.create_task(_warm_catalog_redis(index, version, index.etag))
+
+
+async def _warm_catalog_redis(index: CatalogIndex, version: str, etag: str) -> None:
+  """
+  Записывает оба представления версии каталога в Redis одним pipeline,
+  чтобы первые запросы к другим воркерам после изменения попадали в Redis.
+  """
+  ttl = settings.catalog_cache_ttl_seconds
+  if ttl <= 0 or index.etag != etag:
+    # Индекс успели изменить следующей мутацией - её прогрев запишет свою версию
+    return
+  catalog = index.to_response()
+  redis_ttl = ttl + max(0, settings.catalog_cache_hard_stale_seconds)
+  entries = []
+  for view in ("full", "lite"):
+    view_etag, _body, gzip_body = _encode_catalog(catalog, etag, view)
+    entry = _pack_catalog_entry(view_etag, version, gzip_body)
+    entries.append((_catalog_redis_key(version, view), make_recompute_entry(entry, ttl), redis_ttl))
+  await cache_set_many(entries)
+
+
+async def fetch_admin_catalog(db: AsyncIOMotorDatabase) -> CatalogIndex:
+  """
+  Каталог админки со всеми товарами, включая недоступные.
+  Хранится отдельно от публичного кеша и привязан к версии каталога:
+  перезагружается только после мутаций, которые этот воркер не применил сам.
+  """
+  global _admin_catalog_cache, _admin_catalog_cache_version
+  # Без подписки на изменения версия в памяти может отставать до 10 секунд,
+  # а админам изменения нужны сразу - тогда читаем её из cache_state
+  use_memory_cache = _catalog_invalidation_subscribed
+  current_version = await _get_catalog_cache_version(db, use_memory_cache=use_memory_cache)
+  if _admin_catalog_cache is not None and _admin_catalog_cache_version == current_version:
+    return _admin_catalog_cache
+
+  async with _admin_catalog_cache_lock:
+    current_version = await _get_catalog_cache_version(db, use_memory_cache=use_memory_cache)
+    if _admin_catalog_cache is not None and _admin_catalog_cache_version == current_version:
+      return _admin_catalog_cache
+    data = await _load_catalog_from_db(db, only_available=False)
+    index = CatalogIndex.from_response(data, only_available=False)
+    _admin_catalog_cache = index
+    _admin_catalog_cache_version = current_version
+    return index
+
+
 async def _refresh_catalog_cache(db: AsyncIOMotorDatabase):
   try:
     await fetch_catalog(db, force_refresh=True)
@@ -332,23 +741,167 @@ async def _refresh_catalog_cache(db: AsyncIOMotorDatabase):
     logger.warning("Failed to warm catalog cache after mutation: %s", exc)
 
 
-def _build_catalog_response(catalog: CatalogResponse, etag: str) -> Response:
-  """Создает ответ с использованием orjson/ujson для быстрой сериализации"""
-  catalog_dict = _catalog_to_dict(catalog)
-  # Используем orjson если доступен, иначе ujson
+async def _build_search_index(index: CatalogIndex) -> ProductSearchIndex:
+  # Построение по снимку товаров идет в отдельном потоке, чтобы не блокировать
+  # event loop на больших каталогах; если каталог успели изменить, строим заново
+  while True:
+    generation = index.generation
+    products = list(index.products.values())
+    search_index = await asyncio.to_thread(ProductSearchIndex, products)
+    if index.generation == generation:
+      index.search_index = search_index
+      return search_index
+
+
+def _ensure_search_index_build(index: CatalogIndex) -> asyncio.Task:
+  task = _search_index_builds.get(index)
+  if task is None:
+    task = asyncio.create_task(_build_search_index(index))
+    _search_index_builds[index] = task
+    task.add_done_callback(lambda _task: _search_index_builds.pop(index, None))
+  return task
+
+
+async def _get_search_index(index: CatalogIndex) -> ProductSearchIndex:
+  if index.search_index is not None:
+    return index.search_index
+  # shield: отмена одного запроса не должна прерывать общее построение
+  return await asyncio.shield(_ensure_search_index_build(index))
+
+
+def _dump_json(payload) -> bytes:
   if HAS_ORJSON:
-    content = orjson.dumps(catalog_dict, option=orjson.OPT_SERIALIZE_NUMPY)
+    return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+  return orjson.dumps(payload).encode('utf-8')
+
+
+def _catalog_to_lite_dict(payload: CatalogResponse) -> dict:
+  """
+  Компактное представление для списков: у товара только id, название,
+  цена, первое изображение, доступность и категория.
+  """
+  products = []
+  for product in payload.products:
+    image = product.image
+    if not image and product.images:
+      image = product.images[0]
+    products.append({
+      "id": product.id,
+      "name": product.name,
+      "price": product.price,
+      "image": image,
+      "available": product.available,
+      "category_id": product.category_id,
+    })
+  return {
+    "categories": [{"id": category.id, "name": category.name} for category in payload.categories],
+    "products": products,
+  }
+
+
+def _encode_catalog(catalog: CatalogResponse, etag: str, view: str = "full") -> Tuple[str, bytes, bytes]:
+  """
+  Возвращает etag представления, готовое тело ответа и его gzip-вариант.
+  Результат кешируется по etag: повторные запросы той же версии не
+  сериализуют и не сжимают каталог заново.
+  """
+  if view == "lite":
+    # У компактного представления свой etag, чтобы клиентский кеш не путал их
+    etag = f"lite-{etag}"
+  encoded = _catalog_encoded.get(view)
+  if encoded is not None and encoded[0] == etag:
+    return encoded
+  payload = _catalog_to_lite_dict(catalog) if view == "lite" else _catalog_to_dict(catalog)
+  body = _dump_json(payload)
+  encoded = (etag, body, gzip.compress(body, mtime=0))
+  _catalog_encoded[view] = encoded
+  return encoded
+
+
+def _pack_catalog_entry(etag: str, version: str | None, gzip_body: bytes) -> bytes:
+  """
+  Упаковывает etag, версию и тело каталога в одно значение Redis:
+  JSON-заголовок, перевод строки, затем тело. Тело хранится только в gzip,
+  с записанной кодировкой, и отдается клиентам с gzip без распаковки.
+  """
+  header = _dump_json({"etag": etag, "version": version})
+  return header + b"\n" + pack_encoded(gzip_body, ENCODING_GZIP)
+
+
+def _unpack_catalog_entry(raw: bytes) -> Tuple[str, str | None, str, bytes] | None:
+  """Возвращает (etag, версия, кодировка тела, тело) или None для битой записи."""
+  header_end = raw.find(b"\n")
+  if header_end <= 0:
+    return None
+  try:
+    header = orjson.loads(raw[:header_end])
+    etag = header["etag"]
+  except Exception:
+    return None
+  if not etag:
+    return None
+  encoding, payload = unpack_encoded(raw[header_end + 1:])
+  return etag, header.get("version"), encoding, payload
+
+
+def _accepts_gzip(accept_encoding: str | None) -> bool:
+  return bool(accept_encoding) and "gzip" in accept_encoding.lower()
+
+
+def _build_encoded_catalog_response(
+  etag: str,
+  version: str | None,
+  body: bytes,
+  gzip_body: bytes,
+  accept_encoding: str | None,
+) -> Response:
+  """Отдает заранее закодированные байты каталога без повторной сериализации"""
+  headers = {
+    "ETag": etag,
+    "Cache-Control": _build_cache_control_value(),
+  }
+  if version:
+    # Версия нужна клиенту как параметр since для /catalog/changes
+    headers["X-Catalog-Version"] = version
+  if gzip_body and _accepts_gzip(accept_encoding):
+    # SafeGZipMiddleware пропускает ответы с уже выставленным Content-Encoding
+    headers["Content-Encoding"] = "gzip"
+    headers["Vary"] = "Accept-Encoding"
+    return Response(content=gzip_body, media_type="application/json", headers=headers)
+  return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _build_stored_catalog_response(
+  etag: str,
+  version: str | None,
+  encoding: str,
+  payload: bytes,
+  accept_encoding: str | None,
+) -> Response:
+  """
+  Отдает каталог из записи Redis. Сжатое тело уходит клиенту как есть;
+  распаковка нужна только клиентам без gzip, и то если в памяти процесса
+  нет готового тела той же версии.
+  """
+  if encoding == ENCODING_GZIP and _accepts_gzip(accept_encoding):
+    return _build_encoded_catalog_response(etag, version, b"", payload, accept_encoding)
+  body = None
+  for encoded_etag, encoded_body, _gzip_body in _catalog_encoded.values():
+    if encoded_etag == etag:
+      body = encoded_body
+      break
+  if body is None:
+    body = decode_value(encoding, payload)
+  return _build_encoded_catalog_response(etag, version, body, b"", accept_encoding)
+
+
+def _patch_catalog_product(index: CatalogIndex, doc: dict) -> None:
+  product = _build_catalog_product(doc)
+  if product is None:
+    # Документ больше не проходит валидацию каталога - убираем его из индекса
+    index.remove_product(str(doc["_id"]))
   else:
-    content = orjson.dumps(catalog_dict).encode('utf-8')
-  response = Response(
-    content=content,
-    media_type="application/json",
-    headers={
-      "ETag": etag,
-      "Cache-Control": _build_cache_control_value(),
-    }
-  )
-  return response
+    index.upsert_product(product)
 
 
 def _build_not_modified_response(etag: str) -> Response:
@@ -371,49 +924,187 @@ def _build_cache_control_value() -> str:
   return "public, max-age=0, must-revalidate"
 
 
-@router.get("/catalog", response_model=CatalogResponse)
+@router.get("/catalog", response_model=CatalogResponse | CatalogLiteResponse)
 async def get_catalog(
+  view: str = Query("full", pattern="^(full|lite)$", description="lite - компактные товары для списков"),
   db: AsyncIOMotorDatabase = Depends(get_db),
   if_none_match: str | None = Header(None, alias="If-None-Match"),
+  accept_encoding: str | None = Header(None, alias="Accept-Encoding"),
 ):
-  # Проверяем Redis кэш сначала
-  cache_key = make_cache_key("catalog", only_available=True)
-  cached_data = await cache_get(cache_key)
-  
-  if cached_data:
-    # Оптимизированная обработка кэша без лишних проверок
-    try:
-      catalog_dict = orjson.loads(cached_data) if HAS_ORJSON else orjson.loads(
-        cached_data.decode('utf-8') if isinstance(cached_data, bytes) else cached_data
-      )
-      catalog = CatalogResponse(**catalog_dict)
-      # Получаем etag из отдельного ключа
-      cached_etag = await cache_get(f"{cache_key}:etag")
-      if cached_etag:
-        etag = cached_etag.decode('utf-8')
-        if if_none_match and if_none_match == etag:
-          return _build_not_modified_response(etag)
-        return _build_catalog_response(catalog, etag)
-    except:
-      # Пропускаем ошибки кэша без логирования для скорости
-      pass
-  
-  # Если нет в Redis, используем стандартный кэш
-  catalog, etag = await fetch_catalog(db)
-  
-  # Сохраняем в Redis для следующего раза (без блокировки ответа)
-  try:
-    catalog_dict = _catalog_to_dict(catalog)
-    catalog_bytes = orjson.dumps(catalog_dict, option=orjson.OPT_SERIALIZE_NUMPY) if HAS_ORJSON else orjson.dumps(catalog_dict).encode('utf-8')
-    # Сохраняем асинхронно без ожидания для максимальной скорости ответа
-    asyncio.create_task(cache_set(cache_key, catalog_bytes, ttl=settings.catalog_cache_ttl_seconds))
-    asyncio.create_task(cache_set(f"{cache_key}:etag", etag.encode('utf-8'), ttl=settings.catalog_cache_ttl_seconds))
-  except:
-    pass  # Игнорируем ошибки сохранения кэша для скорости
-  
+  # Одна запись Redis содержит etag и сжатое тело, поэтому при попадании
+  # байты отдаются как есть, без orjson.loads, Pydantic и повторного gzip. Пересобирает запись
+  # только один процесс (блокировка в Redis), остальные отдают прежнюю или ждут.
+  version = await _get_catalog_cache_version(db, use_memory_cache=True)
+  cache_key = _catalog_redis_key(version, view)
+
+  async def build_entry() -> bytes:
+    catalog, etag = await fetch_catalog(db)
+    etag, _body, gzip_body = _encode_catalog(catalog, etag, view)
+    return _pack_catalog_entry(etag, _catalog_cache_version, gzip_body)
+
+  unpacked = _unpack_catalog_entry(
+    await cache_get_or_recompute(
+      cache_key,
+      build_entry,
+      ttl=settings.catalog_cache_ttl_seconds,
+      stale_ttl=settings.catalog_cache_hard_stale_seconds,
+    )
+  )
+  if unpacked is None:
+    unpacked = _unpack_catalog_entry(await build_entry())
+  etag, version, encoding, payload = unpacked
+
   if if_none_match and if_none_match == etag:
     return _build_not_modified_response(etag)
-  return _build_catalog_response(catalog, etag)
+  return _build_stored_catalog_response(etag, version, encoding, payload, accept_encoding)
+
+
+@router.get("/catalog/changes", response_model=CatalogChangesResponse)
+async def get_catalog_changes(
+  since: str = Query(..., min_length=1, description="Версия из заголовка X-Catalog-Version"),
+  db: AsyncIOMotorDatabase = Depends(get_db),
+):
+  """
+  Возвращает только категории и товары, измененные после версии since.
+  Если журнал изменений не покрывает since, отдается полный каталог
+  с full=true.
+  """
+  catalog, _etag = await fetch_catalog(db)
+  index = _catalog_cache
+  version = _catalog_cache_version
+
+  changes = None
+  if index is not None and version is not None:
+    changes = _catalog_change_log.changes_between(since, version)
+
+  if changes is None:
+    payload = _catalog_to_dict(catalog) | {
+      "version": version,
+      "full": True,
+      "deleted_category_ids": [],
+      "deleted_product_ids": [],
+    }
+  else:
+    changed_categories, changed_products = changes
+    payload = {
+      "version": version,
+      "full": False,
+      "categories": [
+        index.categories[category_id].dict(by_alias=True)
+        for category_id in changed_categories
+        if category_id in index.categories
+      ],
+      "products": [
+        index.products[product_id].dict(by_alias=True)
+        for product_id in changed_products
+        if product_id in index.products
+      ],
+      "deleted_category_ids": sorted(
+        category_id for category_id in changed_categories if category_id not in index.categories
+      ),
+      "deleted_product_ids": sorted(
+        product_id for product_id in changed_products if product_id not in index.products
+      ),
+    }
+
+  headers = {"Cache-Control": "no-cache"}
+  if version:
+    headers["X-Catalog-Version"] = version
+  return Response(content=_dump_json(payload), media_type="application/json", headers=headers)
+
+
+async def _get_catalog_index(db: AsyncIOMotorDatabase) -> CatalogIndex:
+  """Индекс публичного каталога; при отключенном кеше строится на один запрос."""
+  catalog, _etag = await fetch_catalog(db)
+  index = _catalog_cache
+  if index is None:
+    index = CatalogIndex.from_response(catalog)
+  return index
+
+
+def _build_etagged_json_response(etag: str, body: bytes) -> Response:
+  return Response(
+    content=body,
+    media_type="application/json",
+    headers={
+      "ETag": etag,
+      "Cache-Control": _build_cache_control_value(),
+    },
+  )
+
+
+@router.get("/catalog/category/{category_id}", response_model=CategoryDetail)
+async def get_catalog_category(
+  category_id: str,
+  db: AsyncIOMotorDatabase = Depends(get_db),
+  if_none_match: str | None = Header(None, alias="If-None-Match"),
+):
+  """
+  Категория и её доступные товары из кеша каталога.
+  ETag зависит только от этой категории, поэтому изменения в других
+  категориях не сбрасывают клиентский кеш.
+  """
+  index = await _get_catalog_index(db)
+  etag = index.category_etag(category_id)
+  if etag is None:
+    raise HTTPException(status_code=404, detail="Категория не найдена")
+  if if_none_match and if_none_match == etag:
+    return _build_not_modified_response(etag)
+
+  encoded = _category_encoded.get(category_id)
+  if encoded is None or encoded[0] != etag:
+    payload = {
+      "category": index.categories[category_id].dict(by_alias=True),
+      "products": [product.dict(by_alias=True) for product in index.category_products(category_id)],
+    }
+    encoded = (etag, _dump_json(payload))
+    _category_encoded[category_id] = encoded
+  return _build_etagged_json_response(etag, encoded[1])
+
+
+@router.get("/catalog/products", response_model=PaginatedProductsResponse)
+async def list_catalog_products(
+  cursor: str | None = Query(None, description="next_cursor предыдущей страницы"),
+  limit: int = Query(50, ge=1, le=200),
+  category_id: str | None = Query(None),
+  db: AsyncIOMotorDatabase = Depends(get_db),
+  if_none_match: str | None = Header(None, alias="If-None-Match"),
+):
+  """Курсорная пагинация доступных товаров (по возрастанию id) из кеша каталога."""
+  index = await _get_catalog_index(db)
+  products, next_cursor = index.page_products(cursor, limit, category_id=category_id)
+  etag = index.products_etag(products, next_cursor)
+  if if_none_match and if_none_match == etag:
+    return _build_not_modified_response(etag)
+  payload = {
+    "products": [product.dict(by_alias=True) for product in products],
+    "next_cursor": next_cursor,
+  }
+  return _build_etagged_json_response(etag, _dump_json(payload))
+
+
+@router.get("/catalog/search", response_model=CatalogSearchResponse)
+async def search_catalog(
+  q: str = Query(..., min_length=MIN_QUERY_TOKEN_LENGTH, max_length=100),
+  limit: int = Query(20, ge=1, le=100),
+  offset: int = Query(0, ge=0),
+  db: AsyncIOMotorDatabase = Depends(get_db),
+):
+  """
+  Поиск товаров по названию, описанию и названиям вариаций (префиксы и опечатки).
+  total не превышает search_index.MAX_CANDIDATES.
+  """
+  index = await _get_catalog_index(db)
+  search_index = await _get_search_index(index)
+  product_ids, total = search_index.search(q, limit=limit, offset=offset)
+  products = [
+    index.products[product_id].dict(by_alias=True)
+    for product_id in product_ids
+    if product_id in index.products
+  ]
+  next_offset = offset + limit if offset + limit < total else None
+  payload = {"products": products, "total": total, "next_offset": next_offset}
+  return Response(content=_dump_json(payload), media_type="application/json")
 
 
 @router.get("/admin/catalog", response_model=CatalogResponse)
@@ -426,10 +1117,20 @@ async def get_admin_catalog(
   ETag/304 здесь отключены, чтобы администраторы сразу видели изменения
   без зависимости от клиентского/прокси кэширования.
   """
+  global _admin_catalog_encoded
   try:
-    # Админка загружает все товары, включая недоступные
-    catalog, etag = await fetch_catalog(db, force_refresh=True, only_available=False)
-    response = _build_catalog_response(catalog, etag)
+    # Админка загружает все товары, включая недоступные, из собственного кеша
+    index = await fetch_admin_catalog(db)
+    etag = index.etag
+    encoded = _admin_catalog_encoded
+    if encoded is None or encoded[0] != etag:
+      encoded = (etag, _dump_json(_catalog_to_dict(index.to_response())))
+      _admin_catalog_encoded = encoded
+    response = Response(
+      content=encoded[1],
+      media_type="application/json",
+      headers={"ETag": etag},
+    )
     # Админке всегда нужен свежий ответ, поэтому блокируем кэш.
     response.headers["Cache-Control"] = "no-store, max-age=0"
     response.headers["Pragma"] = "no-cache"
@@ -449,17 +1150,15 @@ async def get_admin_category_detail(
   db: AsyncIOMotorDatabase = Depends(get_db),
   _admin_id: int = Depends(verify_admin),
 ):
-  category_doc = await db.categories.find_one({"_id": {"$in": _build_id_candidates(category_id)}})
+  # category_id товаров хранится строкой (см. migrations.py), поэтому
+  # категория и её товары читаются параллельно запросами по индексу
+  category_doc, products_docs = await asyncio.gather(
+    db.categories.find_one(_category_filter(category_id)),
+    db.products.find(_category_products_filter(category_id)).to_list(length=None),
+  )
   if not category_doc:
     raise HTTPException(status_code=404, detail="Категория не найдена")
 
-  candidate_values = set(_build_id_candidates(category_id))
-  if category_doc.get("_id"):
-    candidate_values.add(str(category_doc["_id"]))
-
-  products_cursor = db.products.find({"category_id": {"$in": list(candidate_values)}})
-  products_docs = await products_cursor.to_list(length=None)
-
   category_model = Category(**serialize_doc(category_doc) | {"id": str(category_doc["_id"])})
   products_models = []
   for doc in products_docs:
@@ -471,13 +1170,24 @@ async def get_admin_category_detail(
   return CategoryDetail(category=category_model, products=products_models)
 
 
-def _build_id_candidates(raw_id: str) -> Sequence[object]:
-  candidates: set[object] = {raw_id}
-  if ObjectId.is_valid(raw_id):
-    oid = ObjectId(raw_id)
-    candidates.add(oid)
-    candidates.add(str(oid))
-  return list(candidates)
+def _normalize_category_id(raw_id: str) -> str:
+  """Строковая форма id категории, в которой он хранится в products.category_id."""
+  return str(ObjectId(raw_id)) if ObjectId.is_valid(raw_id) else raw_id
+
+
+def _category_products_filter(raw_id: str) -> dict:
+  """
+  Фильтр товаров категории. Пока миграция category_id не отмечена
+  завершенной, у части товаров id категории еще хранится как ObjectId.
+  """
+  category_id = _normalize_category_id(raw_id)
+  if is_migration_completed(CATEGORY_IDS_MIGRATION) or not ObjectId.is_valid(category_id):
+    return {"category_id": category_id}
+  return {"category_id": {"$in": [category_id, ObjectId(category_id)]}}
+
+
+def _category_filter(raw_id: str) -> dict:
+  return {"_id": ObjectId(raw_id) if ObjectId.is_valid(raw_id) else raw_id}
 
 
 @router.post(
@@ -502,11 +1212,11 @@ async def create_category(
   doc = await db.categories.find_one({"_id": result.inserted_id})
   if not doc:
     raise HTTPException(status_code=500, detail="Ошибка при создании категории")
-  await invalidate_catalog_cache(db)
-  await _refresh_catalog_cache(db)
+  created_category = Category(**serialize_doc(doc) | {"id": str(doc["_id"])})
+  await _patch_catalog_cache(db, lambda index: index.upsert_category(created_category))
   if settings.environment != "production":
-  logger.info("Admin %s created category %s (%s)", _admin_id, doc.get("name"), doc.get("_id"))
-  return Category(**serialize_doc(doc) | {"id": str(doc["_id"])})
+    logger.info("Admin %s created category %s (%s)", _admin_id, doc.get("name"), doc.get("_id"))
+  return created_category
 
 
 @router.patch("/admin/category/{category_id}", response_model=Category)
@@ -520,7 +1230,7 @@ async def update_category(
   if not update_data:
     raise HTTPException(status_code=400, detail="Нет данных для обновления")
 
-  category_doc = await db.categories.find_one({"_id": {"$in": _build_id_candidates(category_id)}})
+  category_doc = await db.categories.find_one(_category_filter(category_id))
   if not category_doc:
     raise HTTPException(status_code=404, detail="Категория не найдена")
 
@@ -543,11 +1253,11 @@ async def update_category(
   )
   if not result:
     raise HTTPException(status_code=404, detail="Категория не найдена")
-  await invalidate_catalog_cache(db)
-  await _refresh_catalog_cache(db)
+  updated_category = Category(**serialize_doc(result) | {"id": str(result["_id"])})
+  await _patch_catalog_cache(db, lambda index: index.upsert_category(updated_category))
   if settings.environment != "production":
-  logger.info("Admin %s updated category %s (%s)", _admin_id, result.get("name"), result.get("_id"))
-  return Category(**serialize_doc(result) | {"id": str(result["_id"])})
+    logger.info("Admin %s updated category %s (%s)", _admin_id, result.get("name"), result.get("_id"))
+  return updated_category
 
 
 @router.delete(
@@ -559,33 +1269,24 @@ async def delete_category(
   db: AsyncIOMotorDatabase = Depends(get_db),
   _admin_id: int = Depends(verify_admin),
 ):
-  category_doc = await db.categories.find_one({"_id": {"$in": _build_id_candidates(category_id)}})
+  category_doc = await db.categories.find_one(_category_filter(category_id))
   if not category_doc:
     raise HTTPException(status_code=404, detail="Категория не найдена")
 
-  cleanup_values: set[object] = {
-    category_id,
-    str(category_doc["_id"]),
-  }
-  if isinstance(category_doc["_id"], ObjectId):
-    cleanup_values.add(category_doc["_id"])
-
-  await db.products.delete_many({"category_id": {"$in": list(cleanup_values)}})
+  await db.products.delete_many(_category_products_filter(str(category_doc["_id"])))
 
   delete_result = await db.categories.delete_one({"_id": category_doc["_id"]})
   if delete_result.deleted_count == 0:
     raise HTTPException(status_code=404, detail="Категория не найдена")
 
-  await invalidate_catalog_cache(db)
-  await _refresh_catalog_cache(db)
+  await _patch_catalog_cache(db, lambda index: index.remove_category(str(category_doc["_id"])))
   if settings.environment != "production":
-  logger.info(
-    "Admin %s deleted category %s (%s) cleanup_values=%s",
-    _admin_id,
-    category_doc.get("name"),
-    category_doc.get("_id"),
-    list(cleanup_values),
-  )
+    logger.info(
+      "Admin %s deleted category %s (%s)",
+      _admin_id,
+      category_doc.get("name"),
+      category_doc.get("_id"),
+    )
   return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -603,12 +1304,12 @@ async def create_product(
   if not category:
     raise HTTPException(status_code=400, detail="Категория не найдена")
   data = payload.dict()
+  data["category_id"] = str(category["_id"])
   if data.get("images"):
     data["image"] = data["images"][0]
   result = await db.products.insert_one(data)
   doc = await db.products.find_one({"_id": result.inserted_id})
-  await invalidate_catalog_cache(db)
-  await _refresh_catalog_cache(db)
+  await _patch_catalog_cache(db, lambda index: _patch_catalog_product(index, doc))
   return Product(**serialize_doc(doc) | {"id": str(doc["_id"])})
 
 
@@ -624,6 +1325,7 @@ async def update_product(
     category = await db.categories.find_one({"_id": as_object_id(update_payload["category_id"])})
     if not category:
       raise HTTPException(status_code=400, detail="Категория не найдена")
+    update_payload["category_id"] = str(category["_id"])
   if "images" in update_payload and update_payload["images"]:
     update_payload["image"] = update_payload["images"][0]
   doc = await db.products.find_one_and_update(
@@ -633,8 +1335,7 @@ async def update_product(
   )
   if not doc:
     raise HTTPException(status_code=404, detail="Товар не найден")
-  await invalidate_catalog_cache(db)
-  await _refresh_catalog_cache(db)
+  await _patch_catalog_cache(db, lambda index: _patch_catalog_product(index, doc))
   return Product(**serialize_doc(doc) | {"id": str(doc["_id"])})
 
 
@@ -650,7 +1351,217 @@ async def delete_product(
   result = await db.products.delete_one({"_id": as_object_id(product_id)})
   if result.deleted_count == 0:
     raise HTTPException(status_code=404, detail="Товар не найден")
-  await invalidate_catalog_cache(db)
-  await _refresh_catalog_cache(db)
+  await _patch_catalog_cache(db, lambda index: index.remove_product(product_id))
   return {"status": "ok"}
 
+
+
+def _parse_bulk_rows(body: bytes, content_type: str) -> List[object]:
+  """
+  Разбирает тело POST /admin/products/bulk: NDJSON (операция на строку)
+  или JSON (список операций либо {"operations": [...]}).
+  Нераспарсенные строки NDJSON возвращаются как исключения, чтобы ошибка
+  попала в результат своей строки, а не отменила весь импорт.
+  """
+  if "ndjson" in content_type or "jsonl" in content_type:
+    rows: List[object] = []
+    for line in body.splitlines():
+      if not line.strip():
+        continue
+      try:
+        rows.append(orjson.loads(line))
+      except ValueError as e:
+        rows.append(e)
+    return rows
+
+  try:
+    payload = orjson.loads(body) if body else []
+  except ValueError:
+    raise HTTPException(status_code=400, detail="Некорректный JSON")
+  if isinstance(payload, dict):
+    payload = payload.get("operations")
+  if not isinstance(payload, list):
+    raise HTTPException(status_code=400, detail="Ожидается список операций")
+  return payload
+
+
+def _format_validation_error(error: ValidationError) -> str:
+  return "; ".join(
+    f"{'.'.join(str(part) for part in item['loc'])}: {item['msg']}"
+    for item in error.errors()
+  )
+
+
+@router.post("/admin/products/bulk", response_model=BulkProductsResponse)
+async def bulk_products(
+  request: Request,
+  db: AsyncIOMotorDatabase = Depends(get_db),
+  _admin_id: int = Depends(verify_admin),
+):
+  """
+  Массовое создание, изменение и удаление товаров одним unordered bulk_write.
+  Ошибки возвращаются по строкам, каталог инвалидируется один раз в конце.
+  """
+  rows = _parse_bulk_rows(await request.body(), request.headers.get("content-type", ""))
+  if len(rows) > settings.products_bulk_max_operations:
+    raise HTTPException(
+      status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+      detail=f"Не более {settings.products_bulk_max_operations} операций за запрос",
+    )
+
+  results = [BulkProductRowResult(index=position) for position in range(len(rows))]
+
+  def fail(position: int, error: str) -> None:
+    results[position].ok = False
+    results[position].error = error
+
+  # Валидация строк; id товаров и категорий собираются для двух общих запросов
+  operations: List[Tuple[int, BulkProductOperation, ObjectId, dict | None]] = []
+  # Значения по умолчанию для upsert: пишутся только при вставке ($setOnInsert),
+  # чтобы не затирать поля существующего товара, которых нет в строке
+  upsert_defaults: dict[int, dict] = {}
+  touched_ids: set[ObjectId] = set()
+  category_ids: set[str] = set()
+  for position, row in enumerate(rows):
+    if isinstance(row, Exception):
+      fail(position, f"Некорректный JSON: {row}")
+      continue
+    try:
+      operation = BulkProductOperation.parse_obj(row)
+    except ValidationError as e:
+      fail(position, _format_validation_error(e))
+      continue
+    results[position].op = operation.op.value
+    results[position].id = operation.id
+
+    if operation.id is not None and not ObjectId.is_valid(operation.id):
+      fail(position, "Некорректный id товара")
+      continue
+    if operation.id is None and operation.op != BulkProductOp.CREATE:
+      fail(position, "Не указан id товара")
+      continue
+    product_oid = ObjectId(operation.id) if operation.id else ObjectId()
+    # unordered bulk_write не гарантирует порядок, поэтому один товар - одна операция
+    if product_oid in touched_ids:
+      fail(position, "Товар уже изменяется другой операцией этого запроса")
+      continue
+
+    data: dict | None = None
+    try:
+      if operation.op == BulkProductOp.UPDATE:
+        data = ProductUpdate.parse_obj(operation.data or {}).dict(exclude_unset=True)
+        if not data:
+          fail(position, "Нет данных для обновления")
+          continue
+      elif operation.op == BulkProductOp.UPSERT:
+        product = ProductCreate.parse_obj(operation.data or {})
+        data = product.dict(exclude_unset=True)
+        upsert_defaults[position] = {
+          key: value for key, value in product.dict().items() if key not in data
+        }
+      elif operation.op != BulkProductOp.DELETE:
+        data = ProductCreate.parse_obj(operation.data or {}).dict()
+    except ValidationError as e:
+      fail(position, _format_validation_error(e))
+      continue
+
+    if data is not None:
+      if data.get("images"):
+        data["image"] = data["images"][0]
+        upsert_defaults.get(position, {}).pop("image", None)
+      if data.get("category_id") is not None:
+        data["category_id"] = _normalize_category_id(data["category_id"])
+        category_ids.add(data["category_id"])
+
+    touched_ids.add(product_oid)
+    results[position].id = str(product_oid)
+    operations.append((position, operation, product_oid, data))
+
+  # Категории и существующие товары проверяются двумя запросами на весь импорт
+  existing_oids = [
+    product_oid
+    for _, operation, product_oid, _ in operations
+    if operation.op in (BulkProductOp.UPDATE, BulkProductOp.DELETE)
+  ]
+  categories_docs, existing_docs = await asyncio.gather(
+    db.categories.find(
+      {"_id": {"$in": [_category_filter(category_id)["_id"] for category_id in category_ids]}},
+      {"_id": 1},
+    ).to_list(length=None),
+    db.products.find({"_id": {"$in": existing_oids}}, {"_id": 1}).to_list(length=None),
+  )
+  known_categories = {str(doc["_id"]) for doc in categories_docs}
+  existing_products = {doc["_id"] for doc in existing_docs}
+
+  writes: List[Tuple[int, BulkProductOperation, object]] = []
+  for position, operation, product_oid, data in operations:
+    if data is not None and data.get("category_id") is not None and data["category_id"] not in known_categories:
+      fail(position, "Категория не найдена")
+      continue
+    if operation.op in (BulkProductOp.UPDATE, BulkProductOp.DELETE) and product_oid not in existing_products:
+      fail(position, "Товар не найден")
+      continue
+    if operation.op == BulkProductOp.CREATE:
+      write = InsertOne({"_id": product_oid, **data})
+    elif operation.op == BulkProductOp.DELETE:
+      write = DeleteOne({"_id": product_oid})
+    elif operation.op == BulkProductOp.UPSERT:
+      update = {"$set": data}
+      if upsert_defaults.get(position):
+        update["$setOnInsert"] = upsert_defaults[position]
+      write = UpdateOne({"_id": product_oid}, update, upsert=True)
+    else:
+      write = UpdateOne({"_id": product_oid}, {"$set": data})
+    writes.append((position, operation, write))
+
+  # Номера операций (в списке writes), которые upsert выполнил вставкой
+  upserted_writes: set[int] = set()
+  if writes:
+    try:
+      result = await db.products.bulk_write([write for _, _, write in writes], ordered=False)
+      upserted_writes = set(result.upserted_ids or {})
+    except BulkWriteError as e:
+      upserted_writes = {item["index"] for item in e.details.get("upserted", [])}
+      for write_error in e.details.get("writeErrors", []):
+        fail(writes[write_error["index"]][0], write_error.get("errmsg") or "Ошибка записи")
+
+  response = BulkProductsResponse(results=results)
+  changed_oids: List[ObjectId] = []
+  deleted_ids: List[str] = []
+  for write_index, (position, operation, _) in enumerate(writes):
+    result = results[position]
+    if not result.ok:
+      continue
+    if operation.op == BulkProductOp.DELETE:
+      response.deleted += 1
+      deleted_ids.append(result.id)
+    else:
+      if operation.op == BulkProductOp.CREATE or write_index in upserted_writes:
+        response.created += 1
+      else:
+        response.updated += 1
+      changed_oids.append(ObjectId(result.id))
+  response.failed = sum(1 for result in results if not result.ok)
+
+  if changed_oids or deleted_ids:
+    changed_docs = await db.products.find({"_id": {"$in": changed_oids}}).to_list(length=None) if changed_oids else []
+
+    def apply_bulk(index: CatalogIndex) -> None:
+      for doc in changed_docs:
+        _patch_catalog_product(index, doc)
+      for product_id in deleted_ids:
+        index.remove_product(product_id)
+
+    # Одна версия каталога и одно оповещение воркеров на весь импорт
+    await _patch_catalog_cache(db, apply_bulk)
+
+  if settings.environment != "production":
+    logger.info(
+      "Admin %s bulk products: created=%s updated=%s deleted=%s failed=%s",
+      _admin_id,
+      response.created,
+      response.updated,
+      response.deleted,
+      response.failed,
+    )
+  return response
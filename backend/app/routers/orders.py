@@ -16,6 +16,7 @@ from fastapi import (
 )
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
+from .. import cart_store
 from ..config import settings
 from ..database import get_db
 from ..schemas import (
@@ -27,11 +28,12 @@ from ..schemas import (
 from ..utils import as_object_id, serialize_doc, get_gridfs, ensure_store_is_awake
 from ..security import TelegramUser, get_current_user
 from ..notifications import notify_admins_new_order
+from ..reservations import drop_reservations
 
 router = APIRouter(tags=["orders"])
 
 async def get_cart(db: AsyncIOMotorDatabase, user_id: int) -> Cart | None:
-  cart = await db.carts.find_one({"user_id": user_id})
+  cart = await cart_store.load_cart(db, user_id)
   if not cart or not cart.get("items"):
     return None
   return Cart(**serialize_doc(cart) | {"id": str(cart["_id"])})
@@ -186,7 +188,10 @@ async def create_order(
     raise
 
   # Удаляем корзину и получаем заказ параллельно
-  cart_delete_task = db.carts.delete_one({"_id": as_object_id(cart.id)})
+  cart_delete_task = asyncio.gather(
+    cart_store.delete_cart(db, user_id),
+    drop_reservations(db, user_id),
+  )
   order_doc_task = db.orders.find_one({"_id": result.inserted_id})
   await cart_delete_task  # Ждем только удаление корзины
   doc = await order_doc_task
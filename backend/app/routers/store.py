@@ -1,7 +1,6 @@
 import asyncio
 import json
-from datetime import datetime, timedelta
-from typing import Optional
+from datetime import datetime
 
 from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.responses import StreamingResponse
@@ -9,8 +8,10 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo.errors import ServerSelectionTimeoutError, ConnectionFailure
 
 from ..auth import verify_admin
+from ..cache import TieredCache
 from ..database import get_db
 from ..schemas import StoreSleepRequest, StoreStatus, PaymentLinkRequest
+from ..utils import invalidate_store_awake_cache
 
 router = APIRouter(tags=["store"])
 
@@ -40,27 +41,27 @@ class StoreStatusBroadcaster:
 
 store_status_broadcaster = StoreStatusBroadcaster()
 
-# Простое in-memory кеширование для статуса магазина
-_cache: Optional[dict] = None
-_cache_expires_at: Optional[datetime] = None
-_cache_ttl_seconds = 30  # Увеличено до 30 секунд для максимальной производительности
+# Статус магазина - один документ, кешируется в памяти процесса (L1)
+_store_status_cache = TieredCache("store_status", maxsize=1, ttl=30.0)  # 30 секунд для максимальной производительности
+_STORE_STATUS_KEY = "current"
 
 
 async def get_or_create_store_status(db: AsyncIOMotorDatabase, use_cache: bool = True):
   """
   Получает или создает статус магазина с опциональным кешированием.
+  Одновременные промахи кеша выполняют один запрос к БД.
   
   Args:
     db: Подключение к БД
     use_cache: Использовать ли кеш (по умолчанию True)
   """
-  global _cache, _cache_expires_at
-  
-  # Проверяем кеш, если он включен
-  if use_cache and _cache is not None and _cache_expires_at is not None:
-    if datetime.utcnow() < _cache_expires_at:
-      return _cache.copy()
-  
+  if not use_cache:
+    return await _load_store_status(db)
+  doc = await _store_status_cache.get_or_load(_STORE_STATUS_KEY, lambda: _load_store_status(db))
+  return doc.copy()
+
+
+async def _load_store_status(db: AsyncIOMotorDatabase) -> dict:
   try:
     doc = await db.store_status.find_one({})
     if not doc:
@@ -73,10 +74,6 @@ async def get_or_create_store_status(db: AsyncIOMotorDatabase, use_cache: bool =
       }
       result = await db.store_status.insert_one(status_doc)
       status_doc["_id"] = result.inserted_id
-      # Обновляем кеш
-      if use_cache:
-        _cache = status_doc.copy()
-        _cache_expires_at = datetime.utcnow() + timedelta(seconds=_cache_ttl_seconds)
       return status_doc
     if "payment_link" not in doc:
       await db.store_status.update_one(
@@ -90,11 +87,6 @@ async def get_or_create_store_status(db: AsyncIOMotorDatabase, use_cache: bool =
     if doc.get("is_sleep_mode") and doc.get("sleep_until"):
       doc = await _ensure_awake_if_needed(db, doc)
     
-    # Обновляем кеш
-    if use_cache:
-      _cache = doc.copy()
-      _cache_expires_at = datetime.utcnow() + timedelta(seconds=_cache_ttl_seconds)
-    
     return doc
   except (ServerSelectionTimeoutError, ConnectionFailure) as e:
     raise HTTPException(
@@ -104,10 +96,9 @@ async def get_or_create_store_status(db: AsyncIOMotorDatabase, use_cache: bool =
 
 
 def _invalidate_cache():
-  """Инвалидирует кеш статуса магазина."""
-  global _cache, _cache_expires_at
-  _cache = None
-  _cache_expires_at = None
+  """Инвалидирует кеш статуса магазина (и кеш проверки в ensure_store_is_awake)."""
+  _store_status_cache.invalidate_local()
+  invalidate_store_awake_cache()
 
 
 @router.get("/store/status", response_model=StoreStatus)
@@ -12,6 +12,14 @@ class PyObjectId(str):
     def __get_validators__(cls):
         yield cls.validate
 
+    @classmethod
+    def __get_pydantic_core_schema__(cls, _source_type, _handler):
+        # pydantic 2 вызывает валидаторы из __get_validators__ с дополнительным
+        # аргументом info, поэтому для него схема задается отдельно
+        from pydantic_core import core_schema
+
+        return core_schema.no_info_before_validator_function(cls.validate, core_schema.str_schema())
+
     @classmethod
     def validate(cls, v):
         from bson import ObjectId
@@ -77,11 +85,74 @@ class Product(ProductBase):
         extra = "allow"  # Разрешаем дополнительные поля из базы данных
 
 
+class BulkProductOp(str, Enum):
+    CREATE = "create"
+    UPDATE = "update"
+    UPSERT = "upsert"
+    DELETE = "delete"
+
+
+class BulkProductOperation(BaseModel):
+    op: BulkProductOp
+    id: Optional[str] = None  # Обязателен для update, upsert и delete
+    data: Optional[dict] = None  # Поля ProductCreate (create/upsert) или ProductUpdate (update)
+
+
+class BulkProductRowResult(BaseModel):
+    index: int  # Номер операции во входных данных (с нуля)
+    op: Optional[str] = None
+    id: Optional[str] = None
+    ok: bool = True
+    error: Optional[str] = None
+
+
+class BulkProductsResponse(BaseModel):
+    created: int = 0
+    updated: int = 0
+    deleted: int = 0
+    failed: int = 0
+    results: List[BulkProductRowResult] = Field(default_factory=list)
+
+
 class CatalogResponse(BaseModel):
     categories: List[Category]
     products: List[Product]
 
 
+class ProductLite(BaseModel):
+    id: str
+    name: str
+    price: float
+    image: Optional[str] = None
+    available: bool = True
+    category_id: str
+
+
+class CatalogLiteResponse(BaseModel):
+    categories: List[Category]
+    products: List[ProductLite]
+
+
+class PaginatedProductsResponse(BaseModel):
+    products: List[Product]
+    next_cursor: Optional[str] = None
+
+
+class CatalogSearchResponse(BaseModel):
+    products: List[Product]
+    total: int = 0
+    next_offset: Optional[int] = None
+
+
+class CatalogChangesResponse(BaseModel):
+    version: Optional[str] = None
+    full: bool = False  # True - в categories/products весь каталог, а не дельта
+    categories: List[Category] = Field(default_factory=list)
+    products: List[Product] = Field(default_factory=list)
+    deleted_category_ids: List[str] = Field(default_factory=list)
+    deleted_product_ids: List[str] = Field(default_factory=list)
+
+
 class CartItem(BaseModel):
     id: str
     product_id: str
@@ -118,6 +189,24 @@ class UpdateCartItemRequest(BaseModel):
     quantity: int = Field(..., ge=1, le=50)
 
 
+class CartBatchOp(str, Enum):
+    ADD = "add"
+    SET_QUANTITY = "set_quantity"
+    REMOVE = "remove"
+
+
+class CartBatchOperation(BaseModel):
+    op: CartBatchOp
+    product_id: Optional[str] = None  # Для add
+    variant_id: Optional[str] = None  # Для add
+    item_id: Optional[str] = None  # Для set_quantity и remove
+    quantity: Optional[int] = Field(None, ge=1, le=50)  # Для add и set_quantity
+
+
+class CartBatchRequest(BaseModel):
+    operations: List[CartBatchOperation]
+
+
 class OrderStatus(str, Enum):
     NEW = "новый"
     PROCESSING = "в обработке"
@@ -0,0 +1,271 @@
+"""
+Поисковый индекс товаров каталога в памяти процесса.
+
+Инвертированный индекс по токенам name, description и названиям вариаций:
+префиксный поиск идет по отсортированному списку токенов (bisect),
+а для опечаток используется сопоставление по триграммам.
+"""
+
+import heapq
+import re
+from bisect import bisect_left, insort
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+from .schemas import Product
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Вес поля в релевантности: совпадение в названии важнее описания
+_NAME_WEIGHT = 3
+_VARIANT_WEIGHT = 2
+_DESCRIPTION_WEIGHT = 1
+
+# Множители по типу совпадения токена запроса
+_EXACT_MATCH = 3
+_PREFIX_MATCH = 2
+_TRIGRAM_MATCH = 1
+
+# Минимальная доля общих триграмм, чтобы считать токены похожими
+_TRIGRAM_THRESHOLD = 0.35
+
+# Токены запроса короче этой длины отбрасываются: однобуквенный префикс
+# совпадает почти со всем каталогом
+MIN_QUERY_TOKEN_LENGTH = 2
+
+# Поиск выполняется в event loop, поэтому перебор ограничен: ранжируется
+# не больше MAX_CANDIDATES найденных товаров (total ограничен им же),
+# а проверяется не больше _MAX_SCANNED товаров с самым редким токеном запроса
+MAX_CANDIDATES = 500
+_MAX_SCANNED = 2000
+
+# Если токен запроса совпал не больше чем с таким числом токенов индекса,
+# товары проверяются по его спискам, а не перебором токенов товара
+_MAX_POSTING_CHECKS = 8
+
+def normalize_text(text: str) -> str:
+  """Регистронезависимая форма текста; ё и е считаются одной буквой."""
+  return text.casefold().replace("ё", "е")
+
+
+def tokenize(text: str | None) -> List[str]:
+  if not text or not isinstance(text, str):
+    return []
+  return _TOKEN_RE.findall(normalize_text(text))
+
+
+def _trigrams(token: str) -> Set[str]:
+  padded = f"  {token} "
+  return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _product_fields(product: Product) -> Iterable[Tuple[str | None, int]]:
+  yield product.name, _NAME_WEIGHT
+  yield product.description, _DESCRIPTION_WEIGHT
+  for variant in product.variants or []:
+    if isinstance(variant, dict):
+      yield variant.get("name"), _VARIANT_WEIGHT
+
+
+class ProductSearchIndex:
+  def __init__(self, products: Iterable[Product] = ()):
+    # токен -> вес поля -> id товаров: кандидаты перебираются от лучших совпадений
+    self._postings: Dict[str, Dict[int, Set[str]]] = {}
+    self._sorted_tokens: List[str] = []
+    # триграмма -> токены, в которых она встречается
+    self._trigram_tokens: Dict[str, Set[str]] = {}
+    # товар -> {токен: вес поля}
+    self._product_tokens: Dict[str, Dict[str, int]] = {}
+    self._product_names: Dict[str, str] = {}
+    # При первичной загрузке токены сортируются один раз в конце, а не insort на каждый
+    self._bulk_loading = True
+    for product in products:
+      self.add(product)
+    self._sorted_tokens.sort()
+    self._bulk_loading = False
+
+  def __len__(self) -> int:
+    return len(self._product_tokens)
+
+  def add(self, product: Product) -> None:
+    """Добавляет или переиндексирует товар."""
+    if product.id in self._product_tokens:
+      self.remove(product.id)
+    weights: Dict[str, int] = {}
+    for text, weight in _product_fields(product):
+      for token in tokenize(text):
+        if weights.get(token, 0) < weight:
+          weights[token] = weight
+    for token, weight in weights.items():
+      posting = self._postings.get(token)
+      if posting is None:
+        posting = self._postings[token] = {}
+        if self._bulk_loading:
+          self._sorted_tokens.append(token)
+        else:
+          insort(self._sorted_tokens, token)
+        for trigram in _trigrams(token):
+          self._trigram_tokens.setdefault(trigram, set()).add(token)
+      posting.setdefault(weight, set()).add(product.id)
+    self._product_tokens[product.id] = weights
+    self._product_names[product.id] = normalize_text(product.name)
+
+  def remove(self, product_id: str) -> None:
+    tokens = self._product_tokens.pop(product_id, None)
+    self._product_names.pop(product_id, None)
+    if not tokens:
+      return
+    for token, weight in tokens.items():
+      posting = self._postings.get(token)
+      if posting is None:
+        continue
+      product_ids = posting.get(weight)
+      if product_ids is not None:
+        product_ids.discard(product_id)
+        if not product_ids:
+          del posting[weight]
+      if posting:
+        continue
+      # Токен больше не встречается - убираем его из всех структур
+      del self._postings[token]
+      position = bisect_left(self._sorted_tokens, token)
+      if position < len(self._sorted_tokens) and self._sorted_tokens[position] == token:
+        del self._sorted_tokens[position]
+      for trigram in _trigrams(token):
+        trigram_tokens = self._trigram_tokens.get(trigram)
+        if trigram_tokens is not None:
+          trigram_tokens.discard(token)
+          if not trigram_tokens:
+            del self._trigram_tokens[trigram]
+
+  def _match_token(self, query_token: str) -> Dict[str, int]:
+    """Возвращает {токен индекса: множитель совпадения} для одного токена запроса."""
+    matches: Dict[str, int] = {}
+    position = bisect_left(self._sorted_tokens, query_token)
+    while position < len(self._sorted_tokens):
+      token = self._sorted_tokens[position]
+      if not token.startswith(query_token):
+        break
+      matches[token] = _EXACT_MATCH if token == query_token else _PREFIX_MATCH
+      position += 1
+
+    if matches or len(query_token) < 3:
+      return matches
+
+    # Префиксных совпадений нет - ищем похожие токены по триграммам (опечатки)
+    query_trigrams = _trigrams(query_token)
+    shared: Dict[str, int] = {}
+    for trigram in query_trigrams:
+      for token in self._trigram_tokens.get(trigram, ()):
+        shared[token] = shared.get(token, 0) + 1
+    for token, count in shared.items():
+      if count / len(query_trigrams | _trigrams(token)) >= _TRIGRAM_THRESHOLD:
+        matches[token] = _TRIGRAM_MATCH
+    return matches
+
+  def _posting_size(self, matches: Dict[str, int]) -> int:
+    return sum(
+      len(product_ids)
+      for token in matches
+      for product_ids in self._postings[token].values()
+    )
+
+  def _collect_candidates(self, matches: Dict[str, int], other_matches: List[Dict[str, int]]) -> Dict[str, int]:
+    """
+    Товары, в которых найдены все токены запроса: {id товара: очки}.
+    Кандидаты берутся по первому токену от лучших совпадений к худшим,
+    остальные токены проверяются по токенам самого товара.
+    """
+    tiers = sorted(
+      (
+        (weight * multiplier, token, weight)
+        for token, multiplier in matches.items()
+        for weight in self._postings[token]
+      ),
+      key=lambda tier: -tier[0],
+    )
+    scorers = [self._scorer(other) for other in other_matches]
+    seen: Set[str] = set()
+    totals: Dict[str, int] = {}
+    for score, token, weight in tiers:
+      for product_id in self._postings[token][weight]:
+        if product_id in seen:
+          continue
+        seen.add(product_id)
+        total = score
+        for scorer in scorers:
+          other_score = scorer(product_id)
+          if not other_score:
+            break
+          total += other_score
+        else:
+          totals[product_id] = total
+          if len(totals) >= MAX_CANDIDATES:
+            return totals
+        if len(seen) >= _MAX_SCANNED:
+          return totals
+    return totals
+
+  def _scorer(self, matches: Dict[str, int]) -> Callable[[str], int]:
+    """Функция очков товара по одному токену запроса (0 - токен не найден)."""
+    if len(matches) <= _MAX_POSTING_CHECKS:
+      tiers = sorted(
+        (
+          (weight * multiplier, product_ids)
+          for token, multiplier in matches.items()
+          for weight, product_ids in self._postings[token].items()
+        ),
+        key=lambda tier: -tier[0],
+      )
+
+      def score_by_postings(product_id: str) -> int:
+        for score, product_ids in tiers:
+          if product_id in product_ids:
+            return score
+        return 0
+
+      return score_by_postings
+
+    def score_by_product_tokens(product_id: str) -> int:
+      best = 0
+      for token, weight in self._product_tokens[product_id].items():
+        multiplier = matches.get(token)
+        if multiplier is not None and weight * multiplier > best:
+          best = weight * multiplier
+      return best
+
+    return score_by_product_tokens
+
+  def search(self, query: str, limit: int = 20, offset: int = 0) -> Tuple[List[str], int]:
+    """
+    Ищет товары, в которых найдены все токены запроса.
+    Возвращает id товаров страницы (по убыванию релевантности) и число
+    найденных - не больше MAX_CANDIDATES.
+    """
+    query_tokens = [
+      token
+      for token in dict.fromkeys(tokenize(query))
+      if len(token) >= MIN_QUERY_TOKEN_LENGTH
+    ]
+    if not query_tokens:
+      return [], 0
+
+    token_matches = []
+    for query_token in query_tokens:
+      matches = self._match_token(query_token)
+      if not matches:
+        return [], 0
+      token_matches.append(matches)
+
+    # Кандидатов дает самый редкий токен: так меньше товаров нужно проверить
+    token_matches.sort(key=self._posting_size)
+    totals = self._collect_candidates(token_matches[0], token_matches[1:])
+    if not totals:
+      return [], 0
+
+    # Частичная сортировка: нужна только текущая страница, а не весь список
+    ranked = heapq.nsmallest(
+      offset + limit,
+      totals.items(),
+      key=lambda item: (-item[1], self._product_names.get(item[0], ""), item[0]),
+    )
+    return [product_id for product_id, _score in ranked[offset:]], len(totals)
@@ -1,10 +1,13 @@
 import asyncio
+from typing import Dict, Iterable, Tuple
+
 from bson import ObjectId
 from fastapi import HTTPException, status
 from gridfs import GridFS
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
 
+from .cache import TieredCache
 from .config import settings
 
 _sync_client: MongoClient | None = None
@@ -114,6 +117,31 @@ async def decrement_variant_quantity(
   )
 
 
+async def reserve_variant_quantity(
+  db: AsyncIOMotorDatabase,
+  product_oid: ObjectId,
+  variant_id: str,
+  quantity: int,
+  projection: dict | None = None,
+  session=None,
+) -> dict | None:
+  """
+  Списывает товар со склада одним условным обновлением и возвращает
+  документ товара (с учетом projection) или None, если товара, вариации
+  или нужного количества нет.
+  """
+  return await db.products.find_one_and_update(
+    {
+      "_id": product_oid,
+      "variants": {"$elemMatch": {"id": variant_id, "quantity": {"$gte": quantity}}},
+    },
+    {"$inc": {"variants.$.quantity": -quantity}},
+    projection=projection,
+    return_document=ReturnDocument.AFTER,
+    session=session,
+  )
+
+
 async def restore_variant_quantity(
   db: AsyncIOMotorDatabase,
   product_id: str,
@@ -132,6 +160,101 @@ async def restore_variant_quantity(
   )
 
 
+StockKey = Tuple[str, str]
+
+
+def _merge_stock_lines(items: Iterable[dict]) -> Dict[StockKey, int]:
+  """Суммирует количество по (product_id, variant_id); позиции без вариации пропускаются."""
+  lines: Dict[StockKey, int] = {}
+  for item in items:
+    product_id = item.get("product_id")
+    variant_id = item.get("variant_id")
+    quantity = item.get("quantity") or 0
+    if not product_id or not variant_id or quantity <= 0:
+      continue
+    key = (product_id, variant_id)
+    lines[key] = lines.get(key, 0) + quantity
+  return lines
+
+
+def _stock_restore_update(product_oid: ObjectId, variant_id: str, quantity: int) -> UpdateOne:
+  return UpdateOne(
+    {"_id": product_oid, "variants.id": variant_id},
+    {"$inc": {"variants.$.quantity": quantity}},
+  )
+
+
+async def restore_variant_quantities(
+  db: AsyncIOMotorDatabase,
+  items: Iterable[dict],
+) -> Dict[StockKey, bool]:
+  """
+  Возвращает на склад товары нескольких позиций одним неупорядоченным
+  bulk_write. Результат - {(product_id, variant_id): вернулся ли товар};
+  False получают позиции, товара или вариации которых больше нет.
+  """
+  lines = _merge_stock_lines(items)
+  results = {key: False for key in lines}
+  operations = []
+  operation_keys = []
+  for (product_id, variant_id), quantity in lines.items():
+    try:
+      product_oid = as_object_id(product_id)
+    except ValueError:
+      continue
+    operations.append(_stock_restore_update(product_oid, variant_id, quantity))
+    operation_keys.append((product_id, variant_id))
+  if not operations:
+    return results
+
+  result = await db.products.bulk_write(operations, ordered=False)
+  if result.modified_count == len(operations):
+    results.update(dict.fromkeys(operation_keys, True))
+    return results
+
+  # bulk_write не сообщает, какие операции не нашли документ, -
+  # проверяем, у каких позиций товар с вариацией существует
+  product_ids = {as_object_id(product_id) for product_id, _variant_id in operation_keys}
+  existing = set()
+  async for doc in db.products.find({"_id": {"$in": list(product_ids)}}, {"variants.id": 1}):
+    for variant in doc.get("variants") or []:
+      existing.add((str(doc["_id"]), variant.get("id")))
+  for key in operation_keys:
+    results[key] = key in existing
+  return results
+
+
+async def decrement_variant_quantities(
+  db: AsyncIOMotorDatabase,
+  items: Iterable[dict],
+) -> Dict[StockKey, bool]:
+  """
+  Списывает со склада товары нескольких позиций с проверкой остатка.
+  Результат - {(product_id, variant_id): списан ли товар}.
+
+  bulk_write сообщает только общее число измененных документов, а для
+  условного списания нужно знать, какая именно позиция не прошла проверку
+  (чтобы не вернуть на склад то, что не списывалось). Поэтому позиции
+  списываются отдельными условными обновлениями, но параллельно.
+  Если какое-то списание завершилось исключением, успешные списания
+  возвращаются на склад, а исключение пробрасывается дальше.
+  """
+  lines = _merge_stock_lines(items)
+  outcomes = await asyncio.gather(*[
+    decrement_variant_quantity(db, product_id, variant_id, quantity)
+    for (product_id, variant_id), quantity in lines.items()
+  ], return_exceptions=True)
+  errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+  if errors:
+    await restore_variant_quantities(db, [
+      {"product_id": product_id, "variant_id": variant_id, "quantity": quantity}
+      for ((product_id, variant_id), quantity), outcome in zip(lines.items(), outcomes)
+      if outcome is True
+    ])
+    raise errors[0]
+  return dict(zip(lines, outcomes))
+
+
 async def mark_order_as_deleted(
   db: AsyncIOMotorDatabase,
   order_doc: dict,
@@ -203,34 +326,23 @@ async def permanently_delete_order_entry(
 
 
 # Кэш статуса магазина для быстрой проверки
-_store_status_cache: dict | None = None
-_store_status_cache_time: float = 0
-_STORE_STATUS_CACHE_TTL = 5.0  # 5 секунд кэш
+_store_awake_cache = TieredCache("store_awake", maxsize=1, ttl=5.0)  # 5 секунд кэш
+
+
+def invalidate_store_awake_cache() -> None:
+  _store_awake_cache.invalidate_local()
+
 
 async def ensure_store_is_awake(
   db: AsyncIOMotorDatabase,
 ) -> None:
   """Оптимизированная проверка статуса магазина с кэшированием"""
-  import time
-  global _store_status_cache, _store_status_cache_time
-  
-  now = time.time()
-  # Используем кэш если он свежий
-  if _store_status_cache and (now - _store_status_cache_time) < _STORE_STATUS_CACHE_TTL:
-    if _store_status_cache.get("is_sleep_mode"):
-      raise HTTPException(
-        status_code=status.HTTP_423_LOCKED,
-        detail=_store_status_cache.get("sleep_message") or "Магазин временно не принимает заказы",
-      )
-    return
-
-  # Обновляем кэш
-  doc = await db.store_status.find_one({}, {"is_sleep_mode": 1, "sleep_message": 1})
-  if doc:
-    _store_status_cache = doc
-    _store_status_cache_time = now
-  if doc.get("is_sleep_mode"):
+  doc = await _store_awake_cache.get_or_load(
+    "current",
+    lambda: db.store_status.find_one({}, {"is_sleep_mode": 1, "sleep_message": 1}),
+  )
+  if doc and doc.get("is_sleep_mode"):
     raise HTTPException(
       status_code=status.HTTP_423_LOCKED,
-        detail=doc.get("sleep_message") or "Магазин временно не принимает заказы",
+      detail=doc.get("sleep_message") or "Магазин временно не принимает заказы",
     )
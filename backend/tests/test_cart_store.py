@@ -0,0 +1,228 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import fakeredis
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from app import cart_store
+from app.config import settings
+
+
+def _lua_has_cjson() -> bool:
+  try:
+    return fakeredis.FakeRedis().eval("return type(cjson)", 0) == b"table"
+  except Exception:
+    return False
+
+
+# Lua-скрипты корзины кодируют позиции через cjson, который есть в Redis,
+# но появился в Lua-движке fakeredis только в новых версиях
+pytestmark = pytest.mark.skipif(
+  not _lua_has_cjson(),
+  reason="нужен fakeredis[lua] с поддержкой cjson (см. requirements-dev.txt)",
+)
+
+
+class FakeCarts:
+  """Минимальная замена db.carts: корзины по user_id и записанные bulk_write операции."""
+
+  def __init__(self):
+    self.docs = {}
+    self.bulk_operations = []
+    self.bulk_error = None
+
+  async def find_one_and_update(self, filter, update, **kwargs):
+    user_id = filter["user_id"]
+    if user_id not in self.docs:
+      self.docs[user_id] = {"_id": ObjectId(), "user_id": user_id, **update["$setOnInsert"]}
+    return self.docs[user_id]
+
+  async def bulk_write(self, operations, ordered=True):
+    self.bulk_operations.extend(operations)
+    if self.bulk_error is not None:
+      raise self.bulk_error
+
+
+class FakeDb:
+  def __init__(self):
+    self.carts = FakeCarts()
+
+
+@pytest.fixture
+def redis(monkeypatch):
+  client = fakeredis.FakeAsyncRedis()
+
+  async def get_redis():
+    return client
+
+  monkeypatch.setattr(cart_store, "get_redis", get_redis)
+  monkeypatch.setattr(cart_store, "_detached_carts", set())
+  monkeypatch.setattr(settings, "cart_store", "redis")
+  return client
+
+
+def make_item(product_id: str = "p1", variant_id: str = "v1", quantity: int = 1, price: float = 10.5) -> dict:
+  return {
+    "id": f"{product_id}-{variant_id}",
+    "product_id": product_id,
+    "variant_id": variant_id,
+    "quantity": quantity,
+    "price": price,
+  }
+
+
+def test_add_item_primes_cart_and_merges_same_variant(redis):
+  async def scenario():
+    await redis.flushall()
+    db = FakeDb()
+    await cart_store.add_item(db, 1, make_item(quantity=1))
+    cart = await cart_store.add_item(db, 1, make_item(quantity=2))
+    assert [(item["product_id"], item["quantity"]) for item in cart["items"]] == [("p1", 3)]
+    assert cart["total_amount"] == 31.5
+    assert cart["_id"] == db.carts.docs[1]["_id"]
+    assert await redis.smembers("cart:dirty") == {b"1"}
+
+  asyncio.run(scenario())
+
+
+def test_set_quantity_and_remove_missing_item(redis):
+  async def scenario():
+    await redis.flushall()
+    db = FakeDb()
+    await cart_store.add_item(db, 1, make_item())
+    cart = await cart_store.set_item_quantity(db, 1, "p1-v1", 4)
+    assert cart["items"][0]["quantity"] == 4
+    assert cart["total_amount"] == 42
+    assert await cart_store.set_item_quantity(db, 1, "missing", 1) is None
+    assert await cart_store.remove_item(db, 1, "missing") is None
+    cart = await cart_store.remove_item(db, 1, "p1-v1")
+    assert cart["items"] == []
+    assert cart["total_amount"] == 0
+
+  asyncio.run(scenario())
+
+
+def test_replace_items_checks_updated_at(redis):
+  async def scenario():
+    await redis.flushall()
+    db = FakeDb()
+    cart = await cart_store.add_item(db, 1, make_item())
+    stale_updated_at = cart["updated_at"] - timedelta(seconds=1)
+    assert await cart_store.replace_items(db, 1, [make_item("p2")], stale_updated_at) is None
+
+    cart = await cart_store.replace_items(db, 1, [make_item("p2")], cart["updated_at"])
+    assert [item["product_id"] for item in cart["items"]] == ["p2"]
+
+  asyncio.run(scenario())
+
+
+def test_expire_cart_returns_items_only_after_cutoff(redis):
+  async def scenario():
+    await redis.flushall()
+    db = FakeDb()
+    cart = await cart_store.add_item(db, 1, make_item(quantity=2))
+    assert await cart_store.expire_cart(db, 1, cart["updated_at"] - timedelta(minutes=1)) is None
+
+    items = await cart_store.expire_cart(db, 1, cart["updated_at"] + timedelta(minutes=1))
+    assert [(item["product_id"], item["quantity"]) for item in items] == [("p1", 2)]
+    assert (await cart_store.load_cart(db, 1))["items"] == []
+
+  asyncio.run(scenario())
+
+
+def test_scripts_are_registered_once_per_client(redis, monkeypatch):
+  registered = []
+  register_script = redis.register_script
+
+  def counting_register_script(script):
+    registered.append(script)
+    return register_script(script)
+
+  monkeypatch.setattr(redis, "register_script", counting_register_script)
+
+  async def scenario():
+    await redis.flushall()
+    db = FakeDb()
+    for _ in range(3):
+      await cart_store.add_item(db, 1, make_item())
+
+  asyncio.run(scenario())
+  assert len(registered) == len(set(registered))
+
+
+def test_flush_writes_snapshot_only_over_older_copy(redis):
+  async def scenario():
+    await redis.flushall()
+    db = FakeDb()
+    cart = await cart_store.add_item(db, 1, make_item())
+    assert await cart_store.flush_dirty_carts(db) == 1
+
+    [operation] = db.carts.bulk_operations
+    assert operation._filter == {"user_id": 1, "updated_at": {"$lt": cart["updated_at"]}}
+    assert operation._doc["$set"]["items"] == cart["items"]
+    assert await redis.scard("cart:dirty") == 0
+
+  asyncio.run(scenario())
+
+
+def test_flush_skips_newer_copy_and_requeues_other_errors(redis):
+  async def scenario():
+    await redis.flushall()
+    db = FakeDb()
+    await cart_store.add_item(db, 1, make_item())
+    await cart_store.add_item(db, 2, make_item())
+    db.carts.bulk_error = BulkWriteError({
+      "writeErrors": [
+        {"index": 0, "code": 11000, "errmsg": "duplicate key"},
+        {"index": 1, "code": 2, "errmsg": "bad value"},
+      ],
+    })
+    assert await cart_store.flush_dirty_carts(db) == 0
+    # Корзина с более новой копией в MongoDB пропущена, упавшая - вернулась в очередь
+    failed_user = db.carts.bulk_operations[1]._filter["user_id"]
+    assert await redis.smembers("cart:dirty") == {str(failed_user).encode()}
+
+  asyncio.run(scenario())
+
+
+def test_script_falls_back_when_cart_vanishes_after_priming(redis, monkeypatch):
+  async def prime_without_storing(db, user_id):
+    return await cart_store._mongo_load_cart(db, user_id)
+
+  monkeypatch.setattr(cart_store, "_prime_cart", prime_without_storing)
+
+  async def scenario():
+    await redis.flushall()
+    db = FakeDb()
+    assert await cart_store._run_cart_script(db, 1, cart_store._LUA_ADD_ITEM, cart_store._dump_items(make_item())) is None
+
+  asyncio.run(scenario())
+
+
+def test_cart_written_to_mongo_during_outage_is_evicted_from_redis(redis, monkeypatch):
+  async def scenario():
+    await redis.flushall()
+    db = FakeDb()
+    await cart_store.add_item(db, 1, make_item())
+    assert await redis.exists("cart:1")
+
+    async def redis_down():
+      return None
+
+    monkeypatch.setattr(cart_store, "get_redis", redis_down)
+    await cart_store.clear_items(db, 1)
+    assert cart_store._detached_carts == {1}
+
+    async def redis_back():
+      return redis
+
+    monkeypatch.setattr(cart_store, "get_redis", redis_back)
+    # Устаревшая копия не сбрасывается поверх MongoDB и удаляется из Redis
+    assert await cart_store.flush_dirty_carts(db) == 0
+    assert db.carts.bulk_operations == []
+    assert not await redis.exists("cart:1")
+    assert cart_store._detached_carts == set()
+
+  asyncio.run(scenario())
@@ -0,0 +1,150 @@
+from bson import ObjectId
+
+from app.catalog_index import CatalogChangeLog, CatalogIndex
+from app.schemas import Category, Product
+
+
+def make_category(name: str = "Жидкости", category_id: str | None = None) -> Category:
+  return Category(name=name, id=category_id or str(ObjectId()))
+
+
+def make_product(category_id: str, name: str = "Товар", product_id: str | None = None, **fields) -> Product:
+  return Product(id=product_id or str(ObjectId()), name=name, price=fields.pop("price", 100), category_id=category_id, **fields)
+
+
+def test_etag_does_not_depend_on_order():
+  category = make_category()
+  first = make_product(category.id, "Первый")
+  second = make_product(category.id, "Второй")
+  assert CatalogIndex([category], [first, second]).etag == CatalogIndex([category], [second, first]).etag
+
+
+def test_upsert_and_remove_restore_etag():
+  category = make_category()
+  product = make_product(category.id)
+  index = CatalogIndex([category], [product])
+  initial_etag = index.etag
+
+  changed = make_product(category.id, "Новое название", product_id=product.id)
+  index.upsert_product(changed)
+  assert index.etag != initial_etag
+  assert index.products[product.id].name == "Новое название"
+
+  index.upsert_product(product)
+  assert index.etag == initial_etag
+
+
+def test_public_index_skips_unavailable_products():
+  category = make_category()
+  product = make_product(category.id)
+  index = CatalogIndex([category], [product])
+
+  index.upsert_product(make_product(category.id, product_id=product.id, available=False))
+  assert product.id not in index.products
+  assert index.category_products(category.id) == []
+
+  admin_index = CatalogIndex([category], [product], only_available=False)
+  admin_index.upsert_product(make_product(category.id, product_id=product.id, available=False))
+  assert product.id in admin_index.products
+
+
+def test_move_product_between_categories_updates_category_etags():
+  first = make_category("Первая")
+  second = make_category("Вторая")
+  product = make_product(first.id)
+  index = CatalogIndex([first, second], [product])
+  first_etag = index.category_etag(first.id)
+  second_etag = index.category_etag(second.id)
+
+  index.upsert_product(make_product(second.id, product_id=product.id))
+  assert index.category_products(first.id) == []
+  assert [item.id for item in index.category_products(second.id)] == [product.id]
+  assert index.category_etag(first.id) != first_etag
+  assert index.category_etag(second.id) != second_etag
+
+
+def test_remove_category_removes_its_products():
+  category = make_category()
+  other = make_category("Другая")
+  product = make_product(category.id)
+  kept = make_product(other.id)
+  index = CatalogIndex([category, other], [product, kept])
+  index.take_changes()
+
+  index.remove_category(category.id)
+  assert category.id not in index.categories
+  assert set(index.products) == {kept.id}
+  assert index.category_etag(category.id) is None
+  assert index.take_changes() == ({category.id}, {product.id})
+
+
+def test_take_changes_resets_changed_ids():
+  category = make_category()
+  index = CatalogIndex([category], [])
+  product = make_product(category.id)
+  index.upsert_product(product)
+  index.upsert_category(make_category("Переименована", category.id))
+
+  assert index.take_changes() == ({category.id}, {product.id})
+  assert index.take_changes() == (set(), set())
+
+
+def test_generation_changes_only_on_product_mutations():
+  category = make_category()
+  index = CatalogIndex([category], [])
+  product = make_product(category.id)
+
+  index.upsert_product(product)
+  generation = index.generation
+  index.remove_product(str(ObjectId()))
+  assert index.generation == generation
+  index.remove_product(product.id)
+  assert index.generation == generation + 1
+
+
+def test_page_products_by_cursor():
+  category = make_category()
+  products = [make_product(category.id, f"Товар {number}") for number in range(5)]
+  index = CatalogIndex([category], products)
+  expected = sorted(product.id for product in products)
+
+  page, cursor = index.page_products(None, 2)
+  assert [product.id for product in page] == expected[:2]
+  page, cursor = index.page_products(cursor, 2)
+  assert [product.id for product in page] == expected[2:4]
+  page, cursor = index.page_products(cursor, 2)
+  assert [product.id for product in page] == expected[4:]
+  assert cursor is None
+
+
+def test_to_response_is_reused_until_mutation():
+  category = make_category()
+  index = CatalogIndex([category], [make_product(category.id)])
+  response = index.to_response()
+  assert index.to_response() is response
+
+  index.upsert_product(make_product(category.id))
+  assert index.to_response() is not response
+  assert len(index.to_response().products) == 2
+
+
+def test_change_log_merges_chain_of_versions():
+  log = CatalogChangeLog()
+  log.record("v2", "v1", categories=["c1"], products=["p1"])
+  log.record("v3", "v2", products=["p2"])
+
+  assert log.changes_between("v1", "v3") == ({"c1"}, {"p1", "p2"})
+  assert log.changes_between("v2", "v3") == (set(), {"p2"})
+  assert log.changes_between("v3", "v3") == (set(), set())
+
+
+def test_change_log_breaks_chain_on_full_reload_and_eviction():
+  log = CatalogChangeLog(maxlen=2)
+  log.record("v2", "v1", products=["p1"])
+  log.record("v3", None)
+  assert log.changes_between("v1", "v3") is None
+
+  log.record("v4", "v3", products=["p2"])
+  # v2 вытеснена из журнала
+  assert log.changes_between("v1", "v2") is None
+  assert log.changes_between("v3", "v4") == (set(), {"p2"})
@@ -0,0 +1,100 @@
+from bson import ObjectId
+
+from app.schemas import Product
+from app import search_index
+from app.search_index import ProductSearchIndex, tokenize
+
+
+def make_product(name: str, description: str | None = None, variants: list | None = None) -> Product:
+  return Product(
+    id=str(ObjectId()),
+    name=name,
+    description=description,
+    price=100,
+    category_id=str(ObjectId()),
+    variants=variants,
+  )
+
+
+def test_tokenize_normalizes_case_and_yo():
+  assert tokenize("Ёлка, ЧАЙ!") == ["елка", "чай"]
+  assert tokenize(None) == []
+
+
+def test_prefix_search_requires_all_tokens():
+  mango = make_product("Манго лед")
+  mango_mint = make_product("Манго мята")
+  index = ProductSearchIndex([mango, mango_mint])
+
+  ids, total = index.search("ман")
+  assert total == 2
+  assert set(ids) == {mango.id, mango_mint.id}
+
+  ids, total = index.search("манго мят")
+  assert (ids, total) == ([mango_mint.id], 1)
+
+
+def test_name_match_ranks_above_description():
+  in_name = make_product("Вишня")
+  in_description = make_product("Ягодный микс", description="вишня и малина")
+  index = ProductSearchIndex([in_description, in_name])
+
+  ids, total = index.search("вишня")
+  assert total == 2
+  assert ids == [in_name.id, in_description.id]
+
+
+def test_variant_names_are_searchable():
+  product = make_product("Жидкость", variants=[{"id": "v1", "name": "Арбуз"}])
+  index = ProductSearchIndex([product])
+  assert index.search("арбуз") == ([product.id], 1)
+
+
+def test_typo_matches_by_trigrams():
+  product = make_product("Клубника")
+  index = ProductSearchIndex([product])
+  assert index.search("клубнка") == ([product.id], 1)
+
+
+def test_add_reindexes_and_remove_drops_tokens():
+  product = make_product("Персик")
+  index = ProductSearchIndex([product])
+
+  renamed = product.copy(update={"name": "Абрикос"})
+  index.add(renamed)
+  assert index.search("персик") == ([], 0)
+  assert index.search("абрикос") == ([product.id], 1)
+  assert len(index) == 1
+
+  index.remove(product.id)
+  assert index.search("абрикос") == ([], 0)
+  assert len(index) == 0
+
+
+def test_search_pagination():
+  products = [make_product(f"Лимон {number}") for number in range(5)]
+  index = ProductSearchIndex(products)
+
+  first_page, total = index.search("лимон", limit=2)
+  second_page, _ = index.search("лимон", limit=2, offset=2)
+  assert total == 5
+  assert len(first_page) == 2
+  assert not set(first_page) & set(second_page)
+
+
+def test_single_letter_tokens_are_ignored():
+  product = make_product("Манго лед")
+  index = ProductSearchIndex([product])
+  assert index.search("м") == ([], 0)
+  assert index.search("манго л") == ([product.id], 1)
+
+
+def test_candidates_are_capped_best_matches_first(monkeypatch):
+  monkeypatch.setattr(search_index, "MAX_CANDIDATES", 3)
+  in_names = [make_product(f"Кола {number}") for number in range(3)]
+  in_descriptions = [make_product(f"Напиток {number}", description="кола") for number in range(5)]
+  index = ProductSearchIndex(in_descriptions + in_names)
+
+  ids, total = index.search("кола", limit=10)
+  assert total == 3
+  assert set(ids) == {product.id for product in in_names}